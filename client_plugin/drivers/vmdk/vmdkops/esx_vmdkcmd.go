@@ -51,6 +51,9 @@ const (
 	// Server side understand protocol version. If you are changing client/server protocol we use
 	// over VMCI, PLEASE DO NOT FORGET TO CHANGE IT FOR SERVER in file <vmdk_ops.py> !
 	clientProtocolVersion = "2"
+	// Error returned by ESX service when its request queue is full. Such requests are retried.
+	// PLEASE KEEP IN SYNC WITH SERVICE_BUSY_ERR in file <vmdk_ops.py> !
+	serverBusyErr = "Service is busy, please retry the operation"
 )
 
 // A request to be passed to ESX service
@@ -109,6 +112,13 @@ func (vmdkCmd EsxVmdkCmd) Run(cmd string, name string, opts map[string]string) (
 	for i := 0; i <= maxRetryCount; i++ {
 		ret, err = C.Vmci_GetReply(C.int(EsxPort), cmdS, beS, ans)
 		if ret == 0 {
+			// ESX service declined the request as its queue is full, retry it.
+			if i < maxRetryCount && isServerBusy(ans) {
+				log.Warnf("Run '%s' failed: ESX service is busy. Retrying...", cmd)
+				C.Vmci_FreeBuf(ans)
+				time.Sleep(time.Second * 1)
+				continue
+			}
 			// Received no error, exit loop.
 			// C.Vmci_GetReply indicates success/faulure by <ret> value.
 			// Cgo  interface adds <err> based on errno. We do not explicitly
@@ -150,6 +160,12 @@ func (vmdkCmd EsxVmdkCmd) Run(cmd string, name string, opts map[string]string) (
 	return response, nil
 }
 
+// isServerBusy returns true if ESX service declined the request because it is overloaded
+func isServerBusy(ans *C.be_answer) bool {
+	err := unmarshalError([]byte(C.GoString(ans.buf)))
+	return err != nil && err.Error() == serverBusyErr
+}
+
 func unmarshalError(str []byte) error {
 	// Unmarshalling null always succeeds
 	if string(str) == "null" {
@@ -41,6 +41,8 @@ import auth_data_const
 import convert
 import auth_api
 import auth_data
+import perf_stats
+from volume_index import volumeIndex
 from auth_data import DB_REF
 from error_code import ErrorCode
 from error_code import error_code_to_message
@@ -182,6 +184,10 @@ def commands():
                             'required': True
                         }
                     }
+                },
+                'reindex': {
+                    'func': reindex,
+                    'help': 'Rebuild the host volume index from the datastores'
                 }
             }
         },
@@ -527,6 +533,14 @@ def commands():
                 '--fast': {
                     'help': 'Skip some of the data collection (port, version)',
                     'action': 'store_true'
+                },
+                '--perf': {
+                    'help': 'Show request latency percentiles per command and phase',
+                    'action': 'store_true'
+                },
+                '--locks': {
+                    'help': 'Show wait and hold times of the most contended locks',
+                    'action': 'store_true'
                 }
             }
         }
@@ -629,18 +643,22 @@ def ls(args):
     if args.vmgroup:
         tenant_reg = args.vmgroup
 
+    unavailable = []
     if args.c:
-        (header, rows) = ls_dash_c(args.c, tenant_reg)
+        (header, rows) = ls_dash_c(args.c, tenant_reg, unavailable)
     else:
         header = all_ls_headers()
-        rows = generate_ls_rows(tenant_reg)
+        rows = generate_ls_rows(tenant_reg, unavailable)
     printList(args.output_format, header, rows)
+    if unavailable and args.output_format != "xml":
+        print("WARNING: Datastores unavailable, volumes on them are not listed: {0}".format(
+            ", ".join(unavailable)))
 
 
-def ls_dash_c(columns, tenant_reg):
+def ls_dash_c(columns, tenant_reg, unavailable=None):
     """ Return only the columns requested in the format required for table construction """
     all_headers = all_ls_headers()
-    all_rows = generate_ls_rows(tenant_reg)
+    all_rows = generate_ls_rows(tenant_reg, unavailable)
     indexes = []
     headers = []
     choices = commands()['volume']['cmds']['ls']['args']['-c']['choices']
@@ -659,10 +677,15 @@ def all_ls_headers():
     return ['Volume', 'Datastore', 'VMGroup', 'Capacity', 'Used', 'Filesystem', 'Policy',
             'Disk Format', 'Attached-to', 'Access', 'Attach-as', 'Created By', 'Created Date']
 
-def generate_ls_rows(tenant_reg):
-    """ Gather all volume metadata into rows that can be used to format a table """
+def generate_ls_rows(tenant_reg, unavailable=None):
+    """
+    Gather all volume metadata into rows that can be used to format a table.
+    Names of datastores that could not be scanned are added to unavailable list, if passed.
+    """
     rows = []
-    for v in vmdk_utils.get_volumes(tenant_reg):
+    volumes = vmdk_utils.get_volumes(tenant_reg, unavailable)
+    vol_infos = kv.get_vol_infos([os.path.join(v['path'], v['filename']) for v in volumes])
+    for v in volumes:
         if 'tenant' not in v or v['tenant'] == auth_data_const.ORPHAN_TENANT:
             tenant = 'N/A'
         else:
@@ -672,7 +695,7 @@ def generate_ls_rows(tenant_reg):
         metadata = get_metadata(path)
         attached_to = get_attached_to(metadata)
         policy = get_policy(metadata, path)
-        size_info = get_vmdk_size_info(path)
+        size_info = get_vmdk_size_info(path, vol_infos)
         created, created_by = get_creation_info(metadata)
         diskformat = get_diskformat(metadata)
         fstype = get_fstype(metadata)
@@ -757,16 +780,20 @@ def get_metadata(volPath):
     return kv.getAll(volPath)
 
 
-def get_vmdk_size_info(path):
+def get_vmdk_size_info(path, vol_infos=None):
     """
     Get the capacity and used space for a given VMDK given its absolute path.
     Values are returned as strings in human readable form (e.g. 10MB)
 
-    Using get_vol_info api from volume kv. The info returned by this
+    Using get_vol_info api from volume kv, unless the info was fetched
+    already into vol_infos (see kv.get_vol_infos). The info returned by this
     api is in human readable form
     """
     try:
-        vol_info = kv.get_vol_info(path)
+        if vol_infos is not None and path in vol_infos:
+            vol_info = vol_infos[path]
+        else:
+            vol_info = kv.get_vol_info(path)
         if not vol_info: # race: volume is already gone
             return {'capacity': NOT_AVAILABLE,
                     'used': NOT_AVAILABLE}
@@ -869,9 +896,90 @@ def status(args):
         output_list.append("{}: {}".format(list(r.keys())[0], list(r.values())[0]))
 
     printMessage(args.output_format,"\n".join(output_list))
+
+    if args.perf or args.locks:
+        if not pid:
+            return err_out("Performance stats are not available, the service is not running.")
+        stats = get_service_perf_stats(int(pid))
+        if not stats:
+            return err_out("Failed to get performance stats from the service.")
+        if args.perf:
+            printMessage(args.output_format, "=== Performance (ms) since {0}".format(
+                         time.asctime(time.localtime(stats["since"]))))
+            printList(args.output_format, perf_stats_headers(), generate_perf_stats_rows(stats["stats"]))
+        if args.locks:
+            printMessage(args.output_format, "=== Most contended locks (ms)")
+            printList(args.output_format, lock_stats_headers(), generate_lock_stats_rows(stats["locks"]))
     return None
 
 
+# Max time (seconds) to wait for the service to save performance stats
+PERF_STATS_WAIT = 5
+
+def get_service_perf_stats(pid):
+    """
+    Ask the service (by SIGUSR1) to save its performance stats and return them,
+    or None if the service didn't respond in time
+    """
+    requested = time.time()
+    try:
+        os.kill(pid, signal.SIGUSR1)
+    except OSError:
+        return None
+    deadline = requested + PERF_STATS_WAIT
+    while time.time() < deadline:
+        stats = perf_stats.load()
+        if stats and stats["time"] >= requested:
+            return stats
+        time.sleep(0.1)
+    return None
+
+
+def perf_stats_headers():
+    """ Return column names for status --perf """
+    return ['Command', 'Phase', 'Count', 'Avg', 'P50', 'P95', 'P99', 'Max']
+
+
+def generate_perf_stats_rows(stats):
+    """ Gather per command and phase latencies into rows """
+    def ms(value):
+        return NOT_AVAILABLE if value is None else '{:.1f}'.format(value)
+
+    rows = []
+    for s in stats:
+        rows.append([s['cmd'], s['phase'], str(s['count']), ms(s['avg_ms']),
+                     ms(s['p50_ms']), ms(s['p95_ms']), ms(s['p99_ms']), ms(s['max_ms'])])
+    return rows
+
+
+def lock_stats_headers():
+    """ Return column names for status --locks """
+    return ['Lock', 'Acquired', 'Contended', 'Wait Total', 'Wait Max',
+            'Hold Avg', 'Hold Max', 'Holders']
+
+
+def generate_lock_stats_rows(stats):
+    """ Gather lock wait and hold times into rows """
+    rows = []
+    for s in stats:
+        hold_avg = s['hold_total_ms'] / s['acquired'] if s['acquired'] else 0
+        rows.append([s['name'], str(s['acquired']), str(s['contended']),
+                     '{:.1f}'.format(s['wait_total_ms']), '{:.1f}'.format(s['wait_max_ms']),
+                     '{:.1f}'.format(hold_avg), '{:.1f}'.format(s['hold_max_ms']),
+                     ", ".join(s['holders'])])
+    return rows
+
+
+def reindex(args):
+    """ Drop the volume index and fill it again by reading all volumes """
+    volumeIndex.clear()
+    count = 0
+    for v in vmdk_utils.get_volumes('*'):
+        kv.getAll(os.path.join(v['path'], v['filename']))
+        count += 1
+    printMessage(args.output_format, 'Volume index rebuilt: {0} volumes'.format(count))
+
+
 def set_vol_opts(args):
     try:
         set_ok = vmdk_ops.set_vol_opts(args.volume, args.vmgroup, args.options)
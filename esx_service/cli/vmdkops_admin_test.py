@@ -269,6 +269,20 @@ class TestParsing(unittest.TestCase):
         args = self.parser.parse_args(['status'])
         self.assertEqual(args.func, vmdkops_admin.status)
 
+    def test_status_perf(self):
+        args = self.parser.parse_args(['status', '--perf'])
+        self.assertEqual(args.func, vmdkops_admin.status)
+        self.assertTrue(args.perf)
+
+    def test_status_locks(self):
+        args = self.parser.parse_args(['status', '--locks'])
+        self.assertEqual(args.func, vmdkops_admin.status)
+        self.assertTrue(args.locks)
+
+    def test_volume_reindex(self):
+        args = self.parser.parse_args(['volume', 'reindex'])
+        self.assertEqual(args.func, vmdkops_admin.reindex)
+
     def test_set_no_args(self):
         self.assert_parse_error('set')
 
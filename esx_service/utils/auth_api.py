@@ -130,6 +130,23 @@ def get_tenant_name(tenant_uuid):
     return error_info, tenant_name
 
 
+def get_tenant_names():
+    """
+        Get names of all tenants
+        Return value:
+        -- error_info: return None on success or error info on failure
+        -- tenant_names: return a dict of tenant_uuid -> tenant_name on success or None on failure
+    """
+    error_info, auth_mgr = get_auth_mgr_object()
+    if error_info:
+        return error_info, None
+
+    error_msg, tenant_names = auth_mgr.get_tenant_names()
+    if error_msg:
+        error_info = generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg)
+    return error_info, tenant_names
+
+
 def check_tenant_exist(name):
     """ Check tenant with @param name exist or not
         Return value:
@@ -1318,6 +1318,21 @@ class AuthorizationDataManager:
             logging.debug("get_tenant_name:"+error_msg)
             return error_msg, None
 
+    def get_tenant_names(self):
+        """ Return a dict of tenant_uuid -> tenant_name for all tenants """
+        if self.allow_all_access():
+            return None, {auth_data_const.DEFAULT_TENANT_UUID: auth_data_const.DEFAULT_TENANT}
+
+        try:
+            cur = self.conn.execute(
+                "SELECT id, name FROM tenants"
+                )
+        except sqlite3.Error as e:
+            logging.error("Error: %s when querying tenants table", e)
+            return str(e), None
+
+        return None, dict((r[0], r[1]) for r in cur.fetchall())
+
 def main():
     log_config.configure()
 
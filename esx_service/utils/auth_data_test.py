@@ -417,6 +417,12 @@ class TestAuthDataModel(unittest.TestCase):
 
         self.assertEqual(tenant2_actual_output, tenant2_expected_output)
 
+        # check tenant names
+        error_info, tenant_names = self.auth_mgr.get_tenant_names()
+        self.assertEqual(error_info, None)
+        self.assertEqual(tenant_names[tenant1.id], self.tenant_name)
+        self.assertEqual(tenant_names[tenant2.id], self.tenant_2_name)
+
 
     def test_remove_tenants(self):
         vms = [(self.vm1_uuid, self.vm1_name)]
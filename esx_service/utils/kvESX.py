@@ -23,11 +23,13 @@ from ctypes import \
         create_string_buffer, addressof
 import json
 import logging
+import re
 import sys
 import errno
 import time
 import threadutils
 import vmdk_utils
+import perf_stats
 import os
 
 # Python version 3.5.1
@@ -73,11 +75,60 @@ VMDK_MAX_SNAPS = 32
 # Default kv side car alignment
 KV_ALIGN = 4096
 
+# Side car formats.
+# Version 1 is the KV dict as JSON, padded to KV_ALIGN.
+# Version 2 is the same JSON dict (so it is still read by version 1 code)
+# laid out in two parts, each padded to KV_ALIGN:
+#  - creation meta-data and options, starting with KV_FORMAT_KEY,
+#  - the hot status record (KV_HOT_KEYS) and KV_GENERATION_KEY, as the last block.
+# Attach and detach only change the hot record, so only the last block is written.
+# The generation is bumped on every save, for caches to validate against.
+KV_FORMAT_KEY = '_kvFormat'
+KV_GENERATION_KEY = '_kvGeneration'
+KV_FORMAT_V2 = 2
+# Same values as volume_kv.STATUS, ATTACHED_VM_UUID, ATTACHED_VM_NAME and
+# ATTACHED_VM_DEV; volume_kv can't be imported from here.
+KV_HOT_KEYS = ['status', 'attachedVMUuid', 'attachedVMName', 'attachedVMDevice']
+
 # Flag to track the version of Python on the platform
 is_64bits = False
 
-# Get a Reentrant locking decorator
-diskLibLock = threadutils.get_lock_decorator(reentrant=True)
+# DiskLib is not thread safe, calls into it are serialized with diskLibRLock
+# (taken directly or with the diskLibLock decorator)
+diskLibRLock = threadutils.get_lock(reentrant=True)
+diskLibLock = threadutils.get_lock_decorator(lock=diskLibRLock)
+
+# Side car I/O is serialized per volume, so that metadata access for
+# different volumes runs in parallel. The first argument of functions
+# decorated with volumeLock is the volume path.
+volumeLocks = threadutils.LockManager()
+volumeLock = threadutils.get_key_lock_decorator(volumeLocks, reentrant=True)
+
+
+# Volume type per datastore (all volumes on a datastore have the same type) and
+# volume path -> (descriptor signature, side car file path). Side car entries
+# are checked against the descriptor file, so a re-created volume is resolved
+# again. Entries are dropped when the side car is deleted.
+volTypeCache = {}
+metaFileCache = {}
+metaCacheLock = threadutils.get_lock()
+
+# Version 2 layout of side car files as last read or written by this process:
+# meta file path -> (file signature, generation, cold part). Lets save() write
+# a side car without reading it first. Entries are checked against the file
+# (inode, size, mtime), and by generation if it changed within
+# KV_MTIME_GRANULARITY seconds, as a write in the same mtime tick may not
+# change the rest of the signature.
+kvLayoutCache = {}
+KV_MTIME_GRANULARITY = 2
+
+
+def get_volume_lock(volpath):
+    """
+    Return the lock serializing side car I/O for volpath, to make
+    a sequence of KV calls atomic for this process
+    """
+    return volumeLocks.get_lock(volpath, reentrant=True)
 
 
 class disk_info(Structure):
@@ -190,6 +241,24 @@ def kv_esx_init():
 
 
 def get_vol_type(volpath):
+    """
+    Return the object type of the volume, cached per datastore
+    """
+    match = re.search(vmdk_utils.DATASTORE_PATH_REGEXP, volpath)
+    datastore = match.group(1) if match else None
+    with metaCacheLock:
+        vol_type = volTypeCache.get(datastore)
+    if vol_type:
+        return vol_type
+
+    vol_type = lookup_vol_type(volpath)
+    if vol_type and datastore:
+        with metaCacheLock:
+            volTypeCache[datastore] = vol_type
+    return vol_type
+
+@diskLibLock
+def lookup_vol_type(volpath):
     vol_type = c_uint32(0)
     res = lib.ObjLib_PathToType(volpath.encode(), byref(vol_type))
     if res != 0:
@@ -213,6 +282,91 @@ def get_kv_filename(volpath):
     return None
 
 
+def get_descriptor_sig(volpath):
+    """ Return (inode, mtime) of the volume descriptor, or None if it can't be checked """
+    try:
+        st = os.stat(volpath)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns)
+
+
+def get_meta_file(volpath):
+    """
+    Return the path of the KV (side car) file for the volume, or None.
+    Cached per volume, see metaFileCache.
+    """
+    sig = get_descriptor_sig(volpath)
+    with metaCacheLock:
+        entry = metaFileCache.get(volpath)
+    if sig and entry and entry[0] == sig:
+        return entry[1]
+
+    meta_file = resolve_meta_file(volpath)
+    if meta_file and sig:
+        with metaCacheLock:
+            metaFileCache[volpath] = (sig, meta_file)
+    return meta_file
+
+
+def forget_meta_file(volpath):
+    """ Drop the cached side car file path (and layout) for the volume """
+    with metaCacheLock:
+        entry = metaFileCache.pop(volpath, None)
+        if entry:
+            kvLayoutCache.pop(entry[1], None)
+
+
+def _file_sig(st):
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _put_layout(meta_file, file_sig, generation, cold_str):
+    """ Cache the version 2 layout of meta_file, which had file_sig with it """
+    with metaCacheLock:
+        kvLayoutCache[meta_file] = (file_sig, generation, cold_str)
+
+
+def _forget_layout(meta_file):
+    with metaCacheLock:
+        kvLayoutCache.pop(meta_file, None)
+
+
+def _get_layout(meta_file):
+    """
+    Return (generation, cold part) of meta_file if it is unchanged since
+    its layout was cached, else None.
+    """
+    with metaCacheLock:
+        entry = kvLayoutCache.get(meta_file)
+    if not entry:
+        return None
+    try:
+        st = os.stat(meta_file)
+    except OSError:
+        return None
+    if _file_sig(st) != entry[0]:
+        return None
+    if time.time() - st.st_mtime < KV_MTIME_GRANULARITY and get_generation(meta_file) != entry[1]:
+        return None
+    return entry[1], entry[2]
+
+
+def resolve_meta_file(volpath):
+    """
+    Find the path of the KV (side car) file for the volume, or None
+    """
+    vol_type = get_vol_type(volpath)
+    if not vol_type:
+        logging.warning("KV - could not determine type of volume %s", volpath)
+        return None
+    if vol_type == c_uint32(KV_VOL_VIRTUAL).value:
+        with diskLibRLock:
+            return lib.DiskLib_SidecarMakeFileName(volpath.encode(),
+                                                   DVOL_KEY.encode())
+    return get_kv_filename(volpath)
+
+
 @diskLibLock
 def vol_open_path(volpath, open_flags=VMDK_OPEN_DEFAULT):
     """
@@ -231,10 +385,11 @@ def vol_open_path(volpath, open_flags=VMDK_OPEN_DEFAULT):
     return dhandle
 
 
-@diskLibLock
+@volumeLock
 def create(volpath, kv_dict):
     """
     Create the side car for the volume identified by volpath.
+    Returns the signature of the side car as written (see save()), or False.
     """
     obj_handle = get_uint(0)
 
@@ -246,54 +401,58 @@ def create(volpath, kv_dict):
     if vol_type == c_uint32(KV_VOL_VIRTUAL).value:
         return save(volpath, kv_dict)
 
-    dhandle = vol_open_path(volpath)
-    if not disk_is_valid(dhandle):
-        return False
-    if use_sidecar_create:
-        res = lib.DiskLib_SidecarCreate(dhandle, DVOL_KEY.encode(),
-                                        KV_CREATE_SIZE, KV_SIDECAR_CREATE,
-                                        byref(obj_handle))
-    else:
-        res = lib.DiskLib_SidecarOpen(dhandle, DVOL_KEY.encode(),
-                                      KV_SIDECAR_CREATE,
-                                      byref(obj_handle))
-    if res != 0:
-        logging.warning("Side car create for %s failed - %x", volpath, res)
-        lib.DiskLib_Close(dhandle)
-        return False
+    with diskLibRLock:
+        dhandle = vol_open_path(volpath)
+        if not disk_is_valid(dhandle):
+            return False
+        if use_sidecar_create:
+            res = lib.DiskLib_SidecarCreate(dhandle, DVOL_KEY.encode(),
+                                            KV_CREATE_SIZE, KV_SIDECAR_CREATE,
+                                            byref(obj_handle))
+        else:
+            res = lib.DiskLib_SidecarOpen(dhandle, DVOL_KEY.encode(),
+                                          KV_SIDECAR_CREATE,
+                                          byref(obj_handle))
+        if res != 0:
+            logging.warning("Side car create for %s failed - %x", volpath, res)
+            lib.DiskLib_Close(dhandle)
+            return False
 
-    lib.DiskLib_SidecarClose(dhandle, DVOL_KEY.encode(), byref(obj_handle))
-    lib.DiskLib_Close(dhandle)
+        lib.DiskLib_SidecarClose(dhandle, DVOL_KEY.encode(), byref(obj_handle))
+        lib.DiskLib_Close(dhandle)
 
     return save(volpath, kv_dict)
 
 
-@diskLibLock
+@volumeLock
 def delete(volpath):
     """
     Delete the side car for the given volume.
     """
+    forget_meta_file(volpath)
     vol_type = get_vol_type(volpath)
     if not vol_type:
         logging.warning("KV delete - could not determine type of volume %s", volpath)
         return False
     if vol_type == c_uint32(KV_VOL_VIRTUAL).value:
-        meta_file = lib.DiskLib_SidecarMakeFileName(volpath.encode(), DVOL_KEY.encode())
+        with diskLibRLock:
+            meta_file = lib.DiskLib_SidecarMakeFileName(volpath.encode(), DVOL_KEY.encode())
         if os.path.exists(meta_file):
             os.unlink(meta_file)
             return True
 
     # Other volume types are storage specific sidecars.
-    dhandle = vol_open_path(volpath)
-    if not disk_is_valid(dhandle):
-        return False
-    res = lib.DiskLib_SidecarDelete(dhandle, DVOL_KEY.encode())
-    if res != 0:
-        logging.warning("Side car delete for %s failed - %x", volpath, res)
-        lib.DiskLib_Close(dhandle)
-        return False
+    with diskLibRLock:
+        dhandle = vol_open_path(volpath)
+        if not disk_is_valid(dhandle):
+            return False
+        res = lib.DiskLib_SidecarDelete(dhandle, DVOL_KEY.encode())
+        if res != 0:
+            logging.warning("Side car delete for %s failed - %x", volpath, res)
+            lib.DiskLib_Close(dhandle)
+            return False
 
-    lib.DiskLib_Close(dhandle)
+        lib.DiskLib_Close(dhandle)
     return True
 
 
@@ -301,108 +460,210 @@ def align_str(kv_str, block):
     """
     Align a given string to the specified block boundary.
     """
-    # Align string to the next block boundary. The -1 is to accommodate
+    # Align string to the next block boundary, leaving room for
     # a newline at the end of the string.
-    aligned_len = int((len(kv_str) + block - 1) / block) * block - 1
+    aligned_len = int((len(kv_str) + block) / block) * block - 1
     return '{:<{width}}\n'.format(kv_str, width=aligned_len)
 
 
-@diskLibLock
+def encode_kv(kv_dict, generation):
+    """
+    Return (cold part, hot part) of the version 2 side car content for kv_dict.
+    """
+    cold = dict((k, v) for k, v in kv_dict.items() if k not in KV_HOT_KEYS)
+    cold[KV_FORMAT_KEY] = KV_FORMAT_V2
+    hot = dict((k, v) for k, v in kv_dict.items() if k in KV_HOT_KEYS)
+    hot[KV_GENERATION_KEY] = generation
+    # Split a single JSON dict in two: '{cold...,' and 'hot...}'
+    cold_str = json.dumps(cold, sort_keys=True)[:-1] + ','
+    hot_str = json.dumps(hot, sort_keys=True)[1:]
+    return align_str(cold_str, KV_ALIGN), align_str(hot_str, KV_ALIGN)
+
+
+def decode_kv(kv_str):
+    """
+    Return (KV dict, generation, offset of the hot block) for side car
+    content of any format. Generation and offset are None unless the content
+    has version 2 layout. Raises ValueError if the content is not valid.
+    """
+    kv_dict = json.loads(kv_str)
+    generation = None
+    hot_offset = None
+    if kv_dict.get(KV_FORMAT_KEY) == KV_FORMAT_V2:
+        # Version 1 code may have rewritten the file keeping our keys,
+        # so check the layout
+        hot_offset = len(kv_str) - KV_ALIGN
+        generation = parse_generation(kv_str[hot_offset:])
+        if generation is None or not kv_str[:hot_offset].rstrip().endswith(','):
+            generation = hot_offset = None
+    kv_dict.pop(KV_FORMAT_KEY, None)
+    kv_dict.pop(KV_GENERATION_KEY, None)
+    return kv_dict, generation, hot_offset
+
+
+def parse_generation(hot_str):
+    """ Return the generation in a version 2 hot block, or None if it isn't one """
+    try:
+        hot = json.loads('{' + hot_str)
+    except ValueError:
+        return None
+    if not isinstance(hot, dict):
+        return None
+    return hot.get(KV_GENERATION_KEY)
+
+
+def get_generation(meta_file):
+    """
+    Return the generation of a version 2 side car, reading its last block only.
+    Returns None for older formats or on errors.
+    """
+    try:
+        with open(meta_file, "rb") as fh:
+            size = os.fstat(fh.fileno()).st_size
+            if size < 2 * KV_ALIGN:
+                return None
+            fh.seek(size - KV_ALIGN)
+            return parse_generation(fh.read(KV_ALIGN).decode())
+    except (IOError, OSError, UnicodeDecodeError):
+        return None
+
+
+@volumeLock
 def load(volpath):
     """
     Load and return dictionary from the sidecar
     """
-    vol_type = get_vol_type(volpath)
-    if not vol_type:
-        logging.warning("KV delete - could not determine type of volume %s", volpath)
+    meta_file = get_meta_file(volpath)
+    if not meta_file:
         return None
-    if vol_type == c_uint32(KV_VOL_VIRTUAL).value:
-        meta_file = lib.DiskLib_SidecarMakeFileName(volpath.encode(),
-                                                    DVOL_KEY.encode())
-    else:
-        meta_file = get_kv_filename(volpath)
-        if not meta_file:
-            return None
     retry_count = 0
     vol_name = vmdk_utils.get_volname_from_vmdk_path(volpath)
     while True:
         try:
-            with open(meta_file, "r") as fh:
-                kv_str = fh.read()
+            with perf_stats.phase(perf_stats.PHASE_KV_LOAD):
+                with open(meta_file, "r") as fh:
+                    # taken before the read, so a change meanwhile makes the layout miss
+                    file_sig = _file_sig(os.fstat(fh.fileno()))
+                    kv_str = fh.read()
             break
         except IOError as open_error:
             # This is a workaround to the timing/locking with metadata files issue #626
             if open_error.errno == errno.EBUSY and retry_count <= vmdk_utils.VMDK_RETRY_COUNT:
                 logging.warning("Meta file %s busy for load(), retrying...", meta_file)
                 vmdk_utils.log_volume_lsof(vol_name)
+                time.sleep(vmdk_utils.retry_sleep_time(retry_count))
                 retry_count += 1
-                time.sleep(vmdk_utils.VMDK_RETRY_SLEEP)
             else:
                 logging.exception("Failed to access %s", meta_file)
                 return None
 
     try:
-        return json.loads(kv_str)
+        kv_dict, generation, hot_offset = decode_kv(kv_str)
     except ValueError:
         logging.exception("load:Failed to decode meta-data for %s", volpath)
         return None
+    if hot_offset is not None:
+        _put_layout(meta_file, file_sig, generation, kv_str[:hot_offset])
+    return kv_dict
 
 
-@diskLibLock
+@volumeLock
 def save(volpath, kv_dict, key=None, value=None):
     """
     Save the dictionary to side car.
+    If key is set, the side car is read and only saved if it has value for
+    key, or doesn't have key. Otherwise it is not read if its layout is
+    known (see kvLayoutCache), and only its last block is read if not.
+    With version 2 layout and the cold part unchanged, only the hot block is
+    written.
+    Returns the signature (inode, size, mtime ns, generation) of the side car
+    as written, taken from the descriptor used for the write, or False if
+    it wasn't saved. generation is None unless it has version 2 layout.
     """
-    vol_type = get_vol_type(volpath)
-    if not vol_type:
-        logging.warning("KV delete - could not determine type of volume %s", volpath)
+    meta_file = get_meta_file(volpath)
+    if not meta_file:
         return False
-    if vol_type == c_uint32(KV_VOL_VIRTUAL).value:
-        meta_file = lib.DiskLib_SidecarMakeFileName(volpath.encode(),
-                                                    DVOL_KEY.encode())
-    else:
-        meta_file = get_kv_filename(volpath)
-        if not meta_file:
-            return False
-
-    kv_str = json.dumps(kv_dict)
 
     retry_count = 0
     vol_name = vmdk_utils.get_volname_from_vmdk_path(volpath)
     while True:
         try:
-            if key:
-                with open(meta_file, "r") as rfh:
-                    kv_val = rfh.read()
-                    try:
-                        kv_match = json.loads(kv_val)
-                    except ValueError:
-                        logging.exception("load:Failed to decode meta-data for %s", volpath)
-                        return False
-
-                    if key in kv_match and kv_match[key] != value:
-                        return False
-            with open(meta_file, "w") as fh:
-                fh.write(align_str(kv_str, KV_ALIGN))
-            break
+            with perf_stats.phase(perf_stats.PHASE_KV_SAVE):
+                if key:
+                    return _save_checked(meta_file, volpath, kv_dict, key, value)
+                return _save_unchecked(meta_file, kv_dict)
         except IOError as open_error:
             # This is a workaround to the timing/locking with metadata files issue #626
             if open_error.errno == errno.EBUSY and retry_count <= vmdk_utils.VMDK_RETRY_COUNT:
                 logging.warning("Meta file %s busy for save(), retrying...", meta_file)
                 vmdk_utils.log_volume_lsof(vol_name)
+                time.sleep(vmdk_utils.retry_sleep_time(retry_count))
                 retry_count += 1
-                time.sleep(vmdk_utils.VMDK_RETRY_SLEEP)
             else:
                 logging.exception("Failed to save meta-data for %s", volpath)
+                _forget_layout(meta_file)
                 return False
 
-    return True
 
-@diskLibLock
+def _save_checked(meta_file, volpath, kv_dict, key, value):
+    """ Compare-and-set part of save(), reads the existing side car """
+    with os.fdopen(os.open(meta_file, os.O_RDWR), "r+b") as fh:
+        kv_val = fh.read().decode()
+        try:
+            kv_match, generation, hot_offset = decode_kv(kv_val)
+        except ValueError:
+            logging.exception("load:Failed to decode meta-data for %s", volpath)
+            return False
+
+        if key in kv_match and kv_match[key] != value:
+            return False
+        cold_str = kv_val[:hot_offset] if hot_offset is not None else None
+        return _write_kv(fh, meta_file, kv_dict, generation, cold_str)
+
+
+def _save_unchecked(meta_file, kv_dict):
+    """ Part of save() without compare-and-set, writes the side car without reading it """
+    layout = _get_layout(meta_file)
+    if layout:
+        generation, cold_str = layout
+    else:
+        # Keep generations increasing over saves of any process
+        generation, cold_str = get_generation(meta_file), None
+    with os.fdopen(os.open(meta_file, os.O_WRONLY | os.O_CREAT, 0o666), "wb") as fh:
+        return _write_kv(fh, meta_file, kv_dict, generation, cold_str)
+
+
+def _write_kv(fh, meta_file, kv_dict, generation, cold_str):
+    """
+    Write kv_dict to the side car open as fh, which has version 2 layout
+    with generation and cold part cold_str, or any content if cold_str is None.
+    Returns the signature of the written side car, see save().
+    """
+    new_generation = (generation or 0) + 1
+    new_cold_str, hot_str = encode_kv(kv_dict, new_generation)
+    if new_cold_str == cold_str and len(hot_str) == KV_ALIGN:
+        # Only the status record changed
+        fh.seek(len(cold_str))
+        fh.write(hot_str.encode())
+    else:
+        # Full rewrite, also migrates older formats
+        fh.seek(0)
+        fh.truncate()
+        fh.write((new_cold_str + hot_str).encode())
+    fh.flush()
+    file_sig = _file_sig(os.fstat(fh.fileno()))
+    if len(hot_str) == KV_ALIGN:
+        _put_layout(meta_file, file_sig, new_generation, new_cold_str)
+        return file_sig + (new_generation,)
+    # decode_kv() takes the last KV_ALIGN bytes as hot block
+    _forget_layout(meta_file)
+    return file_sig + (None,)
+
 def fixup_kv(src_volpath, dst_volpath):
     """
     Fix up the sidecars for the destination volume which ever is a
     volume of type - virtual.
+    Side car I/O is locked per volume by load() and create().
     """
     src_vol_type = get_vol_type(src_volpath)
     logging.warning("Source vvol type %x", src_vol_type)
@@ -421,16 +682,18 @@ def fixup_kv(src_volpath, dst_volpath):
         # the source will create a native sidecar that must be deleted
         # and a new flat file version is created.
         if dst_vol_type == c_uint32(KV_VOL_VIRTUAL).value:
-            dhandle = vol_open_path(dst_volpath)
-            if not disk_is_valid(dhandle):
-                return False
-            res = lib.DiskLib_SidecarDelete(dhandle, DVOL_KEY.encode())
-            if res != 0:
-                logging.warning("Side car delete for %s failed - %x", dst_volpath, res)
+            forget_meta_file(dst_volpath)
+            with diskLibRLock:
+                dhandle = vol_open_path(dst_volpath)
+                if not disk_is_valid(dhandle):
+                    return False
+                res = lib.DiskLib_SidecarDelete(dhandle, DVOL_KEY.encode())
+                if res != 0:
+                    logging.warning("Side car delete for %s failed - %x", dst_volpath, res)
+                    lib.DiskLib_Close(dhandle)
+                    return False
+
                 lib.DiskLib_Close(dhandle)
-                return False
-    
-            lib.DiskLib_Close(dhandle)
             src_dict = load(src_volpath)
             return create(dst_volpath, src_dict)
         else:
@@ -442,11 +705,33 @@ def fixup_kv(src_volpath, dst_volpath):
         src_dict = load(src_volpath)
         return create(dst_volpath, src_dict)
 
+# Number of volumes get_infos() handles per hold of the DiskLib lock
+INFO_BATCH_SIZE = 16
+
 @diskLibLock
 def get_info(volpath):
     """
     Return disk stats for the volume
     """
+    return _get_info(volpath)
+
+
+def get_infos(volpaths):
+    """
+    Return a dict of volpath -> disk stats (or None on error) for a list of volumes.
+    DiskLib calls are serialized, so volumes are handled in batches of
+    INFO_BATCH_SIZE per hold of the DiskLib lock, letting other requests in between.
+    """
+    infos = {}
+    for start in range(0, len(volpaths), INFO_BATCH_SIZE):
+        with diskLibRLock:
+            for volpath in volpaths[start:start + INFO_BATCH_SIZE]:
+                infos[volpath] = _get_info(volpath)
+    return infos
+
+
+def _get_info(volpath):
+    """ Return disk stats for the volume. Called with diskLibRLock held """
     dhandle = vol_open_path(volpath, VMDK_OPEN_DISKCHAIN_NOIO)
 
     if not disk_is_valid(dhandle):
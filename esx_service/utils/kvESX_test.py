@@ -0,0 +1,193 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests for side car formats in kvESX.py
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import kvESX
+
+KV_DICT = {'status': 'attached',
+           'attachedVMUuid': '564d-1234',
+           'attachedVMName': 'vm1',
+           'created-by': 'vm1',
+           'volOpts': {'size': '100mb', 'fstype': 'ext4'}}
+
+
+def v1_content(kv_dict):
+    """ Side car content as written by version 1 code """
+    return kvESX.align_str(json.dumps(kv_dict), kvESX.KV_ALIGN)
+
+
+class TestKVFormat(unittest.TestCase):
+    """ Test encoding and decoding of side car content """
+
+    def test_align_str(self):
+        self.assertEqual(len(kvESX.align_str("x" * 10, kvESX.KV_ALIGN)), kvESX.KV_ALIGN)
+        # room for the newline
+        self.assertEqual(len(kvESX.align_str("x" * (kvESX.KV_ALIGN - 1), kvESX.KV_ALIGN)),
+                         kvESX.KV_ALIGN)
+        self.assertEqual(len(kvESX.align_str("x" * kvESX.KV_ALIGN, kvESX.KV_ALIGN)),
+                         kvESX.KV_ALIGN * 2)
+
+    def test_round_trip(self):
+        cold_str, hot_str = kvESX.encode_kv(KV_DICT, 5)
+        self.assertEqual(len(cold_str) % kvESX.KV_ALIGN, 0)
+        self.assertEqual(len(hot_str), kvESX.KV_ALIGN)
+        kv_dict, generation, hot_offset = kvESX.decode_kv(cold_str + hot_str)
+        self.assertEqual(kv_dict, KV_DICT)
+        self.assertEqual(generation, 5)
+        self.assertEqual(hot_offset, len(cold_str))
+        self.assertEqual(kvESX.parse_generation(hot_str), 5)
+
+    def test_hot_keys(self):
+        cold_str, hot_str = kvESX.encode_kv(KV_DICT, 1)
+        for key in kvESX.KV_HOT_KEYS:
+            if key in KV_DICT:
+                self.assertIn(key, hot_str)
+                self.assertNotIn(key, cold_str)
+        # attach/detach leave the cold part as is
+        detached = dict(KV_DICT, status='detached')
+        del detached['attachedVMUuid']
+        self.assertEqual(kvESX.encode_kv(detached, 2)[0], cold_str)
+
+    def test_v2_read_as_json(self):
+        """ Version 1 code reads version 2 side cars """
+        kv_dict = json.loads(''.join(kvESX.encode_kv(KV_DICT, 3)))
+        self.assertEqual(kv_dict[kvESX.KV_GENERATION_KEY], 3)
+        del kv_dict[kvESX.KV_GENERATION_KEY]
+        del kv_dict[kvESX.KV_FORMAT_KEY]
+        self.assertEqual(kv_dict, KV_DICT)
+
+    def test_decode_v1(self):
+        kv_dict, generation, hot_offset = kvESX.decode_kv(v1_content(KV_DICT))
+        self.assertEqual(kv_dict, KV_DICT)
+        self.assertIsNone(generation)
+        self.assertIsNone(hot_offset)
+        self.assertIsNone(kvESX.parse_generation(v1_content(KV_DICT)))
+
+    def test_decode_v2_rewritten_by_v1(self):
+        """ Version 1 code rewrote a version 2 side car, keeping our keys """
+        kv_dict = json.loads(''.join(kvESX.encode_kv(KV_DICT, 3)))
+        kv_dict['status'] = 'detached'
+        decoded, generation, hot_offset = kvESX.decode_kv(v1_content(kv_dict))
+        self.assertEqual(decoded, dict(KV_DICT, status='detached'))
+        self.assertIsNone(generation)
+        self.assertIsNone(hot_offset)
+
+    def test_decode_invalid(self):
+        self.assertRaises(ValueError, kvESX.decode_kv, "{not json")
+        self.assertIsNone(kvESX.parse_generation("not json"))
+
+
+class TestKVSave(unittest.TestCase):
+    """ Test save() and load() on a side car file """
+
+    volpath = "/vmfs/volumes/ds1/dockvols/vol1.vmdk"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.meta_file = os.path.join(self.tmp_dir, "vol1-1234.vmfd")
+        self.get_meta_file = kvESX.get_meta_file
+        kvESX.get_meta_file = lambda volpath: self.meta_file
+        self.granularity = kvESX.KV_MTIME_GRANULARITY
+        kvESX.KV_MTIME_GRANULARITY = -1
+        kvESX.kvLayoutCache.clear()
+
+    def tearDown(self):
+        kvESX.get_meta_file = self.get_meta_file
+        kvESX.KV_MTIME_GRANULARITY = self.granularity
+        kvESX.kvLayoutCache.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self):
+        with open(self.meta_file) as fh:
+            return fh.read()
+
+    def write(self, content):
+        with open(self.meta_file, "w") as fh:
+            fh.write(content)
+
+    def test_save_load(self):
+        self.assertTrue(kvESX.save(self.volpath, KV_DICT))
+        self.assertEqual(kvESX.load(self.volpath), KV_DICT)
+        self.assertEqual(kvESX.get_generation(self.meta_file), 1)
+        self.assertTrue(kvESX.save(self.volpath, dict(KV_DICT, status='detached')))
+        self.assertEqual(kvESX.load(self.volpath)['status'], 'detached')
+        self.assertEqual(kvESX.get_generation(self.meta_file), 2)
+
+    def test_save_signature(self):
+        write_sig = kvESX.save(self.volpath, KV_DICT)
+        st = os.stat(self.meta_file)
+        self.assertEqual(write_sig, (st.st_ino, st.st_size, st.st_mtime_ns, 1))
+        write_sig = kvESX.save(self.volpath, KV_DICT, key='status', value='attached')
+        self.assertEqual(write_sig[-1], 2)
+
+    def test_hot_block_write(self):
+        kvESX.save(self.volpath, KV_DICT)
+        content = self.read()
+        kvESX.save(self.volpath, dict(KV_DICT, status='detached'))
+        new_content = self.read()
+        self.assertEqual(len(new_content), len(content))
+        self.assertEqual(new_content[:-kvESX.KV_ALIGN], content[:-kvESX.KV_ALIGN])
+
+    def test_save_without_layout(self):
+        """ Side car written by another process """
+        kvESX.save(self.volpath, KV_DICT)
+        kvESX.kvLayoutCache.clear()
+        self.assertTrue(kvESX.save(self.volpath, dict(KV_DICT, status='detached')))
+        self.assertEqual(kvESX.load(self.volpath)['status'], 'detached')
+        self.assertEqual(kvESX.get_generation(self.meta_file), 2)
+
+    def test_changed_cold_part(self):
+        kvESX.save(self.volpath, KV_DICT)
+        opts = dict(KV_DICT['volOpts'], size='10gb' * 2000)
+        self.assertTrue(kvESX.save(self.volpath, dict(KV_DICT, volOpts=opts)))
+        self.assertEqual(kvESX.load(self.volpath)['volOpts'], opts)
+        self.assertTrue(kvESX.save(self.volpath, KV_DICT))
+        self.assertEqual(kvESX.load(self.volpath), KV_DICT)
+        self.assertEqual(len(self.read()), 2 * kvESX.KV_ALIGN)
+
+    def test_migrate_v1(self):
+        self.write(v1_content(KV_DICT))
+        self.assertEqual(kvESX.load(self.volpath), KV_DICT)
+        self.assertTrue(kvESX.save(self.volpath, dict(KV_DICT, status='detached')))
+        self.assertEqual(kvESX.decode_kv(self.read())[1:], (1, len(self.read()) - kvESX.KV_ALIGN))
+        self.assertEqual(kvESX.load(self.volpath)['status'], 'detached')
+
+    def test_v2_rewritten_by_v1(self):
+        kvESX.save(self.volpath, KV_DICT)
+        kvESX.load(self.volpath)
+        kv_dict = json.loads(self.read())
+        kv_dict['status'] = 'detached'
+        self.write(v1_content(kv_dict))
+        self.assertEqual(kvESX.load(self.volpath)['status'], 'detached')
+        self.assertTrue(kvESX.save(self.volpath, dict(KV_DICT, status='attached')))
+        self.assertEqual(kvESX.load(self.volpath), KV_DICT)
+
+    def test_compare_and_set(self):
+        kvESX.save(self.volpath, KV_DICT)
+        self.assertFalse(kvESX.save(self.volpath, dict(KV_DICT, status='detached'),
+                                    key='status', value='detached'))
+        self.assertTrue(kvESX.save(self.volpath, dict(KV_DICT, status='detached'),
+                                   key='status', value='attached'))
+        self.assertEqual(kvESX.load(self.volpath)['status'], 'detached')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per command, per phase latency histograms for vmdkops service requests.
+
+Request threads mark the command they execute with start_request()/end_request()
+and time the interesting phases with 'with phase(name):'. The service dumps
+a snapshot of the histograms (and lock stats) to PERF_STATS_FILE on request
+(SIGUSR1), and the admin CLI shows it with 'status --perf' or 'status --locks'.
+"""
+
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+from contextlib import contextmanager
+
+# Snapshot file written by the service and read by admin CLI
+PERF_STATS_FILE = "/var/run/vmdkops/perf_stats.json"
+
+# Phases. PHASE_TOTAL covers the whole request.
+PHASE_TOTAL = "total"
+PHASE_GET_TENANT = "get_tenant"
+PHASE_AUTHORIZE = "authorize"
+PHASE_VOL_PATH = "get_vol_path"
+PHASE_LOCK_WAIT = "lock_wait"
+PHASE_VM_LOCK_WAIT = "vm_lock_wait"
+PHASE_HOSTD_TASK = "hostd_task"
+PHASE_KV_LOAD = "kv_load"
+PHASE_KV_SAVE = "kv_save"
+
+# Command name used for phases timed outside of a request (e.g. VM listener)
+NO_COMMAND = "background"
+
+# Histogram bucket upper bounds in ms, growing by sqrt(2): ~0.7ms ... ~12 min
+BUCKET_BOUNDS_MS = [2 ** (i / 2.0) for i in range(-1, 40)]
+
+# Percentiles reported in snapshots
+PERCENTILES = [50, 95, 99]
+
+
+class Histogram(object):
+    """
+    Latency histogram with fixed logarithmic buckets.
+    Percentiles are approximated by the upper bound of the bucket they fall in.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, ms):
+        idx = 0
+        while idx < len(BUCKET_BOUNDS_MS) and ms > BUCKET_BOUNDS_MS[idx]:
+            idx += 1
+        self.counts[idx] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, pct):
+        """ Return approximate pct-th percentile in ms, or None if empty """
+        if not self.count:
+            return None
+        rank = self.count * pct / 100.0
+        seen = 0
+        for idx, cnt in enumerate(self.counts):
+            seen += cnt
+            if seen >= rank and cnt:
+                if idx < len(BUCKET_BOUNDS_MS):
+                    return min(BUCKET_BOUNDS_MS[idx], self.max_ms)
+                return self.max_ms
+        return self.max_ms
+
+
+class PerfStats(object):
+    """
+    Thread safe collection of histograms keyed by (command, phase)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._started = time.time()
+
+    def record(self, cmd, phase_name, ms):
+        with self._lock:
+            key = (cmd, phase_name)
+            hist = self._histograms.get(key)
+            if not hist:
+                hist = self._histograms[key] = Histogram()
+            hist.record(ms)
+
+    def snapshot(self):
+        """ Return a list of dicts with count, avg, max and percentiles per (command, phase) """
+        result = []
+        with self._lock:
+            for (cmd, phase_name), hist in sorted(self._histograms.items()):
+                entry = {"cmd": cmd,
+                         "phase": phase_name,
+                         "count": hist.count,
+                         "avg_ms": hist.total_ms / hist.count,
+                         "max_ms": hist.max_ms}
+                for pct in PERCENTILES:
+                    entry["p{0}_ms".format(pct)] = hist.percentile(pct)
+                result.append(entry)
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._started = time.time()
+
+    @property
+    def started(self):
+        return self._started
+
+
+_stats = PerfStats()
+_local = threading.local()
+
+
+def start_request(cmd):
+    """ Mark the current thread as executing cmd """
+    _local.cmd = cmd
+    _local.start = time.time()
+
+
+def end_request():
+    """ Record total time for the command started by start_request() """
+    cmd = getattr(_local, "cmd", None)
+    if cmd:
+        _stats.record(cmd, PHASE_TOTAL, (time.time() - _local.start) * 1000)
+    _local.cmd = None
+
+
+def current_command():
+    return getattr(_local, "cmd", None) or NO_COMMAND
+
+
+def record(phase_name, ms):
+    """ Record ms spent in phase_name for the current command """
+    _stats.record(current_command(), phase_name, ms)
+
+
+@contextmanager
+def phase(phase_name):
+    """ Time the enclosed block as phase_name of the current command """
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(phase_name, (time.time() - start) * 1000)
+
+
+@contextmanager
+def timed_lock(lock, phase_name=PHASE_LOCK_WAIT):
+    """ Hold lock for the enclosed block, recording the time spent acquiring it """
+    with phase(phase_name):
+        lock.acquire()
+    try:
+        yield lock
+    finally:
+        lock.release()
+
+
+def snapshot():
+    return _stats.snapshot()
+
+
+def reset():
+    _stats.reset()
+
+
+def dump(path=PERF_STATS_FILE, lock_stats=None):
+    """ Write current stats (and lock_stats list, if passed) to path as json """
+    data = {"time": time.time(),
+            "since": _stats.started,
+            "stats": _stats.snapshot(),
+            "locks": lock_stats or []}
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
+    logging.info("Performance stats saved to %s", path)
+
+
+def load(path=PERF_STATS_FILE):
+    """ Return stats dumped by the service, or None if there are none """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
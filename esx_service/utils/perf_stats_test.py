@@ -0,0 +1,61 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests for perf_stats.py
+
+import unittest
+
+import perf_stats
+
+
+class TestHistogram(unittest.TestCase):
+    """ Test percentile approximation """
+
+    def test_empty(self):
+        self.assertEqual(perf_stats.Histogram().percentile(50), None)
+
+    def test_percentiles(self):
+        hist = perf_stats.Histogram()
+        for _ in range(90):
+            hist.record(1.0)
+        for _ in range(10):
+            hist.record(1000.0)
+        self.assertEqual(hist.count, 100)
+        self.assertEqual(hist.percentile(50), 1.0)
+        # p95 and p99 fall in the bucket of the slow requests, capped by max
+        self.assertEqual(hist.percentile(95), 1000.0)
+        self.assertEqual(hist.percentile(99), 1000.0)
+
+
+class TestPerfStats(unittest.TestCase):
+    """ Test per command and phase accounting """
+
+    def setUp(self):
+        perf_stats.reset()
+
+    def test_phases(self):
+        perf_stats.start_request("get")
+        with perf_stats.phase(perf_stats.PHASE_AUTHORIZE):
+            pass
+        perf_stats.end_request()
+        with perf_stats.phase(perf_stats.PHASE_KV_SAVE):
+            pass
+        keys = [(s["cmd"], s["phase"]) for s in perf_stats.snapshot()]
+        self.assertEqual(keys, [(perf_stats.NO_COMMAND, perf_stats.PHASE_KV_SAVE),
+                                ("get", perf_stats.PHASE_AUTHORIZE),
+                                ("get", perf_stats.PHASE_TOTAL)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,15 +19,50 @@ Written by Bruno Moura <brunotm@gmail.com>
 
 import threading
 import logging
+import time
+import weakref
+from collections import deque
 from weakref import WeakValueDictionary
 
 class LockManager(object):
     """
-    Thread safe lock manager class
+    Thread safe lock manager class.
+    With instrumented=True locks account wait and hold time per lock name,
+    see get_lock_stats(). Stats of locks which are gone are added up per
+    lock name prefix (up to the first '.'), so per volume or per VM lock
+    names don't make the stats grow without bound.
     """
-    def __init__(self):
+    def __init__(self, instrumented=False):
         self._lock = get_lock()
         self._lock_store = WeakValueDictionary()
+        self._instrumented = instrumented
+        # lockname -> LockStats of existing locks
+        self._stats = {}
+        # lock name prefix -> LockStats added up from locks which are gone
+        self._retired_stats = {}
+        # LockStats of locks which are gone, appended by finalizers
+        self._retired = deque()
+
+    def _new_stats(self, lockname):
+        """ Return new LockStats for a new lock. Called under self._lock """
+        self._fold_retired_stats()
+        stats = self._stats[lockname] = LockStats(lockname)
+        return stats
+
+    def _retire_stats(self, lock, stats):
+        """ Have stats added up per name prefix once lock is gone """
+        weakref.finalize(lock, self._retired.append, stats)
+
+    def _fold_retired_stats(self):
+        """ Add up stats of locks which are gone per name prefix. Called under self._lock """
+        while self._retired:
+            stats = self._retired.popleft()
+            if self._stats.get(stats.name) is stats:
+                del self._stats[stats.name]
+            group = lock_stats_group(stats.name)
+            if group not in self._retired_stats:
+                self._retired_stats[group] = LockStats(group)
+            self._retired_stats[group].add(stats)
 
     def get_lock(self, lockname, reentrant=False):
         """
@@ -40,6 +75,10 @@ class LockManager(object):
                 #               lockname, lock)
             except KeyError:
                 lock = get_lock(reentrant)
+                if self._instrumented:
+                    stats = self._new_stats(lockname)
+                    lock = InstrumentedLock(lock, stats)
+                    self._retire_stats(lock, stats)
                 self._lock_store[lockname] = lock
                 # logging.debug("LockManager.get_lock: new lock: %s, %s",
                 #               lockname, lock)
@@ -47,6 +86,23 @@ class LockManager(object):
             #               self._list_locks())
             return lock
 
+    def get_rwlock(self, lockname):
+        """
+        Create or return a existing reader/writer lock identified by lockname.
+        """
+        with self._lock:
+            try:
+                lock = self._lock_store[lockname]
+            except KeyError:
+                lock = RWLock()
+                if self._instrumented:
+                    stats = self._new_stats(lockname)
+                    lock.shared = InstrumentedLock(lock.shared, stats)
+                    lock.exclusive = InstrumentedLock(lock.exclusive, stats)
+                    self._retire_stats(lock, stats)
+                self._lock_store[lockname] = lock
+            return lock
+
     def _list_locks(self):
         return self._lock_store.keys()
 
@@ -57,13 +113,311 @@ class LockManager(object):
         with self._lock:
             return self._list_locks()
 
+    def get_lock_stats(self, top=None):
+        """
+        Return stats (as dicts) for the most contended locks, ordered by
+        total wait time. Returns stats for all locks if top is None.
+        """
+        with self._lock:
+            self._fold_retired_stats()
+            all_stats = list(self._stats.values()) + list(self._retired_stats.values())
+        stats = [s.as_dict() for s in all_stats]
+        stats.sort(key=lambda s: (s["wait_total_ms"], s["contended"]), reverse=True)
+        return stats[:top] if top else stats
+
+    def reset_lock_stats(self):
+        """ Drop all collected lock stats """
+        with self._lock:
+            self._retired.clear()
+            self._retired_stats = {}
+            for stats in self._stats.values():
+                with stats._lock:
+                    stats.reset()
+
+
+def lock_stats_group(lockname):
+    """ Name prefix stats of lockname are added up under once the lock is gone """
+    if "." not in lockname:
+        return lockname
+    return lockname.split(".", 1)[0] + ".*"
+
+
+class LockStats(object):
+    """
+    Wait and hold time accounting for one lock name.
+    Updated under its own lock, so locks with different names don't contend
+    for stats.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._lock = get_lock()
+        self.reset()
+
+    def reset(self):
+        self.acquired = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+        # names of threads currently holding the lock
+        self.holders = []
+
+    def add(self, other):
+        """ Add up stats of other, a lock which is gone """
+        with self._lock:
+            self.acquired += other.acquired
+            self.contended += other.contended
+            self.wait_total += other.wait_total
+            self.wait_max = max(self.wait_max, other.wait_max)
+            self.hold_total += other.hold_total
+            self.hold_max = max(self.hold_max, other.hold_max)
+
+    def as_dict(self):
+        with self._lock:
+            return {"name": self.name,
+                    "acquired": self.acquired,
+                    "contended": self.contended,
+                    "wait_total_ms": self.wait_total * 1000,
+                    "wait_max_ms": self.wait_max * 1000,
+                    "hold_total_ms": self.hold_total * 1000,
+                    "hold_max_ms": self.hold_max * 1000,
+                    "holders": list(self.holders)}
+
+
+class InstrumentedLock(object):
+    """
+    Wraps a lock (anything with acquire(blocking)/release()) and accounts
+    wait time, hold time, contention and current holders in a LockStats.
+    """
+    def __init__(self, lock, stats):
+        self._lock = lock
+        self._stats = stats
+        # thread ident -> (acquire time, thread name) list, to support reentrant locks
+        self._held_since = {}
+
+    def acquire(self, blocking=True):
+        start = time.time()
+        contended = not self._lock.acquire(False)
+        if contended and blocking:
+            self._lock.acquire()
+        acquired = blocking or not contended
+        now = time.time()
+        stats = self._stats
+        with stats._lock:
+            if contended:
+                stats.contended += 1
+                stats.wait_total += now - start
+                stats.wait_max = max(stats.wait_max, now - start)
+            if acquired:
+                name = get_thread_name()
+                stats.acquired += 1
+                stats.holders.append(name)
+                self._held_since.setdefault(threading.current_thread().ident, []).append((now, name))
+        return acquired
+
+    def release(self):
+        now = time.time()
+        stats = self._stats
+        with stats._lock:
+            ident = threading.current_thread().ident
+            held_since = self._held_since.get(ident)
+            if held_since:
+                start, name = held_since.pop()
+                if not held_since:
+                    del self._held_since[ident]
+                stats.hold_total += now - start
+                stats.hold_max = max(stats.hold_max, now - start)
+                if name in stats.holders:
+                    stats.holders.remove(name)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class RWLockMode(object):
+    """
+    One mode (shared or exclusive) of a RWLock, usable as a regular lock
+    """
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
 
-def get_lock_decorator(reentrant=False):
+class RWLock(object):
     """
-    Create a locking decorator to be used in modules
+    Reader/writer lock. Any number of threads may hold it shared, or one thread
+    exclusive. Writers are preferred: once a writer is waiting new readers wait
+    too, so readers cannot starve writers.
+    Used as a regular lock (acquire/release, 'with') it is taken exclusive.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(get_lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+        self.shared = RWLockMode(self.acquire_shared, self.release_shared)
+        self.exclusive = RWLockMode(self.acquire, self.release)
+
+    def acquire_shared(self, blocking=True):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                if not blocking:
+                    return False
+                self._cond.wait()
+            self._readers += 1
+            return True
+
+    def release_shared(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire(self, blocking=True):
+        with self._cond:
+            if not blocking and (self._writer or self._readers):
+                return False
+            self._writers_waiting += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = True
+            return True
+
+    def release(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class FairWorkerPool(object):
+    """
+    Fixed size pool of worker threads fed from a bounded queue.
+    Work items are queued per key (e.g. requesting VM) and keys are served
+    round-robin, so a single busy key cannot starve the others.
+    """
+    def __init__(self, name, num_workers, max_queued, max_queued_per_key=None):
+        self._name = name
+        self._num_workers = num_workers
+        self._max_queued = max_queued
+        self._max_queued_per_key = max_queued_per_key or max_queued
+        self._cond = threading.Condition(get_lock())
+        # key -> deque of pending (target, args)
+        self._queues = {}
+        # keys with pending work, in service order
+        self._ready = deque()
+        self._queued = 0
+        self._started = False
+
+    def start(self):
+        """
+        Start the worker threads. Safe to call more than once.
+        """
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self._num_workers):
+            worker = threading.Thread(target=self._worker,
+                                      name="{0}-{1}".format(self._name, i))
+            worker.daemon = True
+            worker.start()
+        logging.info("Started worker pool %s: workers=%d max_queued=%d max_queued_per_key=%d",
+                     self._name, self._num_workers, self._max_queued,
+                     self._max_queued_per_key)
+
+    def submit(self, key, target, args=()):
+        """
+        Queue target(*args) for execution on behalf of key.
+        Returns False (and does not queue) if the pool or the key queue is full.
+        """
+        with self._cond:
+            queue = self._queues.get(key)
+            if self._queued >= self._max_queued or \
+               (queue and len(queue) >= self._max_queued_per_key):
+                logging.warning("Worker pool %s is full: queued=%d, queued for %s=%d",
+                                self._name, self._queued, key,
+                                len(queue) if queue else 0)
+                return False
+            if queue is None:
+                queue = self._queues[key] = deque()
+                self._ready.append(key)
+            queue.append((target, args))
+            self._queued += 1
+            self._cond.notify()
+            return True
+
+    @property
+    def queued(self):
+        """
+        Return the number of work items waiting for a worker
+        """
+        return self._queued
+
+    def _next_item(self):
+        """
+        Block until work is available and return the next (target, args),
+        taking one item from each key in turn.
+        """
+        with self._cond:
+            while not self._ready:
+                self._cond.wait()
+            key = self._ready.popleft()
+            queue = self._queues[key]
+            item = queue.popleft()
+            self._queued -= 1
+            if queue:
+                # more work for this key, put it behind the other keys
+                self._ready.append(key)
+            else:
+                del self._queues[key]
+            return item
+
+    def _worker(self):
+        """
+        Worker thread loop
+        """
+        worker_name = get_thread_name()
+        while True:
+            target, args = self._next_item()
+            try:
+                target(*args)
+            except Exception:
+                logging.exception("Unhandled exception in worker %s:", get_thread_name())
+            # targets may rename the thread, restore it for the next item
+            set_thread_name(worker_name)
+
+
+def get_lock_decorator(reentrant=False, lock=None):
+    """
+    Create a locking decorator to be used in modules.
+    Uses lock if passed, so that the same lock can also be taken directly.
     """
     # Lock to be used in the decorator
-    lock = get_lock(reentrant)
+    if lock is None:
+        lock = get_lock(reentrant)
     def lock_decorator(func):
         """
         Locking decorator
@@ -84,6 +438,27 @@ def get_lock_decorator(reentrant=False):
     return lock_decorator
 
 
+def get_key_lock_decorator(lock_manager, reentrant=False):
+    """
+    Create a locking decorator serializing calls per value of the first
+    argument of the decorated function (e.g. a volume path), using locks
+    from lock_manager
+    """
+    def lock_decorator(func):
+        """
+        Locking decorator
+        """
+        def protected(lock_key, *args, **kwargs):
+            """
+            Locking wrapper. The key parameter is not named 'key', so that
+            the decorated function may take a 'key' keyword argument.
+            """
+            with lock_manager.get_lock(lock_key, reentrant):
+                return func(lock_key, *args, **kwargs)
+        return protected
+    return lock_decorator
+
+
 def start_new_thread(target, args=None, daemon=False):
     """Start a new thread"""
 
@@ -0,0 +1,217 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests for threadutils.py
+
+import gc
+import threading
+import time
+import unittest
+
+import threadutils
+
+# Max time (seconds) to wait for worker threads in tests
+WAIT_TIMEOUT = 5
+
+
+class TestFairWorkerPool(unittest.TestCase):
+    """ Test the worker pool queueing and fairness logic """
+
+    def setUp(self):
+        self.done = []
+        self.gate = threading.Event()
+        self.all_done = threading.Event()
+        self.expected = 0
+        self.lock = threading.Lock()
+
+    def blocked_item(self, key):
+        """ Work item that waits for the gate before completing """
+        self.gate.wait(WAIT_TIMEOUT)
+        with self.lock:
+            self.done.append(key)
+            if len(self.done) == self.expected:
+                self.all_done.set()
+
+    def test_queue_limits(self):
+        """ Requests beyond the total or per key queue size are declined """
+        pool = threadutils.FairWorkerPool("TestPool", num_workers=1,
+                                          max_queued=3, max_queued_per_key=2)
+        # nothing is consumed until the pool is started
+        self.assertTrue(pool.submit("vm1", self.blocked_item, ("vm1",)))
+        self.assertTrue(pool.submit("vm1", self.blocked_item, ("vm1",)))
+        self.assertFalse(pool.submit("vm1", self.blocked_item, ("vm1",)))
+        self.assertTrue(pool.submit("vm2", self.blocked_item, ("vm2",)))
+        self.assertFalse(pool.submit("vm3", self.blocked_item, ("vm3",)))
+        self.assertEqual(pool.queued, 3)
+
+    def test_round_robin(self):
+        """ Keys are served in turn rather than in arrival order """
+        pool = threadutils.FairWorkerPool("TestPool", num_workers=1, max_queued=10)
+        keys = ["vm1", "vm1", "vm1", "vm2", "vm3"]
+        self.expected = len(keys)
+        for key in keys:
+            self.assertTrue(pool.submit(key, self.blocked_item, (key,)))
+        self.gate.set()
+        pool.start()
+        self.assertTrue(self.all_done.wait(WAIT_TIMEOUT))
+        self.assertEqual(self.done, ["vm1", "vm2", "vm3", "vm1", "vm1"])
+        self.assertEqual(pool.queued, 0)
+
+
+class TestRWLock(unittest.TestCase):
+    """ Test shared/exclusive locking """
+
+    def test_shared(self):
+        """ Readers do not block each other """
+        lock = threadutils.RWLock()
+        lock.acquire_shared()
+        acquired = threading.Event()
+
+        def reader():
+            with lock.shared:
+                acquired.set()
+
+        threading.Thread(target=reader).start()
+        self.assertTrue(acquired.wait(WAIT_TIMEOUT))
+        lock.release_shared()
+
+    def test_writer_preference(self):
+        """ A waiting writer blocks new readers and gets the lock first """
+        lock = threadutils.RWLock()
+        order = []
+        lock.acquire_shared()
+
+        def writer():
+            with lock.exclusive:
+                order.append("writer")
+
+        def reader():
+            with lock.shared:
+                order.append("reader")
+
+        writer_thread = threading.Thread(target=writer)
+        writer_thread.start()
+        # wait for the writer to queue up behind the current reader
+        while not lock._writers_waiting:
+            time.sleep(0.001)
+        reader_thread = threading.Thread(target=reader)
+        reader_thread.start()
+        time.sleep(0.05)
+        self.assertEqual(order, [])
+        lock.release_shared()
+        writer_thread.join(WAIT_TIMEOUT)
+        reader_thread.join(WAIT_TIMEOUT)
+        self.assertEqual(order, ["writer", "reader"])
+
+    def test_lock_manager(self):
+        """ LockManager returns the same RWLock for the same name """
+        manager = threadutils.LockManager()
+        lock = manager.get_rwlock("ds.tenant.vol")
+        self.assertIs(lock, manager.get_rwlock("ds.tenant.vol"))
+        self.assertIsNot(lock, manager.get_rwlock("ds.tenant.vol2"))
+
+
+class TestLockStats(unittest.TestCase):
+    """ Test lock contention accounting """
+
+    def test_contention(self):
+        manager = threadutils.LockManager(instrumented=True)
+        lock = manager.get_lock("vm1")
+        lock.acquire()
+        self.assertEqual(manager.get_lock_stats()[0]["holders"], [threadutils.get_thread_name()])
+
+        def waiter():
+            with manager.get_lock("vm1"):
+                pass
+
+        waiter_thread = threading.Thread(target=waiter)
+        waiter_thread.start()
+        time.sleep(0.05)
+        lock.release()
+        waiter_thread.join(WAIT_TIMEOUT)
+
+        with manager.get_rwlock("ds.tenant.vol").shared:
+            pass
+
+        stats = manager.get_lock_stats(top=1)
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]["name"], "vm1")
+        self.assertEqual(stats[0]["acquired"], 2)
+        self.assertEqual(stats[0]["contended"], 1)
+        self.assertEqual(stats[0]["holders"], [])
+        self.assertTrue(stats[0]["wait_total_ms"] > 0)
+        self.assertEqual(len(manager.get_lock_stats()), 2)
+
+
+    def test_gone_locks(self):
+        """ Stats of locks which are gone are added up per name prefix """
+        manager = threadutils.LockManager(instrumented=True)
+        for vol in ("vol1", "vol2", "vol3"):
+            with manager.get_rwlock("ds1.tenant." + vol).exclusive:
+                pass
+        with manager.get_lock("reconfig.vm-1"):
+            pass
+        gc.collect()
+        stats = dict((s["name"], s) for s in manager.get_lock_stats())
+        self.assertEqual(sorted(stats), ["ds1.*", "reconfig.*"])
+        self.assertEqual(stats["ds1.*"]["acquired"], 3)
+        self.assertEqual(stats["reconfig.*"]["acquired"], 1)
+
+        # existing locks keep their own stats
+        lock = manager.get_lock("reconfig.vm-2")
+        with lock:
+            pass
+        stats = dict((s["name"], s) for s in manager.get_lock_stats())
+        self.assertEqual(stats["reconfig.vm-2"]["acquired"], 1)
+        self.assertEqual(stats["reconfig.*"]["acquired"], 1)
+
+        manager.reset_lock_stats()
+        self.assertEqual([s["acquired"] for s in manager.get_lock_stats()], [0])
+
+
+class TestKeyLockDecorator(unittest.TestCase):
+    """ Test per key locking decorator """
+
+    def test_per_key(self):
+        """ Calls for the same key are serialized, calls for other keys are not """
+        locked = threadutils.get_key_lock_decorator(threadutils.LockManager(), reentrant=True)
+        gate = threading.Event()
+        entered = threading.Event()
+
+        @locked
+        def blocked(key):
+            entered.set()
+            gate.wait(WAIT_TIMEOUT)
+
+        @locked
+        def nested(key):
+            # reentrant for the same key
+            return blocked_done(key)
+
+        @locked
+        def blocked_done(key):
+            return key
+
+        thread = threading.Thread(target=blocked, args=("vol1",))
+        thread.start()
+        self.assertTrue(entered.wait(WAIT_TIMEOUT))
+        # another key is not blocked by vol1
+        self.assertEqual(nested("vol2"), "vol2")
+        gate.set()
+        thread.join(WAIT_TIMEOUT)
+        self.assertEqual(nested("vol1"), "vol1")
+
+
+if __name__ == '__main__':
+    unittest.main()
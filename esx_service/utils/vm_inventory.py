@@ -0,0 +1,165 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Host-wide cache of VMs keyed by BIOS and VC uuid.
+
+The cache is filled and kept current from property collector updates by the
+VM change listener (see vm_listener.py), so VM lookups by uuid are dictionary
+reads instead of searchIndex.FindByUuid() calls to hostd.
+It is only used when ready, i.e. after the listener got the initial content.
+Processes not running the listener (e.g. admin CLI) never see it ready.
+"""
+
+import logging
+import threading
+
+# VM properties tracked in the cache
+VM_NAME = 'config.name'
+VM_BIOS_UUID = 'config.uuid'
+VM_VC_UUID = 'config.instanceUuid'
+VM_CONFIG_PATH = 'summary.config.vmPathName'
+VM_CHANGE_VERSION = 'config.changeVersion'
+VM_PROPERTIES = [VM_NAME, VM_BIOS_UUID, VM_VC_UUID, VM_CONFIG_PATH, VM_CHANGE_VERSION]
+
+# Property collector object update kinds
+KIND_ENTER = 'enter'
+KIND_MODIFY = 'modify'
+KIND_LEAVE = 'leave'
+
+
+class VmInfo(object):
+    """
+    Cached VM properties. moref is bound to the session of the VM listener,
+    see vmdk_ops.bind_vm().
+    """
+
+    def __init__(self, moref):
+        self.moref = moref
+        self.name = None
+        self.bios_uuid = None
+        self.vc_uuid = None
+        self.config_path = None
+        # changes with every VM config change, used to invalidate cached VM config
+        self.change_version = None
+
+    def __repr__(self):
+        return "VmInfo(name={0}, bios_uuid={1}, vc_uuid={2}, config_path={3})".format(
+            self.name, self.bios_uuid, self.vc_uuid, self.config_path)
+
+
+def _key(uuid):
+    """ uuids are matched case insensitive, like searchIndex does """
+    return uuid.lower() if uuid else None
+
+
+class VmInventory(object):
+    """
+    Thread safe VM cache. Keyed by moref id, with indexes by BIOS and VC uuid.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._vms = {}
+        self._by_bios_uuid = {}
+        self._by_vc_uuid = {}
+        self._ready = False
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def set_ready(self):
+        """ Called once the initial content of the inventory is loaded """
+        with self._lock:
+            if not self._ready:
+                logging.info("VM inventory loaded: %d VMs", len(self._vms))
+            self._ready = True
+
+    def clear(self):
+        """ Drop all entries, lookups miss until the inventory is loaded again """
+        with self._lock:
+            self._vms = {}
+            self._by_bios_uuid = {}
+            self._by_vc_uuid = {}
+            self._ready = False
+
+    def update(self, object_set):
+        """ Apply a property collector ObjectUpdate for a VM """
+        moref = object_set.obj
+        moid = moref._moId
+        with self._lock:
+            if object_set.kind == KIND_LEAVE:
+                info = self._vms.pop(moid, None)
+                if info:
+                    self._unindex(info)
+                    logging.debug("VM inventory: removed %s", info)
+                return
+
+            info = self._vms.get(moid)
+            if not info:
+                info = self._vms[moid] = VmInfo(moref)
+            self._unindex(info)
+            for change in object_set.changeSet:
+                if change.name == VM_NAME:
+                    info.name = change.val
+                elif change.name == VM_BIOS_UUID:
+                    info.bios_uuid = change.val
+                elif change.name == VM_VC_UUID:
+                    info.vc_uuid = change.val
+                elif change.name == VM_CONFIG_PATH:
+                    info.config_path = change.val
+                elif change.name == VM_CHANGE_VERSION:
+                    info.change_version = change.val
+            self._index(info)
+
+    def _index(self, info):
+        """ Called under self._lock """
+        if info.bios_uuid:
+            self._by_bios_uuid[_key(info.bios_uuid)] = info
+        if info.vc_uuid:
+            self._by_vc_uuid[_key(info.vc_uuid)] = info
+
+    def _unindex(self, info):
+        """ Called under self._lock """
+        if self._by_bios_uuid.get(_key(info.bios_uuid)) is info:
+            del self._by_bios_uuid[_key(info.bios_uuid)]
+        if self._by_vc_uuid.get(_key(info.vc_uuid)) is info:
+            del self._by_vc_uuid[_key(info.vc_uuid)]
+
+    def lookup(self, uuid, is_vc_uuid=False):
+        """
+        Return VmInfo for the VM with the given VC (or BIOS) uuid.
+        Returns None if not found, or if the inventory is not ready.
+        """
+        if not self._ready or not uuid:
+            return None
+        with self._lock:
+            index = self._by_vc_uuid if is_vc_uuid else self._by_bios_uuid
+            return index.get(_key(uuid))
+
+    def get(self, moid):
+        """ Return VmInfo for VM moref id, or None if not found or not ready """
+        if not self._ready:
+            return None
+        with self._lock:
+            return self._vms.get(moid)
+
+    def lookup_any(self, uuid):
+        """ Return VmInfo for uuid taken as VC uuid first, then as BIOS uuid """
+        return self.lookup(uuid, True) or self.lookup(uuid, False)
+
+
+# Inventory of VMs on this host, maintained by VM change listener
+inventory = VmInventory()
@@ -0,0 +1,79 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests for vm_inventory.py
+
+import unittest
+
+import vm_inventory
+
+
+class FakeMoref(object):
+    def __init__(self, moid):
+        self._moId = moid
+
+
+class FakeChange(object):
+    def __init__(self, name, val):
+        self.name = name
+        self.val = val
+
+
+class FakeObjectUpdate(object):
+    """ Mimics vmodl.query.PropertyCollector.ObjectUpdate """
+    def __init__(self, kind, moref, changes=None):
+        self.kind = kind
+        self.obj = moref
+        self.changeSet = [FakeChange(name, val) for name, val in (changes or {}).items()]
+
+
+class TestVmInventory(unittest.TestCase):
+    """ Test inventory updates and lookups """
+
+    def setUp(self):
+        self.inventory = vm_inventory.VmInventory()
+        self.vm1 = FakeMoref("1")
+        self.inventory.update(FakeObjectUpdate(vm_inventory.KIND_ENTER, self.vm1,
+                                               {vm_inventory.VM_NAME: "vm1",
+                                                vm_inventory.VM_BIOS_UUID: "564D-BIOS",
+                                                vm_inventory.VM_VC_UUID: "5000-VC",
+                                                vm_inventory.VM_CHANGE_VERSION: "v1"}))
+
+    def test_not_ready(self):
+        """ Lookups miss until the initial content is loaded """
+        self.assertIsNone(self.inventory.lookup("564d-bios"))
+        self.inventory.set_ready()
+        self.assertIs(self.inventory.lookup("564d-bios").moref, self.vm1)
+        self.assertIs(self.inventory.lookup("5000-vc", is_vc_uuid=True).moref, self.vm1)
+        self.assertIsNone(self.inventory.lookup("5000-vc"))
+        self.assertEqual(self.inventory.get("1").change_version, "v1")
+        self.inventory.clear()
+        self.assertIsNone(self.inventory.lookup("564d-bios"))
+
+    def test_rename_and_remove(self):
+        self.inventory.set_ready()
+        self.inventory.update(FakeObjectUpdate(vm_inventory.KIND_MODIFY, self.vm1,
+                                               {vm_inventory.VM_NAME: "vm1-renamed",
+                                                vm_inventory.VM_VC_UUID: "5000-VC2"}))
+        self.assertEqual(self.inventory.lookup_any("5000-vc2").name, "vm1-renamed")
+        self.assertIsNone(self.inventory.lookup_any("5000-vc"))
+        self.assertEqual(self.inventory.lookup_any("564d-bios").name, "vm1-renamed")
+
+        self.inventory.update(FakeObjectUpdate(vm_inventory.KIND_LEAVE, self.vm1))
+        self.assertIsNone(self.inventory.lookup_any("564d-bios"))
+        self.assertIsNone(self.inventory.lookup_any("5000-vc2"))
+
+
+if __name__ == '__main__':
+    unittest.main()
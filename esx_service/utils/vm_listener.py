@@ -16,7 +16,9 @@
 '''
 VM change listener (started as a part of vmdkops service).
 It monitors VM poweroff events and detaches the DVS managed
-volumes from the VM and updates the status in KV
+volumes from the VM and updates the status in KV.
+It also keeps the VM inventory cache (vm_inventory.py) and the datastore
+cache (vmdk_utils.DatastoreCache) current.
 '''
 
 import logging
@@ -31,6 +33,7 @@ import log_config
 import vmdk_utils
 import vmdk_ops
 import volume_kv
+import vm_inventory
 
 from pyVmomi import VmomiSupport, vim, vmodl
 # vim api version used - version11
@@ -106,8 +109,9 @@ def start_vm_changelistener():
     ex = listen_vm_propertychange(pc)
     # hostd is down
 
-    if isinstance(ex, RemoteDisconnected):
+    if isinstance(ex, RemoteDisconnected) or vmdk_ops.is_connection_error(ex):
         logging.error("VMChangeListener: Hostd connection error %s", str(ex))
+        vmdk_ops.mark_si_stale()
         # Need to get new SI instance, create a new property collector and property filter
         # for it. Can't use the old one due to stale authentication error.
         start_vm_changelistener()
@@ -130,7 +134,11 @@ def create_vm_powerstate_filter(pc, from_node):
     # Add the property specs
     propSpec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, all=False)
     propSpec.pathSet.append(VM_POWERSTATE)
+    propSpec.pathSet.extend(vm_inventory.VM_PROPERTIES)
     filterSpec.propSet.append(propSpec)
+    dsPropSpec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Datastore, all=False)
+    dsPropSpec.pathSet.extend(vmdk_utils.DS_PROPERTIES)
+    filterSpec.propSet.append(dsPropSpec)
     try:
         pcFilter = pc.CreateFilter(filterSpec, True)
         atexit.register(pcFilter.Destroy)
@@ -145,8 +153,20 @@ def listen_vm_propertychange(pc):
     """
     Waits for updates on powerstate of VMs. If powerstate is poweroff,
     detach the dvs managed volumes attached to VM.
+    VM add/remove/rename updates are applied to the VM inventory cache,
+    datastore add/remove/rename updates to the datastore cache.
     """
     logging.info("VMChangeListener thread started")
+    try:
+        return _listen_vm_propertychange(pc)
+    finally:
+        # Caches can't be trusted until they are loaded again on a new listener
+        vm_inventory.inventory.clear()
+        vmdk_utils.datastoreCache.clear_live()
+
+
+def _listen_vm_propertychange(pc):
+    """ Update loop of listen_vm_propertychange() """
     version = ''
     while True:
         try:
@@ -154,6 +174,14 @@ def listen_vm_propertychange(pc):
             # process the updates result
             for filterSet in result.filterSet:
                 for objectSet in filterSet.objectSet:
+                    if isinstance(objectSet.obj, vim.Datastore):
+                        vmdk_utils.datastoreCache.update(objectSet)
+                        continue
+                    if isinstance(objectSet.obj, vim.VirtualMachine):
+                        vm_inventory.inventory.update(objectSet)
+                        if objectSet.kind == vm_inventory.KIND_LEAVE:
+                            # VM unregistered
+                            vmdk_ops.vmTopologies.forget(objectSet.obj)
                     if objectSet.kind != 'modify':
                         continue
                     for change in objectSet.changeSet:
@@ -172,6 +200,9 @@ def listen_vm_propertychange(pc):
 
                         set_device_detached(moref)
             version = result.version
+            # The first update has the initial content for all VMs and datastores
+            vm_inventory.inventory.set_ready()
+            vmdk_utils.datastoreCache.set_live()
         # Capture hostd down exception
         except RemoteDisconnected as e:
             return e
@@ -184,13 +215,17 @@ def listen_vm_propertychange(pc):
             # Log this info if required by admin just in case
             logging.info("VMChangeListener: VM was powered down and then deleted right away. Fault msg: %s", e.msg)
         except Exception as e:
+            if vmdk_ops.is_connection_error(e):
+                # reconnect, see start_vm_changelistener()
+                return e
             # Do we need to alert the admin? how?
             logging.error("VMChangeListener: error %s", str(e))
 
 
 def vm_folder_traversal():
     """
-    Build the traversal spec for the property collector to traverse vmFolder
+    Build the traversal spec for the property collector to traverse vmFolder,
+    and the datastores of each datacenter
     """
 
     TraversalSpec = vmodl.query.PropertyCollector.TraversalSpec
@@ -200,11 +235,15 @@ def vm_folder_traversal():
     dcToVmf = TraversalSpec(name='dcToVmf', type=vim.Datacenter, path='vmFolder', skip=False)
     dcToVmf.selectSet.append(SelectionSpec(name='visitFolders'))
 
+    # Datastores of the datacenter
+    dcToDs = TraversalSpec(name='dcToDs', type=vim.Datacenter, path='datastore', skip=False)
+
     # Recurse through the folders
     visitFolders = TraversalSpec(name='visitFolders', type=vim.Folder, path='childEntity', skip=False)
-    visitFolders.selectSet.extend((SelectionSpec(name='visitFolders'), SelectionSpec(name='dcToVmf'),))
+    visitFolders.selectSet.extend((SelectionSpec(name='visitFolders'), SelectionSpec(name='dcToVmf'),
+                                   SelectionSpec(name='dcToDs'),))
 
-    return SelectionSpec.Array((visitFolders, dcToVmf,))
+    return SelectionSpec.Array((visitFolders, dcToVmf, dcToDs,))
 
 
 def set_device_detached(vm_moref):
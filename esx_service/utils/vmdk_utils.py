@@ -17,11 +17,13 @@
 
 import os
 import os.path
-import glob
 import re
 import logging
 import fnmatch
 import subprocess
+import random
+import threading
+import time
 
 from pyVim import vmconfig
 from pyVmomi import vim
@@ -35,12 +37,20 @@ import auth_data_const
 import auth
 import auth_api
 import log_config
+from volume_index import volumeIndex, DIR_MTIME_GRANULARITY
 from error_code import *
 
 
-# datastores should not change during 'vmdkops_admin' run,
-# so using global to avoid multiple scans of /vmfs/volumes
-datastores = None
+# Datastore properties tracked by the VM change listener, see DatastoreCache
+DS_NAME = 'summary.name'
+DS_URL = 'summary.url'
+DS_PROPERTIES = [DS_NAME, DS_URL]
+
+# Property collector object update kind for removed objects
+KIND_LEAVE = 'leave'
+
+# Attempts to set the datastore cache live while datastores are added concurrently
+SET_LIVE_RETRIES = 3
 
 # we assume files smaller that that to be descriptor files
 MAX_DESCR_SIZE = 5000
@@ -48,22 +58,33 @@ MAX_DESCR_SIZE = 5000
 # regexp for finding "snapshot" (aka delta disk) descriptor names
 SNAP_NAME_REGEXP = r"^.*-[0-9]{6}$"        # used for names without .vmdk suffix
 SNAP_VMDK_REGEXP = r"^.*-[0-9]{6}\.vmdk$"  # used for file names
+# same, with the volume name as group(1)
+SNAP_VOL_REGEXP = r"^(.*)-[0-9]{6}\.vmdk$"
 
 # regexp for finding 'special' vmdk files (they are created by ESXi)
 SPECIAL_FILES_REGEXP = r"\A.*-(delta|ctk|digest|flat)\.vmdk$"
 
-# glob expression to match end of 'delta' (aka snapshots) file names.
-SNAP_SUFFIX_GLOB = "-[0-9][0-9][0-9][0-9][0-9][0-9].vmdk"
-
 # regexp for finding datastore path "[datastore] path/to/file.vmdk" from full vmdk path
 DATASTORE_PATH_REGEXP = r"^/vmfs/volumes/([^/]+)/(.*\.vmdk)$"
 
 # lsof command
 LSOF_CMD = "/bin/vmkvsitools lsof"
 
-# Number of times and sleep time to retry on IOError EBUSY
-VMDK_RETRY_COUNT = 5
-VMDK_RETRY_SLEEP = 1
+# Number of times to retry on IOError EBUSY, and the backoff between retries:
+# exponential from VMDK_RETRY_SLEEP_MIN up to VMDK_RETRY_SLEEP_MAX seconds, jittered.
+# Total wait is about 5 seconds.
+VMDK_RETRY_COUNT = 12
+VMDK_RETRY_SLEEP_MIN = 0.005
+VMDK_RETRY_SLEEP_MAX = 1
+
+# Minimum interval between lsof logs for the same volume, in seconds
+LSOF_LOG_INTERVAL = 60
+
+# Datastores are scanned for volumes in parallel by this many threads
+DS_SCAN_WORKERS = 8
+DS_SCAN_MAX_QUEUED = 256
+# Seconds to wait for datastore scans before listing without the slow ones
+DS_SCAN_TIMEOUT = 10
 
 # root for all the volumes
 VOLUME_ROOT = "/vmfs/volumes/"
@@ -74,33 +95,182 @@ lockManager = threadutils.LockManager()
 # vmdkops vib name
 VIB_NAME = "esx-vmdkops-service"
 
+class DatastoreCache(object):
+    """
+    Datastores known to this host, as (name, url, dockvols_path) tuples,
+    with indexes by name and url.
+
+    It is loaded by a scan of the datastore folder (see init_datastoreCache).
+    In the service, the VM change listener (vm_listener.py) also subscribes
+    to datastore add/remove/rename, and once it has the initial content the
+    cache is 'live': kept current by those updates and never scanned again.
+    Datastores should not change during 'vmdkops_admin' run, so there the
+    scan result is used as is.
+    """
+
+    def __init__(self):
+        self._lock = threadutils.get_lock()
+        self._datastores = None
+        self._by_name = {}
+        self._by_url = {}
+        # moref id -> {property: value} for datastores reported by the listener
+        self._listened = {}
+        # moref id -> (name, dockvols_path) as last checked for listened datastores
+        self._paths = {}
+        self._live = False
+        # bumped on every content change, so users can validate derived data
+        self._generation = 0
+
+    @property
+    def loaded(self):
+        return self._datastores is not None
+
+    @property
+    def live(self):
+        return self._live
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def load(self, datastores):
+        """ Set the content from a scan, unless the cache is live """
+        with self._lock:
+            if not self._live:
+                self._set(datastores)
+
+    def _set(self, datastores):
+        """ Called under self._lock """
+        if datastores != self._datastores:
+            self._generation += 1
+        self._datastores = datastores
+        self._by_name = dict((ds[0], ds) for ds in datastores)
+        self._by_url = dict((ds[1], ds) for ds in datastores)
+
+    def _refresh(self, set_live=False):
+        """
+        Set the content from the listened datastores, return False if some
+        of them were left out as their dockvols path is not known yet.
+        Dockvols paths are checked without self._lock, and only for datastores
+        added or renamed since they were last checked, so an unresponsive
+        datastore does not hold the listener on every update.
+        """
+        with self._lock:
+            unchecked = [(moid, props.get(DS_NAME)) for moid, props in self._listened.items()
+                         if props.get(DS_NAME) and
+                         self._paths.get(moid, (None, None))[0] != props.get(DS_NAME)]
+        checked = {}
+        for moid, name in unchecked:
+            dockvols_path, err = vmdk_ops.get_vol_path(datastore=name, create=False)
+            if err:
+                logging.error(" datastore %s is being ignored as the dockvol path can't be created on it", name)
+                dockvols_path = None
+            checked[moid] = (name, dockvols_path)
+        with self._lock:
+            for moid, path in checked.items():
+                if moid in self._listened:
+                    self._paths[moid] = path
+            complete = True
+            datastores = []
+            for moid, props in self._listened.items():
+                name = props.get(DS_NAME)
+                if not name:
+                    continue
+                checked_name, dockvols_path = self._paths.get(moid, (None, None))
+                if checked_name != name:
+                    # added or renamed concurrently, the update refreshes again
+                    complete = False
+                    continue
+                if dockvols_path:
+                    datastores.append((name, props.get(DS_URL), dockvols_path))
+            if not self._live and not set_live:
+                return complete
+            self._set(sorted(datastores))
+            if set_live and not self._live:
+                self._live = True
+                logging.info("Datastore cache is live: %d datastores", len(datastores))
+            return complete
+
+    def update(self, object_set):
+        """ Apply a property collector ObjectUpdate for a datastore """
+        moid = object_set.obj._moId
+        with self._lock:
+            if object_set.kind == KIND_LEAVE:
+                props = self._listened.pop(moid, None)
+                self._paths.pop(moid, None)
+                logging.info("Datastore removed: %s", props)
+            else:
+                props = self._listened.setdefault(moid, {})
+                for change in object_set.changeSet:
+                    props[change.name] = change.val
+                if self._live:
+                    logging.info("Datastore added or changed: %s", props)
+            live = self._live
+        if live:
+            self._refresh()
+
+    def set_live(self):
+        """ Called by the listener once it has the initial content """
+        for _ in range(SET_LIVE_RETRIES):
+            if self._refresh(set_live=True):
+                return
+        logging.warning("Datastore cache is live with some datastores left out, "
+                        "they are added on their next update")
+
+    def clear_live(self):
+        """ Called when the listener stops. Content is kept, but may be scanned again """
+        with self._lock:
+            self._live = False
+            self._listened = {}
+            self._paths = {}
+
+    def get_all(self):
+        return self._datastores
+
+    def by_name(self, name):
+        """ Return (name, url, dockvols_path) for datastore name, or None """
+        return self._by_name.get(name)
+
+    def by_url(self, url):
+        """ Return (name, url, dockvols_path) for datastore url, or None """
+        return self._by_url.get(url)
+
+
+datastoreCache = DatastoreCache()
+
+
 def init_datastoreCache(force=False):
     """
     Initializes the datastore cache with the list of datastores accessible
     from local ESX host. force=True will force it to ignore current cache
-    and force init
+    and force init, unless the cache is kept current by the VM listener.
     """
     with lockManager.get_lock("init_datastoreCache"):
-        global datastores
-        logging.debug("init_datastoreCache:  %s", datastores)
-        if datastores and not force:
+        if datastoreCache.loaded and (not force or datastoreCache.live):
             return
+        logging.debug("init_datastoreCache:  %s", datastoreCache.get_all())
 
         si = vmdk_ops.get_si()
 
-        #  We are connected to ESX so childEntity[0] is current DC/Host
-        ds_objects = si.content.rootFolder.childEntity[0].datastoreFolder.childEntity
-        tmp_ds = []
+        try:
+            #  We are connected to ESX so childEntity[0] is current DC/Host
+            ds_objects = si.content.rootFolder.childEntity[0].datastoreFolder.childEntity
+            ds_infos = [datastore.info for datastore in ds_objects]
+        except Exception as ex:
+            if vmdk_ops.is_connection_error(ex):
+                vmdk_ops.mark_si_stale(si)
+            raise
 
-        for datastore in ds_objects:
-            dockvols_path, err = vmdk_ops.get_vol_path(datastore=datastore.info.name, create=False)
+        tmp_ds = []
+        for info in ds_infos:
+            dockvols_path, err = vmdk_ops.get_vol_path(datastore=info.name, create=False)
             if err:
-                logging.error(" datastore %s is being ignored as the dockvol path can't be created on it", datastore.info.name)
+                logging.error(" datastore %s is being ignored as the dockvol path can't be created on it", info.name)
                 continue
-            tmp_ds.append((datastore.info.name,
-                           datastore.info.url,
+            tmp_ds.append((info.name,
+                           info.url,
                            dockvols_path))
-        datastores = tmp_ds
+        datastoreCache.load(tmp_ds)
 
 
 def validate_datastore(datastore):
@@ -110,11 +280,11 @@ def validate_datastore(datastore):
     is a part of the updated cache.
     """
     init_datastoreCache()
-    if datastore in [i[0] for i in datastores]:
+    if datastoreCache.by_name(datastore):
         return True
     else:
         init_datastoreCache(force=True)
-        if datastore in [i[0] for i in datastores]:
+        if datastoreCache.by_name(datastore):
             return True
     return False
 
@@ -128,12 +298,22 @@ def get_datastores():
     'dockvol-path; is a full path to 'dockvols' folder on datastore
     """
     init_datastoreCache()
-    return datastores
+    return datastoreCache.get_all()
 
 
-def get_volumes(tenant_re):
-    """ Return dicts of docker volumes, their datastore and their paths
+def get_volumes(tenant_re, unavailable=None):
+    """ Return dicts of docker volumes, their datastore and their paths.
+    Datastores are scanned in parallel. Datastores not scanned within
+    DS_SCAN_TIMEOUT are left out, and their names added to the unavailable
+    list, if passed.
     """
+    volumes = list(iter_volumes(tenant_re, unavailable))
+    logging.debug("volumes %s", volumes)
+    return volumes
+
+
+def iter_volumes(tenant_re, unavailable=None):
+    """ Generator version of get_volumes(), yields volume dicts one by one """
     # Assume we have two tenants "tenant1" and "tenant2"
     # volumes for "tenant1" are in /vmfs/volumes/datastore1/dockervol/tenant1
     # volumes for "tenant2" are in /vmfs/volumes/datastore1/dockervol/tenant2
@@ -143,40 +323,57 @@ def get_volumes(tenant_re):
     # tenant_re = "tenant*" : return volumes which belong to tenant1 or tenant2
     # tenant_re = "*" : return all volumes under /vmfs/volumes/datastore1/dockervol
     logging.debug("get_volumes: tenant_pattern(%s)", tenant_re)
-    volumes = []
-    for (datastore, url, path) in get_datastores():
-        logging.debug("get_volumes: %s %s %s", datastore, url, path)
+    tenant_names = {}
+    if not tenant_re:
+        # only the dockvols directory itself
+        sub_dirs = ('',)
+    else:
+        # tenant directories are named by tenant uuid
+        error_info, tenant_names = auth_api.get_tenant_names()
+        if error_info:
+            logging.warning("get_volumes: failed to get tenant names: %s", error_info.msg)
+            tenant_names = {}
+        if tenant_re == "*":
+            # all directories, including orphan ones
+            sub_dirs = None
+        else:
+            # only directories of matching tenants
+            sub_dirs = tuple(sorted(tenant_uuid for tenant_uuid, tenant_name in tenant_names.items()
+                                    if fnmatch.fnmatch(tenant_name, tenant_re)))
+            if not sub_dirs:
+                return
+
+    for (datastore, path, dirs) in scan_datastores(get_datastores(), sub_dirs, unavailable):
+        logging.debug("get_volumes: %s %s", datastore, path)
         if not tenant_re:
-            for file_name in list_vmdks(path):
+            for file_name in dirs[0][1]:
                 # path : docker_vol path
-                volumes.append({'path': path,
-                                'filename': file_name,
-                                'datastore': datastore})
+                yield {'path': path,
+                       'filename': file_name,
+                       'datastore': datastore}
         else:
-            for root, dirs, files in os.walk(path):
+            for root, vmdks in dirs:
                 # walkthough all files under docker_vol path
                 # root is the current directory which is traversing
                 #  root = /vmfs/volumes/datastore1/dockervol/tenant1_uuid
                 #  path = /vmfs/volumes/datastore1/dockervol
-                #  sub_dir get the string "/tenant1_uuid"
                 #  sub_dir_name is "tenant1_uuid"
-                #  call get_tenant_name with "tenant1_uuid" to find corresponding
+                #  tenant_names maps "tenant1_uuid" to the corresponding
                 #  tenant_name which will be used to match
                 #  pattern specified by tenant_re
                 logging.debug("get_volumes: path=%s root=%s", path, root)
-                sub_dir = root.replace(path, "")
-                sub_dir_name = sub_dir[1:]
+                sub_dir_name = root[len(path) + 1:]
                 # sub_dir_name is the tenant uuid
-                error_info, tenant_name = auth_api.get_tenant_name(sub_dir_name)
-                if not error_info:
+                tenant_name = tenant_names.get(sub_dir_name)
+                if tenant_name:
                     logging.debug("get_volumes: path=%s root=%s sub_dir_name=%s tenant_name=%s",
                                   path, root, sub_dir_name, tenant_name)
                     if fnmatch.fnmatch(tenant_name, tenant_re):
-                        for file_name in list_vmdks(root):
-                            volumes.append({'path': root,
-                                            'filename': file_name,
-                                            'datastore': datastore,
-                                            'tenant': tenant_name})
+                        for file_name in vmdks:
+                            yield {'path': root,
+                                   'filename': file_name,
+                                   'datastore': datastore,
+                                   'tenant': tenant_name}
                 else:
                     # cannot find this tenant, this tenant was removed
                     # mark those volumes created by "orphan" tenant
@@ -186,13 +383,111 @@ def get_volumes(tenant_re):
 
                     # return orphan volumes only in case when volumes from any tenants are asked
                     if tenant_re == "*":
-                        for file_name in list_vmdks(root):
-                            volumes.append({'path': root,
-                                            'filename': file_name,
-                                            'datastore': datastore,
-                                            'tenant' : auth_data_const.ORPHAN_TENANT})
-    logging.debug("volumes %s", volumes)
-    return volumes
+                        for file_name in vmdks:
+                            yield {'path': root,
+                                   'filename': file_name,
+                                   'datastore': datastore,
+                                   'tenant' : auth_data_const.ORPHAN_TENANT}
+
+
+class DatastoreScan(object):
+    """
+    Listing of the volume directories of a datastore, run on dsScanPool.
+    Concurrent callers asking for the same listing share one scan.
+    """
+
+    def __init__(self, path, sub_dirs):
+        self.path = path
+        self.sub_dirs = sub_dirs
+        self.done = threading.Event()
+        # list of (directory, volume vmdks), None if the scan failed
+        self.result = None
+
+    def run(self):
+        try:
+            if self.sub_dirs is None:
+                self.result = list(walk_volume_dirs(self.path))
+            else:
+                dirs = [os.path.join(self.path, name) if name else self.path
+                        for name in self.sub_dirs]
+                self.result = [(root, list_volume_dir(root)[1]) for root in dirs]
+        except Exception as ex:
+            logging.warning("Failed to scan %s for volumes: %s", self.path, ex)
+        finally:
+            with dsScansLock:
+                if dsScans.get((self.path, self.sub_dirs)) is self:
+                    del dsScans[(self.path, self.sub_dirs)]
+            self.done.set()
+
+
+dsScanPool = threadutils.FairWorkerPool(name="DatastoreScan",
+                                        num_workers=DS_SCAN_WORKERS,
+                                        max_queued=DS_SCAN_MAX_QUEUED)
+# (dockvols path, sub_dirs) -> DatastoreScan in progress
+dsScans = {}
+dsScansLock = threadutils.get_lock()
+
+
+def scan_datastores(datastores, sub_dirs, unavailable=None):
+    """
+    List volume directories of datastores in parallel: the directories named
+    in sub_dirs tuple ('' is the dockvols directory itself), or all
+    directories under dockvols if sub_dirs is None.
+    Return a list of (datastore name, dockvols path, list of (directory, volume vmdks)).
+    Datastores not scanned within DS_SCAN_TIMEOUT (e.g. hung NFS mounts) are
+    left out, and their names added to the unavailable list, if passed.
+    """
+    dsScanPool.start()
+    scans = []
+    for (datastore, url, path) in datastores:
+        with dsScansLock:
+            scan = dsScans.get((path, sub_dirs))
+            submitted = True
+            if not scan:
+                scan = DatastoreScan(path, sub_dirs)
+                submitted = dsScanPool.submit(datastore, scan.run)
+                if submitted:
+                    dsScans[(path, sub_dirs)] = scan
+        if submitted:
+            scans.append((datastore, path, scan))
+        else:
+            logging.warning("Datastore %s not scanned for volumes, scan pool is full", datastore)
+            if unavailable is not None:
+                unavailable.append(datastore)
+
+    deadline = time.time() + DS_SCAN_TIMEOUT
+    results = []
+    for datastore, path, scan in scans:
+        if not scan.done.wait(max(0, deadline - time.time())) or scan.result is None:
+            logging.warning("Datastore %s unavailable, volumes on it are not listed", datastore)
+            if unavailable is not None:
+                unavailable.append(datastore)
+            continue
+        results.append((datastore, path, scan.result))
+    return results
+
+
+def scan_volume_dir(path):
+    """ Return (sub directories, volume vmdks) found in directory path """
+    listing = get_dir_listing(path)
+    return list(listing.subdirs), list(listing.descriptors)
+
+
+def list_volume_dir(path):
+    """
+    Return (sub directories, volume vmdks) in directory path.
+    Served from the volume index unless the directory changed since last scan.
+    """
+    return volumeIndex.list_dir(path, scan_volume_dir)
+
+
+def walk_volume_dirs(top):
+    """ Like os.walk(top), yield (directory, volume vmdks in it) using the volume index """
+    subdirs, vmdks = list_volume_dir(top)
+    yield top, vmdks
+    for name in subdirs:
+        for entry in walk_volume_dirs(os.path.join(top, name)):
+            yield entry
 
 
 def get_vmdk_path(path, vol_name):
@@ -202,21 +497,33 @@ def get_vmdk_path(path, vol_name):
     If the disk does not exists, returns full path to the disk for create().
     """
 
-    # Get a delta disk list, and if it's empty - return the full path for volume
+    # Use the latest delta disk, and if there is none - return the full path for volume
     # VMDK base file.
     # Note: we rely on NEVER allowing '-NNNNNN' in end of a volume name and on
     # the fact that ESXi always creates deltadisks as <name>-NNNNNN.vmdk (N is a
     # digit, and there are exactly 6 digits there) for delta disks
     #
     # see vmdk_ops.py:parse_vol_name() which enforces the volume name rules.
-    delta_disks = glob.glob("{0}/{1}{2}".format(path, vol_name, SNAP_SUFFIX_GLOB))
-    if not delta_disks:
+    deltas = get_dir_listing(path).deltas.get(vol_name)
+    if not deltas:
         return os.path.join(path, "{0}.vmdk".format(vol_name))
 
-    # this funky code gets the name of the latest delta disk:
-    latest = sorted([(vmdk, os.stat(vmdk).st_ctime) for vmdk in delta_disks], key=lambda d: d[1], reverse=True)[0][0]
-    logging.debug("The latest delta disk is %s. All delta disks: %s", latest, delta_disks)
-    return latest
+    # The latest one is found by ctime, which is not part of the memoized
+    # listing as a delta disk rewritten in place doesn't change the directory
+    latest = deltas[0]
+    if len(deltas) > 1:
+        latest = max(deltas, key=lambda name: get_ctime(os.path.join(path, name)))
+
+    logging.debug("The latest delta disk is %s", latest)
+    return os.path.join(path, latest)
+
+
+def get_ctime(file_path):
+    """ Return ctime of file_path, or 0 if it does not exist """
+    try:
+        return os.stat(file_path).st_ctime
+    except OSError:
+        return 0
 
 
 def get_datastore_path(vmdk_path):
@@ -245,55 +552,95 @@ def get_volname_from_vmdk_path(vmdk_path):
     return strip_vmdk_extension(vmdk)
 
 
-def list_vmdks(path, volname="", show_snapshots=False):
-    """ Return a list of VMDKs in a given path. Filters out non-descriptor
-    files and delta disks.
-
-    Params:
-    path -  where the VMDKs are looked for
-    volname - if passed, only files related to this VMDKs will be returned. Useful when
-            doing volume snapshot inspect
-    show_snapshots - if set to True, all VMDKs (including delta files) will be returned
+class DirListing(object):
+    """
+    Content of a volume directory, classified in a single scandir pass:
+    sub directories, VMDK descriptors of volumes and of delta disks
+    (snapshots), and the delta disks of each volume.
     """
 
-    # dockvols may not exists on a datastore - this is normal.
-    if not os.path.exists(path):
-        return []
-    logging.debug("list_vmdks: dockvol existed on datastore")
-    vmdks = [f for f in os.listdir(path) if vmdk_is_a_descriptor(path, f)]
-    if volname:
-        vmdks = [f for f in vmdks if f.startswith(volname)]
+    def __init__(self, path=None):
+        self.subdirs = []
+        self.descriptors = []
+        self.snapshots = []
+        # volume name -> file names of its delta disks
+        self.deltas = {}
+        if path:
+            self._scan(path)
+
+    def _scan(self, path):
+        special_expr = re.compile(SPECIAL_FILES_REGEXP)
+        snap_expr = re.compile(SNAP_VOL_REGEXP)
+        for entry in os.scandir(path):
+            # like os.walk(), do not follow symlinks to directories
+            if entry.is_dir(follow_symlinks=False):
+                self.subdirs.append(entry.name)
+                continue
+            name = entry.name.lower()
+            # filter out all files with wrong extention
+            # also filter out -delta, -flat, -digest and -ctk VMDK files
+            if not name.endswith('.vmdk') or special_expr.match(name):
+                continue
 
-    if not show_snapshots:
-        expr = re.compile(SNAP_VMDK_REGEXP)
-        vmdks = [f for f in vmdks if not expr.match(f)]
-    logging.debug("vmdks %s", vmdks)
-    return vmdks
+            snap_match = snap_expr.match(entry.name)
+            if snap_match:
+                self.deltas.setdefault(snap_match.group(1), []).append(entry.name)
+
+            # Check the size. It's a cheap(ish) way to check for descriptor,
+            # without actually checking the file content and risking lock conflicts
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                # if file does not exist, assume it's small enough
+                size = 0
+            if size > MAX_DESCR_SIZE:
+                continue
+            if snap_match:
+                self.snapshots.append(entry.name)
+            else:
+                self.descriptors.append(entry.name)
 
 
-def vmdk_is_a_descriptor(path, file_name):
-    """
-    Is the file a vmdk descriptor file?  We assume any file that ends in .vmdk,
-    does not have -delta or -flat or -digest or -ctk at the end of filename,
-    and has a size less than MAX_DESCR_SIZE is a descriptor file.
-    """
+# Empty listing for missing directories
+NO_DIR_LISTING = DirListing()
 
-    name = file_name.lower()
+# directory path -> (mtime, DirListing), see get_dir_listing()
+dirListings = {}
+dirListingsLock = threadutils.get_lock()
 
-    # filter out all files with wrong extention
-    # also filter out -delta, -flat, -digest and -ctk VMDK files
-    if not name.endswith('.vmdk') or re.match(SPECIAL_FILES_REGEXP, name):
-        return False
 
-    # Check the size. It's a cheap(ish) way to check for descriptor,
-    # without actually checking the file content and risking lock conflicts
+def get_dir_listing(path):
+    """
+    Return DirListing for a volume directory. Listings are memoized, and
+    reused while the directory mtime is unchanged.
+    """
     try:
-        if os.stat(os.path.join(path, file_name)).st_size > MAX_DESCR_SIZE:
-            return False
+        mtime = os.stat(path).st_mtime_ns
     except OSError:
-        pass  # if file does not exist, assume it's small enough
+        # dockvols may not exists on a datastore - this is normal.
+        with dirListingsLock:
+            dirListings.pop(path, None)
+        return NO_DIR_LISTING
 
-    return True
+    with dirListingsLock:
+        entry = dirListings.get(path)
+    if entry and entry[0] == mtime:
+        return entry[1]
+
+    try:
+        listing = DirListing(path)
+    except OSError as ex:
+        logging.warning("Failed to list %s: %s", path, ex)
+        return NO_DIR_LISTING
+
+    with dirListingsLock:
+        # A directory changed within the mtime granularity may change again
+        # without a new mtime, so it is listed again on next use
+        if time.time() - mtime / 1e9 < DIR_MTIME_GRANULARITY:
+            dirListings.pop(path, None)
+        else:
+            dirListings[path] = (mtime, listing)
+    return listing
 
 
 def strip_vmdk_extension(filename):
@@ -429,21 +776,84 @@ def check_volumes_mounted(vm_list):
     return None
 
 
-def log_volume_lsof(vol_name):
-    """Log volume open file descriptors"""
+def retry_sleep_time(retry_count):
+    """
+    Return how long to sleep before retry number retry_count (from 0) of an
+    operation failed on a busy file. Jitter keeps concurrent retries apart.
+    """
+    backoff = min(VMDK_RETRY_SLEEP_MAX, VMDK_RETRY_SLEEP_MIN * (2 ** retry_count))
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+class LsofLogger(object):
+    """
+    Logs open file descriptors of busy volumes, at most once per volume per
+    interval. lsof lists the whole host, so it runs in a background thread,
+    one at a time, and serves all volumes requested meanwhile.
+    """
+
+    def __init__(self, interval=LSOF_LOG_INTERVAL):
+        self._interval = interval
+        self._lock = threadutils.get_lock()
+        # vol_name -> time of last lsof request
+        self._last = {}
+        self._pending = set()
+        self._running = False
+
+    def request(self, vol_name):
+        """ Log open descriptors of vol_name soon, unless done recently """
+        now = time.time()
+        with self._lock:
+            last = self._last.get(vol_name)
+            if last and now - last < self._interval:
+                return
+            self._last = dict((name, t) for name, t in self._last.items()
+                              if now - t < self._interval)
+            self._last[vol_name] = now
+            self._pending.add(vol_name)
+            if self._running:
+                return
+            self._running = True
+        threadutils.start_new_thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                vol_names = self._pending
+                self._pending = set()
+                if not vol_names:
+                    self._running = False
+                    return
+            try:
+                _log_lsof(vol_names)
+            except Exception as ex:
+                logging.error("Error running lsof for %s: %s", ", ".join(vol_names), ex)
+
+
+def _log_lsof(vol_names):
+    """ Log open file descriptors of volumes in vol_names """
     rc, out = vmdk_ops.RunCommand(LSOF_CMD)
     if rc != 0:
-        logging.error("Error running lsof for %s: %s", vol_name, out)
+        logging.error("Error running lsof for %s: %s", ", ".join(vol_names), out)
         return
+    exprs = [re.compile(r".*/vmfs/volumes/.*{0}.*".format(re.escape(name))) for name in vol_names]
     for line in out.splitlines():
         # Make sure we only match the lines pertaining to that volume files.
-        if re.search(r".*/vmfs/volumes/.*{0}.*".format(vol_name), line):
+        if any(expr.search(line) for expr in exprs):
             cartel, name, ftype, fd, desc = line.split()
             msg = "cartel={0}, name={1}, type={2}, fd={3}, desc={4}".format(
                 cartel, name, ftype, fd, desc)
             logging.info("Volume open descriptor: %s", msg)
 
 
+lsofLogger = LsofLogger()
+
+
+def log_volume_lsof(vol_name):
+    """Log volume open file descriptors, in background and rate limited per volume"""
+    lsofLogger.request(vol_name)
+
+
 def get_datastore_objects():
     """ return all datastore objects """
     si = vmdk_ops.get_si()
@@ -465,11 +875,9 @@ def get_datastore_url(datastore_name):
     if not validate_datastore(datastore_name):
         return None
 
-    # Query datastore URL from VIM API
-    # get_datastores() return a list of tuple
-    # each tuple has format like (datastore_name, datastore_url, dockvol_path)
-    res = [d[1] for d in get_datastores() if d[0] == datastore_name]
-    return res[0]
+    # the datastore may have been removed since
+    datastore = datastoreCache.by_name(datastore_name)
+    return datastore[1] if datastore else None
 
 
 def get_datastore_name(datastore_url):
@@ -482,10 +890,8 @@ def get_datastore_name(datastore_url):
     if datastore_url == auth_data_const.ALL_DS_URL:
         return auth_data_const.ALL_DS
 
-    # Query datastore name from VIM API
-    # get_datastores() return a list of tuple
-    # each tuple has format like (datastore_name, datastore_url, dockvol_path)
-    res = [d[0] for d in get_datastores() if d[1] == datastore_url]
+    init_datastoreCache()
+    res = datastoreCache.by_url(datastore_url)
     logging.debug("get_datastore_name: res=%s", res)
     return res[0] if res else None
 
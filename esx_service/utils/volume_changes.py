@@ -0,0 +1,138 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Change sequence of the set of volumes on this host, for "list since" requests.
+
+The sequence is bumped when volumes are created or removed by this service
+(see executeRequest() in vmdk_ops.py), and when the periodic rescan finds the
+volume set or tenants changed by others (other hosts, admin CLI, manual
+changes).
+Lists computed for a tenant are kept with the sequence they were computed at,
+so a client passing the sequence of its last list gets only the volumes added
+and removed since then, and nothing at all if the sequence did not change.
+Paged lists are served from the same lists, so reading all pages lists the
+datastores once per sequence, not once per page.
+"""
+
+import collections
+import logging
+import time
+
+import threadutils
+
+# Seconds between rescans of the datastores for changes made by others
+VOLUME_RESCAN_INTERVAL = 60
+
+# Number of lists kept per tenant to compute changes from
+LIST_HISTORY_SIZE = 8
+
+
+class VolumeChanges(object):
+    """
+    Thread safe change sequence and per tenant list history.
+    list_func(tenant) returns the volume names of a tenant, and
+    scan_func() returns a value which changes when any volume is added or
+    removed (used by rescan()).
+    """
+
+    def __init__(self, list_func, scan_func, history_size=LIST_HISTORY_SIZE):
+        self._list_func = list_func
+        self._scan_func = scan_func
+        self._history_size = history_size
+        self._lock = threadutils.get_lock()
+        # Starts at current time (ms), so sequences handed out before a
+        # service restart are never taken for current ones
+        self._sequence = int(time.time() * 1000)
+        # tenant -> OrderedDict of sequence -> frozenset of names
+        self._lists = {}
+        self._last_scan = None
+
+    @property
+    def sequence(self):
+        return self._sequence
+
+    def bump(self):
+        """ Note a change of the volume set """
+        with self._lock:
+            self._sequence += 1
+            logging.debug("Volume change sequence: %d", self._sequence)
+
+    def list_since(self, tenant, since=None):
+        """
+        Return (sequence, names, added, removed) for tenant.
+        If the list at sequence since is known, names is None and added and
+        removed are the changes since then (both empty if unchanged).
+        Otherwise names is the full list and added and removed are None.
+        """
+        sequence, current = self._current_list(tenant)
+        with self._lock:
+            previous = self._lists[tenant].get(since) if since is not None else None
+
+        if previous is None:
+            return sequence, sorted(current), None, None
+        return sequence, None, sorted(current - previous), sorted(previous - current)
+
+    def get_list(self, tenant, sequence=None):
+        """
+        Return (sequence, frozenset of names) for tenant: the list kept for
+        sequence if it is given and still kept, else the current list.
+        """
+        if sequence is not None:
+            with self._lock:
+                names = self._lists.get(tenant, {}).get(sequence)
+            if names is not None:
+                return sequence, names
+        return self._current_list(tenant)
+
+    def _current_list(self, tenant):
+        """ Return (sequence, frozenset of names) for tenant at the current sequence """
+        with self._lock:
+            sequence = self._sequence
+            current = self._lists.get(tenant, {}).get(sequence)
+        if current is None:
+            # sequence is taken before the list, so a change meanwhile
+            # makes the next request list again
+            current = frozenset(self._list_func(tenant))
+        with self._lock:
+            lists = self._lists.setdefault(tenant, collections.OrderedDict())
+            # A list computed meanwhile by another request may differ if the
+            # volumes changed, keep the one handed out first
+            current = lists.setdefault(sequence, current)
+            while len(lists) > self._history_size:
+                lists.popitem(last=False)
+        return sequence, current
+
+    def rescan(self):
+        """
+        Bump the sequence if the volume set changed since the last rescan.
+        The first rescan always bumps it, as lists may have been computed
+        before it.
+        """
+        scan = self._scan_func()
+        if scan != self._last_scan:
+            if self._last_scan is not None:
+                logging.info("Volumes changed outside of this service")
+            self.bump()
+        self._last_scan = scan
+
+    def rescan_loop(self, interval=VOLUME_RESCAN_INTERVAL):
+        """ Rescan thread, runs forever """
+        threadutils.set_thread_name("VolumeRescan")
+        while True:
+            try:
+                self.rescan()
+            except Exception as ex:
+                logging.warning("Volume rescan failed: %s", ex)
+            time.sleep(interval)
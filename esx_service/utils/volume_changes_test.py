@@ -0,0 +1,124 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests for volume_changes.py
+
+import unittest
+
+import volume_changes
+
+
+class TestVolumeChanges(unittest.TestCase):
+    """ Test volume change sequence and list history """
+
+    def setUp(self):
+        self.volumes = {"tenant1": {"vol1@ds1"}, "tenant2": set()}
+        self.lists = 0
+        self.changes = volume_changes.VolumeChanges(self.list_volumes,
+                                                    self.scan_volumes,
+                                                    history_size=2)
+
+    def list_volumes(self, tenant):
+        self.lists += 1
+        return iter(self.volumes[tenant])
+
+    def scan_volumes(self):
+        return frozenset((tenant, name) for tenant, names in self.volumes.items()
+                         for name in names)
+
+    def test_full_list(self):
+        seq, names, added, removed = self.changes.list_since("tenant1")
+        self.assertEqual(names, ["vol1@ds1"])
+        self.assertIsNone(added)
+        self.assertIsNone(removed)
+        # unknown sequence
+        self.assertEqual(self.changes.list_since("tenant1", seq - 1)[1], ["vol1@ds1"])
+
+    def test_unchanged(self):
+        seq = self.changes.list_since("tenant1")[0]
+        self.assertEqual(self.changes.list_since("tenant1", seq), (seq, None, [], []))
+        self.assertEqual(self.lists, 1)
+
+    def test_changes(self):
+        seq = self.changes.list_since("tenant1")[0]
+        self.volumes["tenant1"] = {"vol2@ds1"}
+        self.changes.bump()
+        new_seq, names, added, removed = self.changes.list_since("tenant1", seq)
+        self.assertGreater(new_seq, seq)
+        self.assertIsNone(names)
+        self.assertEqual(added, ["vol2@ds1"])
+        self.assertEqual(removed, ["vol1@ds1"])
+        self.assertEqual(self.lists, 2)
+
+    def test_other_tenant_changed(self):
+        seq = self.changes.list_since("tenant1")[0]
+        self.volumes["tenant2"] = {"vol2@ds1"}
+        self.changes.bump()
+        self.assertEqual(self.changes.list_since("tenant1", seq)[1:], (None, [], []))
+
+    def test_concurrent_lists(self):
+        """ Lists at the same sequence get the same volumes """
+        list_volumes = self.list_volumes
+
+        def list_during_create(tenant):
+            names = set(self.volumes[tenant])
+            # another request lists after the create
+            self.volumes["tenant1"] = {"vol1@ds1", "vol2@ds1"}
+            self.list_volumes = list_volumes
+            self.changes.list_since("tenant1")
+            return iter(names)
+
+        self.list_volumes = list_during_create
+        self.changes = volume_changes.VolumeChanges(lambda tenant: self.list_volumes(tenant),
+                                                    self.scan_volumes)
+        seq, names = self.changes.list_since("tenant1")[:2]
+        self.assertEqual(names, ["vol1@ds1", "vol2@ds1"])
+        # both clients are diffed against that list after the create bumps the sequence
+        self.changes.bump()
+        self.assertEqual(self.changes.list_since("tenant1", seq)[1:], (None, [], []))
+
+    def test_get_list(self):
+        seq, names = self.changes.get_list("tenant1")
+        self.assertEqual(names, {"vol1@ds1"})
+        self.volumes["tenant1"] = {"vol2@ds1"}
+        self.changes.bump()
+        # kept list of an earlier sequence
+        self.assertEqual(self.changes.get_list("tenant1", seq), (seq, names))
+        self.assertEqual(self.lists, 1)
+        new_seq, names = self.changes.get_list("tenant1", seq - 1)
+        self.assertEqual((new_seq, names), (seq + 1, {"vol2@ds1"}))
+        # the same list is used for changes
+        self.assertEqual(self.changes.list_since("tenant1", seq)[1:], (None, ["vol2@ds1"], ["vol1@ds1"]))
+        self.assertEqual(self.lists, 2)
+
+    def test_history_size(self):
+        first = self.changes.list_since("tenant1")[0]
+        for _ in range(2):
+            self.changes.bump()
+            self.changes.list_since("tenant1")
+        self.assertEqual(self.changes.list_since("tenant1", first)[1], ["vol1@ds1"])
+
+    def test_rescan(self):
+        seq = self.changes.sequence
+        self.changes.rescan()
+        self.assertEqual(self.changes.sequence, seq + 1)
+        self.changes.rescan()
+        self.assertEqual(self.changes.sequence, seq + 1)
+        self.volumes["tenant2"] = {"vol2@ds1"}
+        self.changes.rescan()
+        self.assertEqual(self.changes.sequence, seq + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,305 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Host-local index of docker volumes, kept in an SQLite DB next to the auth DB.
+
+The index holds
+ - the content of each dockvols directory (sub directories and volume vmdks),
+   with the directory mtime it was read at. Listing a directory whose mtime is
+   unchanged is a DB query, so volume enumeration does not scan datastores.
+ - the metadata of each volume, with the side car signature (inode, size, mtime)
+   it was read at. It is updated from every KV create/save/delete (volume_kv.py),
+   in the background, and only used while the side car still has that signature.
+
+Both are validated by a stat, so changes made by other hosts or by hand
+are picked up. The index is a cache only: it is safe to drop it at any time
+(see 'vmdkops_admin.py volume reindex'), and any DB error falls back to
+reading the datastores.
+"""
+
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# Location of the index DB
+VOLUME_INDEX_PATH = '/etc/vmware/vmdkops/volume-index.db'
+
+# Bump when the schema changes. An index with another version is recreated.
+INDEX_VERSION = 1
+
+# Seconds to wait for the DB lock held by another thread or process (e.g. admin CLI)
+DB_LOCK_TIMEOUT = 5
+
+# Max metadata updates committed in one transaction by the writer thread
+MAX_WRITE_BATCH = 64
+
+# Directory mtimes may have a coarse granularity. A directory changed less than
+# this many seconds before it was scanned is scanned again on next use, as a
+# later change in the same tick would not change its mtime.
+DIR_MTIME_GRANULARITY = 2
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS dirs (
+        path TEXT PRIMARY KEY NOT NULL,
+        mtime INTEGER NOT NULL,
+        subdirs TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS volumes (
+        path TEXT PRIMARY KEY NOT NULL,
+        dir TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        meta_sig TEXT,
+        metadata TEXT,
+        status TEXT,
+        attached_vm_uuid TEXT,
+        attached_vm_name TEXT,
+        options TEXT,
+        size TEXT,
+        updated REAL
+    )""",
+    "CREATE INDEX IF NOT EXISTS volumes_dir ON volumes (dir)",
+]
+
+# Metadata keys copied to their own columns. Same values as in volume_kv.py,
+# which can't be imported from here.
+META_STATUS = 'status'
+META_ATTACHED_VM_UUID = 'attachedVMUuid'
+META_ATTACHED_VM_NAME = 'attachedVMName'
+META_VOL_OPTS = 'volOpts'
+META_SIZE = 'size'
+
+
+def _dir_mtime(path):
+    """ Return mtime (ns) of directory path, or None if it doesn't exist """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _sig_str(file_sig):
+    return json.dumps(list(file_sig)) if file_sig else None
+
+
+class VolumeIndex(object):
+    """
+    Thread safe access to the volume index DB.
+    The DB is opened on first use, with one connection per thread. If it
+    can't be opened, the index is disabled and all methods behave as if
+    nothing was indexed.
+    Metadata updates (put_metadata() and forget()) are queued, and committed
+    in batches by a writer thread, so requests don't wait for DB commits.
+    """
+
+    def __init__(self, db_path=VOLUME_INDEX_PATH):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._initialized = False
+        self._disabled = False
+        self._writes = queue.Queue()
+        self._writer = None
+
+    def _connect(self):
+        """ Return the DB connection of this thread, or None if the index is disabled """
+        conn = getattr(self._local, "conn", None)
+        if conn or self._disabled:
+            return conn
+        try:
+            conn = sqlite3.connect(self.db_path, timeout=DB_LOCK_TIMEOUT)
+            with self._lock:
+                if not self._initialized:
+                    self._init_schema(conn)
+                    self._initialized = True
+                    logging.info("Volume index opened: %s", self.db_path)
+        except sqlite3.Error as e:
+            logging.warning("Volume index %s disabled: %s", self.db_path, e)
+            self._disabled = True
+            return None
+        self._local.conn = conn
+        return conn
+
+    def _init_schema(self, conn):
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != INDEX_VERSION:
+            with conn:
+                conn.execute("DROP TABLE IF EXISTS dirs")
+                conn.execute("DROP TABLE IF EXISTS volumes")
+        with conn:
+            for stmt in SCHEMA:
+                conn.execute(stmt)
+            conn.execute("PRAGMA user_version = {0}".format(INDEX_VERSION))
+
+    def _execute(self, func):
+        """
+        Run func(conn) in a transaction and return its result.
+        Return None if the index is disabled or on DB errors.
+        """
+        conn = self._connect()
+        if not conn:
+            return None
+        try:
+            with conn:
+                return func(conn)
+        except sqlite3.Error as e:
+            logging.warning("Volume index %s: %s", self.db_path, e)
+            return None
+
+    def _queue_write(self, func):
+        """ Queue func(conn) for the writer thread """
+        if self._disabled:
+            return
+        with self._lock:
+            if not self._writer:
+                self._writer = threading.Thread(target=self._write_loop,
+                                                name="VolumeIndexWriter")
+                self._writer.daemon = True
+                self._writer.start()
+        self._writes.put(func)
+
+    def _write_loop(self):
+        """ Writer thread, commits queued writes in batches. Runs forever """
+        while True:
+            funcs = [self._writes.get()]
+            while len(funcs) < MAX_WRITE_BATCH:
+                try:
+                    funcs.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+
+            def write_all(conn):
+                for func in funcs:
+                    func(conn)
+
+            self._execute(write_all)
+            for _ in funcs:
+                self._writes.task_done()
+
+    def flush(self):
+        """ Wait until queued writes are committed (or failed) """
+        self._writes.join()
+
+    def list_dir(self, path, scan):
+        """
+        Return (subdirs, vmdks) of directory path, from the index if the
+        directory did not change since it was indexed.
+        Otherwise scan(path) returns them and the index is updated.
+        Both lists are sorted by name either way. A missing directory has no content.
+        """
+        mtime = _dir_mtime(path)
+        if mtime is None:
+            return [], []
+
+        def lookup(conn):
+            row = conn.execute("SELECT mtime, subdirs FROM dirs WHERE path = ?",
+                               (path,)).fetchone()
+            if not row or row[0] != mtime:
+                return None
+            vmdks = [r[0] for r in conn.execute(
+                "SELECT filename FROM volumes WHERE dir = ? ORDER BY filename", (path,))]
+            return json.loads(row[1]), vmdks
+
+        content = self._execute(lookup)
+        if content is not None:
+            return content
+
+        subdirs, vmdks = scan(path)
+        subdirs = sorted(subdirs)
+        vmdks = sorted(vmdks)
+        if time.time() - mtime / 1e9 < DIR_MTIME_GRANULARITY:
+            indexed_mtime = 0
+        else:
+            indexed_mtime = mtime
+
+        def store(conn):
+            conn.execute("INSERT OR REPLACE INTO dirs (path, mtime, subdirs) VALUES (?, ?, ?)",
+                         (path, indexed_mtime, json.dumps(subdirs)))
+            indexed = set(r[0] for r in conn.execute(
+                "SELECT filename FROM volumes WHERE dir = ?", (path,)))
+            for name in indexed.difference(vmdks):
+                conn.execute("DELETE FROM volumes WHERE path = ?", (os.path.join(path, name),))
+            for name in set(vmdks).difference(indexed):
+                conn.execute("INSERT OR IGNORE INTO volumes (path, dir, filename) VALUES (?, ?, ?)",
+                             (os.path.join(path, name), path, name))
+
+        # mtime is taken before the scan, so a concurrent change of the
+        # directory makes the entry miss on next use
+        self._execute(store)
+        return subdirs, vmdks
+
+    def get_metadata(self, vmdk_path, file_sig):
+        """ Return indexed metadata if the side car still has file_sig, else None """
+        if not file_sig:
+            return None
+
+        def lookup(conn):
+            return conn.execute("SELECT meta_sig, metadata FROM volumes WHERE path = ?",
+                                (vmdk_path,)).fetchone()
+
+        row = self._execute(lookup)
+        if row and row[1] and row[0] == _sig_str(file_sig):
+            return json.loads(row[1])
+        return None
+
+    def put_metadata(self, vmdk_path, file_sig, vol_meta):
+        """
+        Index metadata read from or written to the side car with file_sig.
+        The update is queued, until it is committed get_metadata() misses for
+        the new file_sig.
+        """
+        opts = vol_meta.get(META_VOL_OPTS) or {}
+        values = (_sig_str(file_sig),
+                  json.dumps(vol_meta),
+                  vol_meta.get(META_STATUS),
+                  vol_meta.get(META_ATTACHED_VM_UUID),
+                  vol_meta.get(META_ATTACHED_VM_NAME),
+                  json.dumps(opts),
+                  opts.get(META_SIZE),
+                  time.time())
+
+        def store(conn):
+            # Volumes not listed yet are indexed when their directory is scanned
+            conn.execute("""UPDATE volumes SET meta_sig = ?, metadata = ?, status = ?,
+                            attached_vm_uuid = ?, attached_vm_name = ?, options = ?,
+                            size = ?, updated = ? WHERE path = ?""",
+                         values + (vmdk_path,))
+
+        self._queue_write(store)
+
+    def forget(self, vmdk_path):
+        """ Drop indexed metadata of vmdk_path, e.g. when it is deleted """
+        def drop(conn):
+            conn.execute("UPDATE volumes SET meta_sig = NULL, metadata = NULL WHERE path = ?",
+                         (vmdk_path,))
+
+        self._queue_write(drop)
+
+    def clear(self):
+        """ Drop the whole index, it is filled again as volumes are listed and read """
+        self.flush()
+
+        def drop(conn):
+            conn.execute("DELETE FROM dirs")
+            conn.execute("DELETE FROM volumes")
+
+        self._execute(drop)
+
+
+# Index shared by all threads of this process
+volumeIndex = VolumeIndex()
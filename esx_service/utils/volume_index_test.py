@@ -0,0 +1,153 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests for volume_index.py
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import volume_index
+
+
+class TestVolumeIndex(unittest.TestCase):
+    """ Test volume index DB """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.vol_dir = os.path.join(self.tmp_dir, "dockvols")
+        os.mkdir(self.vol_dir)
+        os.mkdir(os.path.join(self.vol_dir, "tenant1"))
+        self.index = volume_index.VolumeIndex(os.path.join(self.tmp_dir, "index.db"))
+        self.scans = 0
+        # let directory mtimes be trusted right away
+        self.granularity = volume_index.DIR_MTIME_GRANULARITY
+        volume_index.DIR_MTIME_GRANULARITY = -1
+
+    def tearDown(self):
+        volume_index.DIR_MTIME_GRANULARITY = self.granularity
+        shutil.rmtree(self.tmp_dir)
+
+    def scan(self, path):
+        self.scans += 1
+        names = os.listdir(path)
+        return ([n for n in names if os.path.isdir(os.path.join(path, n))],
+                sorted(n for n in names if n.endswith(".vmdk")))
+
+    def touch(self, name):
+        open(os.path.join(self.vol_dir, name), "w").close()
+
+    def test_list_dir_cached(self):
+        self.touch("vol1.vmdk")
+        self.assertEqual(self.index.list_dir(self.vol_dir, self.scan),
+                         (["tenant1"], ["vol1.vmdk"]))
+        self.assertEqual(self.index.list_dir(self.vol_dir, self.scan),
+                         (["tenant1"], ["vol1.vmdk"]))
+        self.assertEqual(self.scans, 1)
+
+    def test_list_dir_changed(self):
+        self.touch("vol1.vmdk")
+        self.index.list_dir(self.vol_dir, self.scan)
+        os.remove(os.path.join(self.vol_dir, "vol1.vmdk"))
+        self.touch("vol2.vmdk")
+        # make sure mtime changes even with coarse timestamps
+        st = os.stat(self.vol_dir)
+        os.utime(self.vol_dir, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        self.assertEqual(self.index.list_dir(self.vol_dir, self.scan)[1], ["vol2.vmdk"])
+        self.assertEqual(self.index.list_dir(self.vol_dir, self.scan)[1], ["vol2.vmdk"])
+        self.assertEqual(self.scans, 2)
+
+    def test_list_dir_order(self):
+        self.touch("vol2.vmdk")
+        self.touch("vol1.vmdk")
+        scan_reversed = lambda path: tuple(list(reversed(l)) for l in self.scan(path))
+        scanned = self.index.list_dir(self.vol_dir, scan_reversed)
+        self.assertEqual(scanned[1], ["vol1.vmdk", "vol2.vmdk"])
+        self.assertEqual(self.index.list_dir(self.vol_dir, scan_reversed), scanned)
+        self.assertEqual(self.scans, 1)
+
+    def test_list_missing_dir(self):
+        self.assertEqual(self.index.list_dir(os.path.join(self.tmp_dir, "none"), self.scan),
+                         ([], []))
+        self.assertEqual(self.scans, 0)
+
+    def test_recent_dir_rescanned(self):
+        volume_index.DIR_MTIME_GRANULARITY = 60
+        self.index.list_dir(self.vol_dir, self.scan)
+        self.index.list_dir(self.vol_dir, self.scan)
+        self.assertEqual(self.scans, 2)
+
+    def test_metadata(self):
+        self.touch("vol1.vmdk")
+        self.index.list_dir(self.vol_dir, self.scan)
+        path = os.path.join(self.vol_dir, "vol1.vmdk")
+        meta = {"status": "detached", "volOpts": {"size": "10gb"}}
+        self.index.put_metadata(path, (1, 2, 3), meta)
+        self.index.flush()
+        self.assertEqual(self.index.get_metadata(path, (1, 2, 3)), meta)
+        # side car changed
+        self.assertIsNone(self.index.get_metadata(path, (1, 2, 4)))
+        self.index.forget(path)
+        self.index.flush()
+        self.assertIsNone(self.index.get_metadata(path, (1, 2, 3)))
+
+    def test_metadata_not_listed(self):
+        path = os.path.join(self.vol_dir, "vol1.vmdk")
+        self.index.put_metadata(path, (1, 2, 3), {"status": "detached"})
+        self.index.flush()
+        self.assertIsNone(self.index.get_metadata(path, (1, 2, 3)))
+
+    def test_metadata_batched(self):
+        for i in range(3):
+            self.touch("vol{0}.vmdk".format(i))
+        self.index.list_dir(self.vol_dir, self.scan)
+        paths = [os.path.join(self.vol_dir, "vol{0}.vmdk".format(i)) for i in range(3)]
+        for i, path in enumerate(paths):
+            self.index.put_metadata(path, (1, 2, i), {"status": "detached"})
+        # later updates of the same volume win
+        self.index.put_metadata(paths[0], (1, 2, 9), {"status": "attached"})
+        self.index.flush()
+        self.assertEqual(self.index.get_metadata(paths[0], (1, 2, 9)), {"status": "attached"})
+        self.assertIsNone(self.index.get_metadata(paths[0], (1, 2, 0)))
+        self.assertEqual(self.index.get_metadata(paths[2], (1, 2, 2)), {"status": "detached"})
+
+    def test_other_threads(self):
+        self.touch("vol1.vmdk")
+        self.index.list_dir(self.vol_dir, self.scan)
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(self.index.list_dir(self.vol_dir, self.scan)))
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [(["tenant1"], ["vol1.vmdk"])])
+        self.assertEqual(self.scans, 1)
+
+    def test_clear(self):
+        self.index.list_dir(self.vol_dir, self.scan)
+        self.index.clear()
+        self.index.list_dir(self.vol_dir, self.scan)
+        self.assertEqual(self.scans, 2)
+
+    def test_disabled(self):
+        index = volume_index.VolumeIndex(os.path.join(self.tmp_dir, "none", "index.db"))
+        self.touch("vol1.vmdk")
+        self.assertEqual(index.list_dir(self.vol_dir, self.scan)[1], ["vol1.vmdk"])
+        self.assertEqual(index.list_dir(self.vol_dir, self.scan)[1], ["vol1.vmdk"])
+        self.assertEqual(self.scans, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,7 +24,9 @@ VMDK name is formed as [vmdatastore] dockvols/"Name".vmdk
 Commands ("cmd" in request):
 		"create"  - create a VMDK in "[vmdatastore] dvol"
 		"remove"  - remove a VMDK. We assume it's not open, and fail if it is
-		"list"    - enumerate VMDKs
+		"list"    - enumerate VMDKs. With "page-size" (and "cursor", "sequence") in opts,
+		            returns one page of VMDKs ordered by name. With "since"
+		            in opts, returns VMDKs added and removed since then
 		"get"     - get info about an individual volume (vmdk)
 		"attach"  - attach a VMDK to the requesting VM
 		"detach"  - detach a VMDK from the requesting VM (assuming it's unmounted)
@@ -33,16 +35,20 @@ Commands ("cmd" in request):
 
 import atexit
 import getopt
+import heapq
+import http.client
 import json
 import logging
 import os
 import os.path
 import re
 import signal
+import socket
 import subprocess
 import sys
 import traceback
 import time
+from contextlib import contextmanager
 from ctypes import *
 
 from vmware import vsi
@@ -94,7 +100,10 @@ import error_code
 from error_code import ErrorCode
 from error_code import error_code_to_message
 import vm_listener
+import vm_inventory
 import counter
+import perf_stats
+import volume_changes
 
 # Python version 3.5.1
 PYTHON64_VERSION = 50659824
@@ -107,15 +116,24 @@ OSFS_MKDIR_CMD = "/usr/lib/vmware/osfs/bin/osfs-mkdir -n "
 DOCK_VOLS_DIR = "dockvols"  # place in the same (with Docker VM) datastore
 MAX_JSON_SIZE = 1024 * 4  # max buf size for query json strings. Queries are limited in size
 MAX_SKIP_COUNT = 16       # max retries on VMCI Get Ops failures
+MAX_LIST_PAGE_SIZE = 1000 # max volumes in one page of "list" reply
 VMDK_ADAPTER_TYPE = 'busLogic'  # default adapter type
 
 # Server side understand protocol version. If you are changing client/server protocol we use
 # over VMCI, PLEASE DO NOT FORGET TO CHANGE IT FOR CLIENT in file <esx_vmdkcmd.go> !
 SERVER_PROTOCOL_VERSION = 2
 
+# Options of "list" request for paged replies, see listVMDK()
+LIST_PAGE_SIZE = 'page-size'
+LIST_CURSOR = 'cursor'
+LIST_SEQUENCE = 'sequence'
+# Option of "list" request for changes only, see listVMDK()
+LIST_SINCE = 'since'
+
 # Error codes
 VMCI_ERROR = -1 # VMCI C code uses '-1' to indicate failures
 ECONNABORTED = 103 # Error on non privileged client
+EINTR = 4 # vmci_get_one_op interrupted by a signal
 
 # Volume data returned on Get request
 CAPACITY = 'capacity'
@@ -134,11 +152,31 @@ PVSCSI_MAX_TARGETS = 16
 # Service instance provide from connection to local hostd
 _service_instance = None
 
+# Set when _service_instance is known to be stale and must be reconnected
+_si_stale = False
+
+# Connected hostd sessions (main and pooled), logged out at exit
+_connected_sis = set()
+
+# Number of additional local hostd sessions used by request threads for
+# vSphere calls, so that concurrent requests do not share one connection
+SI_POOL_SIZE = 4
+
+# Interval (seconds) between liveness checks of the hostd sessions
+SI_KEEPALIVE_INTERVAL = 30
+
 # VMCI library used to communicate with clients
 lib = None
 
-# For managing resource locks.
-lockManager = threadutils.LockManager()
+# For managing resource locks. Locks are instrumented, so that contention
+# can be checked with 'vmdkops_admin.py status --locks'
+lockManager = threadutils.LockManager(instrumented=True)
+
+# Number of most contended locks saved with the performance stats
+LOCK_STATS_TOP = 20
+
+# Set by SIGUSR1 handler, stats are saved by dump_stats_loop()
+dumpStatsRequest = threading.Event()
 
 # Barrier indicating whether stop has been requested
 stopBarrier = False
@@ -149,6 +187,21 @@ opsCounter = counter.OpsCounter()
 # Timeout setting for waiting all in-flight ops drained
 WAIT_OPS_TIMEOUT = 20
 
+# Worker threads executing VMCI requests, and limits on requests waiting for a worker.
+# Requests are queued per requesting VM (cartel) and served round-robin.
+MAX_WORKER_THREADS = 32
+MAX_QUEUED_REQUESTS = 256
+MAX_QUEUED_REQUESTS_PER_VM = 64
+
+# Reply sent when the request queue is full. Client retries on this error.
+SERVICE_BUSY_ERR = "Service is busy, please retry the operation"
+
+# Pool of worker threads for VMCI requests
+requestPool = threadutils.FairWorkerPool(name="VmciWorker",
+                                         num_workers=MAX_WORKER_THREADS,
+                                         max_queued=MAX_QUEUED_REQUESTS,
+                                         max_queued_per_key=MAX_QUEUED_REQUESTS_PER_VM)
+
 # PCI bus and function number bits and mask, used on the slot number.
 PCI_BUS_BITS = 5
 PCI_BUS_MASK = 31
@@ -228,11 +281,11 @@ def createVMDK(vmdk_path, vm_name, vol_name,
     volume_datastore_path = vmdk_utils.get_datastore_path(vmdk_path)
     logging.debug("volume_datastore_path=%s", volume_datastore_path)
 
-    si = get_si()
-    task = si.content.virtualDiskManager.CreateVirtualDisk(
-        name=volume_datastore_path, spec=vdisk_spec)
     try:
-        wait_for_tasks(si, [task])
+        with siPool.session() as si:
+            task = si.content.virtualDiskManager.CreateVirtualDisk(
+                name=volume_datastore_path, spec=vdisk_spec)
+            wait_for_tasks(si, [task])
     except vim.fault.VimFault as ex:
         return err("Failed to create volume: {0}".format(ex.msg))
 
@@ -319,7 +372,7 @@ def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_
     dest_vol = vmdk_utils.get_datastore_path(vmdk_path)
     source_vol = vmdk_utils.get_datastore_path(src_vmdk_path)
     lockname = "{}.{}.{}".format(src_datastore, tenant_name, src_volume)
-    with lockManager.get_lock(lockname):
+    with lockManager.get_rwlock(lockname).exclusive:
         # Verify if the source volume is in use.
         attached, uuid, attach_as, attached_vm_name = getStatusAttached(src_vmdk_path)
         if attached:
@@ -355,11 +408,11 @@ def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_
         vdisk_spec.diskType = disk_format
 
         # Clone volume
-        si = get_si()
-        task = si.content.virtualDiskManager.CopyVirtualDisk(
-            sourceName=source_vol, destName=dest_vol, destSpec=vdisk_spec)
         try:
-            wait_for_tasks(si, [task])
+            with siPool.session() as si:
+                task = si.content.virtualDiskManager.CopyVirtualDisk(
+                    sourceName=source_vol, destName=dest_vol, destSpec=vdisk_spec)
+                wait_for_tasks(si, [task])
         except vim.fault.VimFault as ex:
             return err("Failed to clone volume: {0}".format(ex.msg))
 
@@ -393,17 +446,17 @@ def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_
             return set_err
 
     # Update volume meta
-    vol_meta = kv.getAll(vmdk_path)
-    vol_meta[kv.CREATED_BY] = vm_name
-    vol_meta[kv.CREATED] = time.asctime(time.gmtime())
-    vol_meta[kv.VOL_OPTS][kv.CLONE_FROM] = src_volume
-    vol_meta[kv.VOL_OPTS][kv.DISK_ALLOCATION_FORMAT] = opts[kv.DISK_ALLOCATION_FORMAT]
-    if kv.ACCESS in opts:
-        vol_meta[kv.VOL_OPTS][kv.ACCESS] = opts[kv.ACCESS]
-    if kv.ATTACH_AS in opts:
-        vol_meta[kv.VOL_OPTS][kv.ATTACH_AS] = opts[kv.ATTACH_AS]
-
-    if not kv.setAll(vmdk_path, vol_meta):
+    def set_clone_meta(vol_meta):
+        vol_meta[kv.CREATED_BY] = vm_name
+        vol_meta[kv.CREATED] = time.asctime(time.gmtime())
+        vol_meta[kv.VOL_OPTS][kv.CLONE_FROM] = src_volume
+        vol_meta[kv.VOL_OPTS][kv.DISK_ALLOCATION_FORMAT] = opts[kv.DISK_ALLOCATION_FORMAT]
+        if kv.ACCESS in opts:
+            vol_meta[kv.VOL_OPTS][kv.ACCESS] = opts[kv.ACCESS]
+        if kv.ATTACH_AS in opts:
+            vol_meta[kv.VOL_OPTS][kv.ATTACH_AS] = opts[kv.ATTACH_AS]
+
+    if not kv.update(vmdk_path, set_clone_meta):
         msg = "Failed to create metadata kv store for {0}".format(vmdk_path)
         logging.warning(msg)
         removeVMDK(vmdk_path)
@@ -624,11 +677,11 @@ def cleanVMDK(vmdk_path, vol_name=None):
     vol_meta = kv.getAll(vmdk_path)
     kv.delete(vmdk_path)
     while True:
-        si = get_si()
-        task = si.content.virtualDiskManager.DeleteVirtualDisk(name=volume_datastore_path)
         try:
             # Wait for delete, exit loop on success
-            wait_for_tasks(si, [task])
+            with siPool.session() as si:
+                task = si.content.virtualDiskManager.DeleteVirtualDisk(name=volume_datastore_path)
+                wait_for_tasks(si, [task])
             break
         except vim.fault.FileNotFound as ex:
             logging.warning("*** removeVMDK: File not found error: %s", ex.msg)
@@ -640,8 +693,8 @@ def cleanVMDK(vmdk_path, vol_name=None):
             else:
                 logging.warning("*** removeVMDK: Retrying removal on error: %s", ex.msg)
                 vmdk_utils.log_volume_lsof(vol_name)
+                time.sleep(vmdk_utils.retry_sleep_time(retry_count))
                 retry_count += 1
-                time.sleep(vmdk_utils.VMDK_RETRY_SLEEP)
 
     return None
 
@@ -699,44 +752,161 @@ def getVMDK(vmdk_path, vol_name, datastore):
 
     return result
 
-def listVMDK(tenant):
+def listVMDK(tenant, opts=None):
     """
     Returns a list of volume names (note: may be an empty list).
     Each volume name is returned as either `volume@datastore`, or just `volume`
     for volumes on vm_datastore
+
+    If opts has LIST_PAGE_SIZE, returns one page of the list instead, which
+    bounds the reply size and its JSON encoding time for clients with many volumes:
+        {"Volumes": [...], "Cursor": <name of last volume in page, or None>,
+         "Sequence": <n>}
+    Volumes are ordered by name, and a page has at most LIST_PAGE_SIZE volumes
+    with names after LIST_CURSOR (if given). The Cursor of the last page is None.
+    Pages are taken from the list kept for LIST_SEQUENCE, the Sequence of the
+    first page, so the datastores are listed once for all pages (or from the
+    current list if that one is not kept anymore). See volume_changes.py.
+    No client asks for pages yet (the plugin always gets the full list).
+
+    If opts has LIST_SINCE, the Sequence of a previous reply (or None),
+    returns only the changes since that reply when possible:
+        {"Sequence": <n>, "Unchanged": true}
+        {"Sequence": <n>, "Added": [...], "Removed": [...]}
+        {"Sequence": <n>, "Volumes": [...]}  (full list)
+    See volume_changes.py.
     """
+    if opts and LIST_SINCE in opts:
+        if LIST_PAGE_SIZE in opts:
+            return err("Options {0} and {1} can't be used together".format(LIST_SINCE, LIST_PAGE_SIZE))
+        return listVMDKSince(tenant, opts[LIST_SINCE])
+
+    page_size = None
+    cursor = None
+    if opts and LIST_PAGE_SIZE in opts:
+        try:
+            page_size = int(opts[LIST_PAGE_SIZE])
+        except (TypeError, ValueError):
+            page_size = 0
+        if page_size <= 0 or page_size > MAX_LIST_PAGE_SIZE:
+            return err("Invalid {0} '{1}', expected 1 to {2}".format(
+                LIST_PAGE_SIZE, opts[LIST_PAGE_SIZE], MAX_LIST_PAGE_SIZE))
+        cursor = opts.get(LIST_CURSOR)
+        sequence = opts.get(LIST_SEQUENCE)
+        if sequence is not None:
+            try:
+                sequence = int(sequence)
+            except (TypeError, ValueError):
+                return err("Invalid {0} '{1}'".format(LIST_SEQUENCE, sequence))
+
+    if page_size is None:
+        return [{u'Name': name, u'Attributes': {}} for name in iter_volume_names(tenant)]
+
+    sequence, names = volumeChanges.get_list(tenant, sequence)
+    if cursor:
+        names = (name for name in names if name > cursor)
+    page = heapq.nsmallest(page_size + 1, names)
+    more = len(page) > page_size
+    page = page[:page_size]
+    return {u'Volumes': [{u'Name': name, u'Attributes': {}} for name in page],
+            u'Cursor': page[-1] if more else None,
+            u'Sequence': sequence}
+
+
+def listVMDKSince(tenant, since):
+    """ Returns changes of the volume list of tenant since sequence since, see listVMDK() """
+    if since is not None:
+        try:
+            since = int(since)
+        except (TypeError, ValueError):
+            return err("Invalid {0} '{1}'".format(LIST_SINCE, since))
+    sequence, names, added, removed = volumeChanges.list_since(tenant, since)
+    if names is not None:
+        return {u'Sequence': sequence,
+                u'Volumes': [{u'Name': name, u'Attributes': {}} for name in names]}
+    if not added and not removed:
+        return {u'Sequence': sequence, u'Unchanged': True}
+    return {u'Sequence': sequence,
+            u'Added': [{u'Name': name, u'Attributes': {}} for name in added],
+            u'Removed': [{u'Name': name} for name in removed]}
+
+
+def iter_volume_names(tenant):
+    """ Generator of fully qualified names of the volumes of tenant """
     vmdk_utils.init_datastoreCache(force=True)
-    vmdks = vmdk_utils.get_volumes(tenant)
     # build  fully qualified vol name for each volume found
-    return [{u'Name': get_full_vol_name(x['filename'], x['datastore']),
-             u'Attributes': {}} \
-            for x in vmdks]
+    return (get_full_vol_name(x['filename'], x['datastore'])
+            for x in vmdk_utils.iter_volumes(tenant))
 
 
+def scan_volumes():
+    """
+    Returns paths of all volumes on all datastores, and the tenant uuid to
+    name mapping, for volumeChanges rescans. The mapping is included as
+    lists are kept by tenant name, so a tenant removed and created again
+    with the same name (and a new uuid) changes its list.
+    """
+    vmdk_utils.init_datastoreCache(force=True)
+    error_info, tenant_names = auth_api.get_tenant_names()
+    if error_info:
+        logging.warning("scan_volumes: failed to get tenant names: %s", error_info.msg)
+        tenant_names = {}
+    paths = frozenset(os.path.join(x['path'], x['filename'])
+                      for x in vmdk_utils.iter_volumes("*"))
+    return paths, frozenset(tenant_names.items())
+
 
-def findVmByUuid(vm_uuid, is_vc_uuid=False):
+# Change sequence of the volume set, for "list" with LIST_SINCE
+volumeChanges = volume_changes.VolumeChanges(iter_volume_names, scan_volumes)
+
+
+def findVmByUuid(vm_uuid, is_vc_uuid=False, si=None):
     """
     Find VM by vm_uuid.
     is_vc_uuid should be true if vm_uuid is vc uuid, else it should be false.
     Return VM managed object, reconnect if needed. Throws if connection fails twice.
     Returns None if the uuid is not found
+    Uses the VM inventory cache, and asks hostd only if the VM is not there
+    (cache not loaded, or VM registered after the last inventory update).
+    The VM is bound to session si if passed (see bind_vm()).
     """
-    si = get_si()
-    vm = si.content.searchIndex.FindByUuid(None, vm_uuid, True, is_vc_uuid)
-    return vm
+    vm_info = vm_inventory.inventory.lookup(vm_uuid, is_vc_uuid)
+    if vm_info:
+        return bind_vm(vm_info.moref, si)
+    if si:
+        return si.content.searchIndex.FindByUuid(None, vm_uuid, True, is_vc_uuid)
+    with siPool.session() as pooled_si:
+        vm = pooled_si.content.searchIndex.FindByUuid(None, vm_uuid, True, is_vc_uuid)
+    if not vm:
+        return None
+    # The pooled session is used by other threads from now on
+    return bind_vm(vm)
+
+def bind_vm(vm, si=None):
+    '''
+    Return VM managed object vm bound to session si, or to the current main
+    session if si is None.
+    VMs from the inventory are bound to the session of the VM listener, and
+    VMs found over pooled sessions to those, either of which may have been
+    replaced or given to another thread since.
+    '''
+    if not si:
+        si = get_si()
+    return vim.VirtualMachine(vm._moId, si._stub) if si else vm
 
-def findVmByUuidChoice(bios_uuid, vc_uuid):
+def findVmByUuidChoice(bios_uuid, vc_uuid, si=None):
     """
     Returns vm object based on either vc_uuid, or bios_uuid.
     Returns None if failed to find.
+    The VM is bound to session si if passed, else to the main session.
     """
     vm = None
     if vc_uuid:
-        vm = findVmByUuid(vc_uuid, True)
+        vm = findVmByUuid(vc_uuid, True, si)
     if not vm: # either vc_uuid is not even passed, or we failed to find the VM by VC uuid:
         if vc_uuid:
             logging.info("Failed to find VM by VC UUID %s, trying BIOS UUID %s", vc_uuid, bios_uuid)
-        vm = findVmByUuid(bios_uuid, False)
+        vm = findVmByUuid(bios_uuid, False, si)
     if not vm: # can't find VM by VC or BIOS uuid
         logging.error("Failed to find VM by BIOS UUID either.")
         return None
@@ -744,6 +914,9 @@ def findVmByUuidChoice(bios_uuid, vc_uuid):
     return vm
 
 def vm_uuid2name(vm_uuid):
+    vm_info = vm_inventory.inventory.lookup_any(vm_uuid)
+    if vm_info and vm_info.name:
+        return vm_info.name
     vm = findVmByUuidChoice(vm_uuid, vm_uuid)
     if not vm or not vm.config:
         return None
@@ -760,22 +933,83 @@ def apply_action_VMDK(action, vmdk_path, vm_name, bios_uuid, vc_uuid):
     # note: vc_uuid is the last one to avoid reworkign tests which use positional args and
     # not aware of vc_uuid
     """Finds the VM and applies action(path,vm_MO) to it.
-    Returns json reply from action to pass upstairs, or json with 'err'"""
+    Returns json reply from action to pass upstairs, or json with 'err'
+    The VM is bound to a pooled session for the whole request, so reading its
+    config and reconfiguring it do not queue on the main session."""
 
     logging.info("*** %s: VMDK %s to VM '%s' , bios uuid = %s, VC uuid=%s)",
                  action.__name__, vmdk_path, vm_name, bios_uuid, vc_uuid)
-    vm = findVmByUuidChoice(bios_uuid, vc_uuid)
-    vcuuid = 'None'
-    if vc_uuid:
-        vcuuid = vc_uuid
+    with siPool.session() as si:
+        vm = findVmByUuidChoice(bios_uuid, vc_uuid, si)
+        vcuuid = 'None'
+        if vc_uuid:
+            vcuuid = vc_uuid
 
-    if not vm: # can't find VM by VC or BIOS uuid
-        return err("Failed to find VM object for %s (bios %s vc %s)" % (vm_name, bios_uuid, vcuuid))
+        if not vm: # can't find VM by VC or BIOS uuid
+            return err("Failed to find VM object for %s (bios %s vc %s)" % (vm_name, bios_uuid, vcuuid))
+
+        if vm.config.name != vm_name:
+            logging.warning("vm_name from vSocket '%s' does not match VM object '%s' ", vm_name, vm.config.name)
 
-    if vm.config.name != vm_name:
-        logging.warning("vm_name from vSocket '%s' does not match VM object '%s' ", vm_name, vm.config.name)
+        return action(vmdk_path, vm)
 
-    return action(vmdk_path, vm)
+
+# Directory mtimes may have a coarse granularity. Paths in a volume directory
+# changed less than this many seconds before they were resolved are not cached.
+VOL_PATH_MTIME_GRANULARITY = 2
+
+class VolPathCache(object):
+    """
+    Cache of vmdk paths resolved by executeRequest() with get_vol_path() and
+    vmdk_utils.get_vmdk_path(), keyed by (datastore, tenant name, volume name).
+    An entry is only used while the datastore cache is unchanged, and while
+    the volume directory has the mtime it had when the path was resolved, so
+    volumes and delta disks created or removed, and tenant directories
+    renamed, by anyone make it miss. Entries of volumes created or removed by
+    this service are also dropped right away (see forget()).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> (datastore cache generation, volume dir, dir mtime, vmdk path)
+        self._entries = {}
+
+    def get(self, key):
+        """ Return cached vmdk path for key, or None """
+        with self._lock:
+            entry = self._entries.get(key)
+        if not entry or entry[0] != vmdk_utils.datastoreCache.generation:
+            return None
+        if _dir_mtime(entry[1]) != entry[2]:
+            return None
+        return entry[3]
+
+    def put(self, key, generation, path, mtime, vmdk_path):
+        """
+        Cache vmdk_path resolved in directory path, which had mtime (ns)
+        before the resolution. generation is the datastore cache generation
+        taken before it.
+        """
+        if mtime is None or time.time() - mtime / 1e9 < VOL_PATH_MTIME_GRANULARITY:
+            return
+        with self._lock:
+            self._entries[key] = (generation, path, mtime, vmdk_path)
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+def _dir_mtime(path):
+    """ Return mtime (ns) of directory path, or None if it can't be checked """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+# Resolved vmdk paths of volumes used by requests
+volPathCache = VolPathCache()
 
 
 def get_vol_path(datastore, tenant_name=None, create=True):
@@ -869,7 +1103,7 @@ def parse_vol_name(full_vol_name):
     # Caveat: we block '-NNNNNN' in end of volume name to make sure that volume
     # name never conflicts with VMDK snapshot name (e.g. 'disk-000001.vmdk').
     # Note that N is a digit and there are exactly 6 of them (hardcoded in ESXi)
-    # vmdk_utils.py:list_vmdks() explicitly relies on this assumption.
+    # vmdk_utils.py:get_vmdk_path() explicitly relies on this assumption.
     if re.match(vmdk_utils.SNAP_NAME_REGEXP, vol_name):
         raise ValidationError("Volume names ending with '-NNNNNN' (where N is a digit) are not supported")
 
@@ -1011,7 +1245,8 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
     logging.debug("executeRequest: vm_datastore = %s, vm_datastore_url = %s",
                   vm_datastore, vm_datastore_url)
 
-    error_info, tenant_uuid, tenant_name = auth.get_tenant(vm_uuid)
+    with perf_stats.phase(perf_stats.PHASE_GET_TENANT):
+        error_info, tenant_uuid, tenant_name = auth.get_tenant(vm_uuid)
     force_detach = False
     if error_info:
         # For "docker volume ls", in case of error from the plugin Docker prints a list of cached volume names,
@@ -1074,7 +1309,7 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
         if cmd == "list":
             threadutils.set_thread_name("{0}-nolock-{1}".format(vm_name, cmd))
             # if default_datastore is not set, should return error
-            return listVMDK(tenant_name)
+            return listVMDK(tenant_name, opts)
 
         try:
             vol_name, datastore = parse_vol_name(full_vol_name)
@@ -1099,14 +1334,15 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
                       "default_datastore_url=%s datastore_url=%s",
                       vm_uuid, vm_name, tenant_uuid, tenant_name, default_datastore_url, datastore_url)
 
-    error_info = authorize_check(vm_uuid=vm_uuid,
-                                 datastore_url=datastore_url,
-                                 datastore=datastore,
-                                 cmd=cmd,
-                                 opts=opts,
-                                 use_default_ds=use_default_ds,
-                                 vm_datastore_url=vm_datastore_url,
-                                 vm_datastore=vm_datastore)
+    with perf_stats.phase(perf_stats.PHASE_AUTHORIZE):
+        error_info = authorize_check(vm_uuid=vm_uuid,
+                                     datastore_url=datastore_url,
+                                     datastore=datastore,
+                                     cmd=cmd,
+                                     opts=opts,
+                                     use_default_ds=use_default_ds,
+                                     vm_datastore_url=vm_datastore_url,
+                                     vm_datastore=vm_datastore)
     if error_info:
         return err(error_info)
 
@@ -1118,13 +1354,22 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
         # a real datastore_url instead of url of _VM_DS
         datastore_url = vm_datastore_url
 
-    path, errMsg = get_vol_path(datastore, tenant_name)
-    logging.debug("executeRequest for tenant %s with path %s", tenant_name, path)
-    if path is None:
-        return errMsg
-
-    vmdk_path = vmdk_utils.get_vmdk_path(path, vol_name)
+    with perf_stats.phase(perf_stats.PHASE_VOL_PATH):
+        vol_path_key = (datastore, tenant_name, vol_name)
+        vmdk_path = volPathCache.get(vol_path_key)
+        if vmdk_path:
+            logging.debug("executeRequest for tenant %s with cached vmdk path %s", tenant_name, vmdk_path)
+        else:
+            generation = vmdk_utils.datastoreCache.generation
+            path, errMsg = get_vol_path(datastore, tenant_name)
+            logging.debug("executeRequest for tenant %s with path %s", tenant_name, path)
+            if path is None:
+                return errMsg
 
+            # taken before the listing, so a change meanwhile makes the entry miss
+            mtime = _dir_mtime(path)
+            vmdk_path = vmdk_utils.get_vmdk_path(path, vol_name)
+            volPathCache.put(vol_path_key, generation, path, mtime, vmdk_path)
 
     # Set up locking for volume operations.
     # Lock name defaults to combination of DS,tenant name and vol name
@@ -1132,9 +1377,12 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
     # Set thread name to vm_name-lockname
     threadutils.set_thread_name("{0}-{1}".format(vm_name, lockname))
 
-    # Get a lock for the volume
+    # Get a lock for the volume. "get" only reads the volume and shares the lock
+    # with other "get" requests, all other commands need it exclusive.
+    volume_lock = lockManager.get_rwlock(lockname)
+    lock_mode = volume_lock.shared if cmd == "get" else volume_lock.exclusive
     logging.debug("Trying to acquire lock: %s", lockname)
-    with lockManager.get_lock(lockname):
+    with perf_stats.timed_lock(lock_mode):
         logging.debug("Acquired lock: %s", lockname)
 
         if cmd == "get":
@@ -1156,63 +1404,236 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
                                   tenant_uuid=tenant_uuid,
                                   datastore_url=datastore_url)
 
-        # For attach/detach reconfigure tasks, hold a per vm lock.
+        # Attach/detach reconfigure tasks are serialized per VM by its
+        # reconfig lock, and batched by reconfigBatcher while one is running.
         elif cmd == "attach":
-            with lockManager.get_lock(vm_uuid):
-                response = attachVMDK(vmdk_path=vmdk_path, vm_name=vm_name,
-                                      bios_uuid=vm_uuid, vc_uuid=vc_uuid)
+            response = attachVMDK(vmdk_path=vmdk_path, vm_name=vm_name,
+                                  bios_uuid=vm_uuid, vc_uuid=vc_uuid)
         elif cmd == "detach":
-            with lockManager.get_lock(vm_uuid):
-                response = detachVMDK(vmdk_path=vmdk_path, vm_name=vm_name,
-                                      bios_uuid=vm_uuid, vc_uuid=vc_uuid)
+            response = detachVMDK(vmdk_path=vmdk_path, vm_name=vm_name,
+                                  bios_uuid=vm_uuid, vc_uuid=vc_uuid)
         else:
             return err("Unknown command:" + cmd)
 
+        if cmd in ("create", "remove"):
+            # also after failures, which may leave a volume behind
+            volPathCache.forget(vol_path_key)
+            volumeChanges.bump()
+
     logging.debug("Released lock: %s", lockname)
     return response
 
+def connect_local_si():
+    '''
+    Return a new connection to the local SI, or None if connection fails
+    '''
+    try:
+        logging.info("Connecting to the local Service Instance as 'dcui' ")
+
+        # Connect to local server as user "dcui" since this is the Admin that does not lose its
+        # Admin permissions even when the host is in lockdown mode. User "dcui" does not have a
+        # password - it is used by local application DCUI (Direct Console User Interface)
+        # Version must be set to access newer features, such as VSAN.
+        si = pyVim.connect.Connect(
+            host='localhost',
+            user='dcui',
+            version=newestVersions.Get('vim'))
+    except Exception as e:
+        logging.exception("Failed to create the local Service Instance as 'dcui', continuing... : ")
+        return None
+
+    # set out ID in context to be used in request - so we'll see it in logs
+    reqCtx = VmomiSupport.GetRequestContext()
+    reqCtx["realUser"] = 'dvolplug'
+    _connected_sis.add(si)
+    return si
+
+def disconnect_local_si(si):
+    '''
+    Log out a session returned by connect_local_si() which is no longer used.
+    Best effort, the session is usually broken already.
+    '''
+    _connected_sis.discard(si)
+    try:
+        pyVim.connect.Disconnect(si)
+    except Exception as ex:
+        logging.debug("Failed to disconnect Service Instance session: %s", ex)
+
+@atexit.register
+def disconnect_all_si():
+    ''' Log out all sessions still connected at exit '''
+    for si in list(_connected_sis):
+        disconnect_local_si(si)
+
 def connectLocalSi():
     '''
 	Initialize a connection to the local SI
 	'''
     global _service_instance
     if not _service_instance:
-        try:
-            logging.info("Connecting to the local Service Instance as 'dcui' ")
-
-            # Connect to local server as user "dcui" since this is the Admin that does not lose its
-            # Admin permissions even when the host is in lockdown mode. User "dcui" does not have a
-            # password - it is used by local application DCUI (Direct Console User Interface)
-            # Version must be set to access newer features, such as VSAN.
-            _service_instance = pyVim.connect.Connect(
-                host='localhost',
-                user='dcui',
-                version=newestVersions.Get('vim'))
-        except Exception as e:
-            logging.exception("Failed to create the local Service Instance as 'dcui', continuing... : ")
-            return
-
-    # set out ID in context to be used in request - so we'll see it in logs
-    reqCtx = VmomiSupport.GetRequestContext()
-    reqCtx["realUser"] = 'dvolplug'
-    atexit.register(pyVim.connect.Disconnect, _service_instance)
+        _service_instance = connect_local_si()
 
 def get_si():
     '''
-	Return a connection to the local SI
+	Return a connection to the local SI.
+	Liveness is tracked by si_keepalive() and by callers reporting connection
+	failures with mark_si_stale(), so this only reconnects a session which is
+	known to be stale.
 	'''
+    global _service_instance, _si_stale
+    si = _service_instance
+    if si and not _si_stale:
+        return si
+
     with lockManager.get_lock('siLock'):
-        global _service_instance
-        try:
-            _service_instance.CurrentTime()
-        except:
-            # service_instance is invalid (could be stale)
+        if _si_stale or not _service_instance:
+            # service_instance is invalid (stale)
             # reset it to None and try to connect again.
+            stale_si = _service_instance
             _service_instance = None
+            _si_stale = False
+            if stale_si:
+                disconnect_local_si(stale_si)
             connectLocalSi()
 
         return _service_instance
 
+def mark_si_stale(si=None):
+    '''
+	Mark the local SI connection stale, so that the next get_si() reconnects.
+	If si is passed, only mark it if it is still the current connection.
+	'''
+    global _si_stale
+    if si is None or si is _service_instance:
+        if not _si_stale:
+            logging.info("Local Service Instance session is stale, will reconnect")
+        _si_stale = True
+
+def is_connection_error(ex):
+    '''
+    Return True if ex means the connection to hostd is broken or unauthenticated.
+    Other OSErrors (e.g. from file operations) are not connection errors.
+    '''
+    return isinstance(ex, (ConnectionError, socket.timeout, socket.gaierror,
+                           http.client.HTTPException, vim.fault.NotAuthenticated))
+
+def si_keepalive():
+    '''
+	Keepalive thread: check liveness of the hostd sessions every SI_KEEPALIVE_INTERVAL
+	seconds. Keeps idle sessions from expiring and marks broken ones stale.
+	'''
+    threadutils.set_thread_name("SiKeepalive")
+    while not stopBarrier:
+        time.sleep(SI_KEEPALIVE_INTERVAL)
+        si = _service_instance
+        if si and not _si_stale:
+            try:
+                si.CurrentTime()
+            except Exception as ex:
+                logging.warning("Local Service Instance liveness check failed: %s", ex)
+                mark_si_stale(si)
+        siPool.check_idle()
+
+class ServiceInstancePool(object):
+    """
+    Pool of local hostd sessions for request threads.
+    A session is checked out for the duration of a vSphere call sequence
+    ('with siPool.session() as si:'), so calls from concurrent requests go
+    over different connections instead of queueing on one. Idle sessions are
+    health checked by si_keepalive(), and a session failing with a connection
+    error is dropped and replaced by a new one on a later checkout.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._cond = threading.Condition(threadutils.get_lock())
+        # idle connected sessions
+        self._idle = []
+        # number of sessions checked out or idle
+        self._count = 0
+
+    def checkout(self):
+        """
+        Return a live session, waiting for one to be checked in if all are in use.
+        Returns None if a session cannot be established.
+        """
+        with self._cond:
+            while not self._idle and self._count >= self._size:
+                self._cond.wait()
+            si = self._idle.pop() if self._idle else None
+            if not si:
+                self._count += 1
+
+        if not si:
+            si = connect_local_si()
+            if not si:
+                self._discard()
+        return si
+
+    def checkin(self, si):
+        """ Return a session obtained from checkout() to the pool """
+        if not si:
+            return
+        with self._cond:
+            self._idle.append(si)
+            self._cond.notify()
+
+    def _discard(self, si=None):
+        """
+        Forget a checked out session, so a new one can be created in its place.
+        si (if any) is disconnected.
+        """
+        with self._cond:
+            self._count -= 1
+            self._cond.notify()
+        if si:
+            disconnect_local_si(si)
+
+    def check_idle(self):
+        """
+        Check liveness of idle sessions and drop the broken ones.
+        Sessions are not locked while checked, as they are taken out of the pool.
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for si in idle:
+            try:
+                si.CurrentTime()
+            except Exception as ex:
+                logging.info("Pooled Service Instance session is stale, dropping it: %s", ex)
+                self._discard(si)
+                continue
+            self.checkin(si)
+
+    @contextmanager
+    def session(self):
+        """
+        Check out a session for the enclosed block. Falls back to get_si() on failure.
+        A session that fails with a connection error is dropped rather than returned.
+        """
+        si = self.checkout()
+        if not si:
+            si = get_si()
+            try:
+                yield si
+            except Exception as ex:
+                if is_connection_error(ex):
+                    mark_si_stale(si)
+                raise
+            return
+        try:
+            yield si
+        except Exception as ex:
+            if is_connection_error(ex):
+                logging.info("Pooled Service Instance session failed, dropping it: %s", ex)
+                self._discard(si)
+                si = None
+            raise
+        finally:
+            self.checkin(si)
+
+siPool = ServiceInstancePool(SI_POOL_SIZE)
+
 def is_service_available():
     """
     Check if connection to hostd service is available
@@ -1225,41 +1646,11 @@ def get_datastore_names_list():
     """returns names of known datastores"""
     return [i[0] for i in vmdk_utils.get_datastores()]
 
-def findDeviceByPath(vmdk_path, vm):
-    logging.debug("findDeviceByPath: Looking for device {0}".format(vmdk_path))
-    for d in vm.config.hardware.device:
-        if type(d) != vim.vm.device.VirtualDisk:
-            continue
-
-        # Disks of all backing have a backing object with a filename attribute.
-        # The filename identifies the virtual disk by name and can be used
-        # to match with the given volume name.
-        # Filename format is as follows:
-        #   "[<datastore name>] <parent-directory>/tenant/<vmdk-descriptor-name>"
-        logging.debug("d.backing.fileName %s", d.backing.fileName)
-        ds, disk_path = d.backing.fileName.rsplit("]", 1)
-        datastore = ds[1:]
-        backing_disk = disk_path.lstrip()
-        logging.debug("findDeviceByPath: datastore=%s, backing_disk=%s", datastore, backing_disk)
-
-        # Construct the parent dir and vmdk name, resolving
-        # links if any.
-        dvol_dir = os.path.dirname(vmdk_path)
-        datastore_prefix = os.path.realpath(os.path.join("/vmfs/volumes", datastore)) + '/'
-        real_vol_dir = os.path.realpath(dvol_dir).replace(datastore_prefix, "")
-        virtual_disk = os.path.join(real_vol_dir, os.path.basename(vmdk_path))
-        logging.debug("dvol_dir=%s datastore_prefix=%s real_vol_dir=%s", dvol_dir, datastore_prefix,real_vol_dir)
-        logging.debug("backing_disk=%s virtual_disk=%s", backing_disk, virtual_disk)
-        if virtual_disk == backing_disk:
-            logging.debug("findDeviceByPath: MATCH: %s", backing_disk)
-            return d
-    return None
-
 # Find the PCI slot number
-def get_controller_pci_slot(vm, pvscsi, key_offset):
+def get_controller_pci_slot(topology, pvscsi, key_offset):
     ''' Return PCI slot number of the given PVSCSI controller
     Input parameters:
-    vm: VM configuration
+    topology: VmTopology of the VM
     pvscsi: given PVSCSI controller
     key_offset: offset from the bus number, controller_key - key_offset
     is equal to the slot number of this given PVSCSI controller
@@ -1270,12 +1661,9 @@ def get_controller_pci_slot(vm, pvscsi, key_offset):
        # Slot number is got from from the VM config.
        key = 'scsi{0}.pciSlotNumber'.format(pvscsi.key -
                                             key_offset)
-       slot = [cfg for cfg in vm.config.extraConfig \
-               if cfg.key.lower() == key.lower()]
-       # If the given controller exists
-       if slot:
-          slot_num = slot[0].value
-       else:
+       slot_num = topology.get_extra_config(key)
+       # If the given controller doesn't exist
+       if slot_num is None:
           return None
     # Check if the PCI slot is on the primary or secondary bus
     # and find the slot number for the bridge on the secondary
@@ -1287,11 +1675,8 @@ def get_controller_pci_slot(vm, pvscsi, key_offset):
         bus = bus - 1
         # Get PCI bridge slot number
         key = 'pciBridge{0}.pciSlotNumber'.format(bus)
-        bridge_slot = [cfg for cfg in vm.config.extraConfig \
-                       if cfg.key.lower() == key.lower()]
-        if bridge_slot:
-            slot_num = bridge_slot[0].value
-        else:
+        slot_num = topology.get_extra_config(key)
+        if slot_num is None:
             # We didn't find a PCI bridge for this bus.
             return None
         bus = (int(slot_num) >> PCI_BUS_BITS) & PCI_BUS_MASK
@@ -1299,6 +1684,111 @@ def get_controller_pci_slot(vm, pvscsi, key_offset):
     bus_num = '{0}.{1}'.format(hex(int(slot_num))[2:], func)
     return [str(orig_slot_num), bus_num]
 
+class VmTopology(object):
+    '''
+    In memory model of the VM devices used for disk placement: SCSI controllers,
+    unit numbers in use, disks by backing file and PCI slot configuration.
+    Built from a single fetch of vm.config.
+    '''
+
+    def __init__(self, config):
+        self.uuid = config.uuid
+        self.change_version = config.changeVersion
+        self.devices = list(config.hardware.device)
+        # extraConfig keys are matched case insensitive
+        self._extra_config = dict((opt.key.lower(), opt.value) for opt in config.extraConfig)
+        # datastore name -> resolved datastore path prefix
+        self._datastore_prefixes = {}
+
+    @property
+    def controllers(self):
+        ''' All SCSI controllers (pvscsi, lsi logic, whatever) '''
+        return [d for d in self.devices if isinstance(d, vim.VirtualSCSIController)]
+
+    @property
+    def pvscsi(self):
+        return [d for d in self.devices if type(d) == vim.ParaVirtualSCSIController]
+
+    def get_extra_config(self, key):
+        return self._extra_config.get(key.lower())
+
+    def used_units(self, controller_key):
+        ''' Return the set of disk unit numbers in use on the controller '''
+        return set([dev.unitNumber
+                    for dev in self.devices
+                    if type(dev) == vim.VirtualDisk and dev.controllerKey == controller_key])
+
+    def _datastore_prefix(self, datastore):
+        prefix = self._datastore_prefixes.get(datastore)
+        if prefix is None:
+            prefix = os.path.realpath(os.path.join("/vmfs/volumes", datastore)) + '/'
+            self._datastore_prefixes[datastore] = prefix
+        return prefix
+
+    def find_disk(self, vmdk_path):
+        ''' Return the VirtualDisk backed by vmdk_path, or None '''
+        logging.debug("find_disk: Looking for device %s", vmdk_path)
+        # Construct the parent dir and vmdk name, resolving links if any.
+        real_vol_dir = os.path.realpath(os.path.dirname(vmdk_path))
+        vmdk_name = os.path.basename(vmdk_path)
+        for d in self.devices:
+            if type(d) != vim.vm.device.VirtualDisk:
+                continue
+
+            # Disks of all backing have a backing object with a filename attribute.
+            # The filename identifies the virtual disk by name and can be used
+            # to match with the given volume name.
+            # Filename format is as follows:
+            #   "[<datastore name>] <parent-directory>/tenant/<vmdk-descriptor-name>"
+            ds, disk_path = d.backing.fileName.rsplit("]", 1)
+            datastore = ds[1:]
+            backing_disk = disk_path.lstrip()
+            virtual_disk = os.path.join(real_vol_dir.replace(self._datastore_prefix(datastore), ""),
+                                        vmdk_name)
+            if virtual_disk == backing_disk:
+                logging.debug("find_disk: MATCH: %s", backing_disk)
+                return d
+        return None
+
+class VmTopologyCache(object):
+    '''
+    VmTopology per VM, so that attach/detach placement does not fetch the VM
+    config for every request.
+    A cached topology is dropped after reconfigures done by us and when the
+    VM is unregistered, and rebuilt when the VM listener reports a different
+    config change version (see vm_inventory), i.e. once the VM config changed.
+    Without the VM listener (inventory not ready) the topology is rebuilt on
+    every use.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # VM moId -> VmTopology
+        self._topologies = {}
+
+    def get(self, vm):
+        ''' Return VmTopology for vm, built from vm.config if not cached or stale '''
+        key = vm._moId
+        vm_info = vm_inventory.inventory.get(key)
+        with self._lock:
+            topology = self._topologies.get(key)
+        if topology and vm_info and vm_info.change_version == topology.change_version:
+            return topology
+        return self.refresh(vm)
+
+    def refresh(self, vm):
+        ''' Rebuild VmTopology for vm from its current config '''
+        topology = VmTopology(vm.config)
+        with self._lock:
+            self._topologies[vm._moId] = topology
+        return topology
+
+    def forget(self, vm):
+        with self._lock:
+            self._topologies.pop(vm._moId, None)
+
+vmTopologies = VmTopologyCache()
+
 def dev_info(unit_number, pci_bus_slot_number):
     '''Return a dictionary with Unit/Bus for the vmdk (or error)'''
     return {'Unit': str(unit_number),
@@ -1307,53 +1797,59 @@ def dev_info(unit_number, pci_bus_slot_number):
 
 def reset_vol_meta(vmdk_path):
     '''Clears metadata for vmdk_path'''
-    vol_meta = kv.getAll(vmdk_path)
-    if not vol_meta:
-       vol_meta = {}
     logging.debug("Reseting meta-data for disk=%s", vmdk_path)
-    if set(vol_meta.keys()) & {kv.STATUS, kv.ATTACHED_VM_UUID}:
-          logging.debug("Old meta-data for %s was (status=%s VM uuid=%s)",
-                        vmdk_path, vol_meta[kv.STATUS],
-                        vol_meta[kv.ATTACHED_VM_UUID])
-    vol_meta[kv.STATUS] = kv.DETACHED
-    vol_meta[kv.ATTACHED_VM_UUID] = None
-    vol_meta[kv.ATTACHED_VM_NAME] = None
-    if not kv.setAll(vmdk_path, vol_meta):
+
+    def reset_meta(vol_meta):
+        if set(vol_meta.keys()) & {kv.STATUS, kv.ATTACHED_VM_UUID}:
+              logging.debug("Old meta-data for %s was (status=%s VM uuid=%s)",
+                            vmdk_path, vol_meta.get(kv.STATUS),
+                            vol_meta.get(kv.ATTACHED_VM_UUID))
+        vol_meta[kv.STATUS] = kv.DETACHED
+        vol_meta[kv.ATTACHED_VM_UUID] = None
+        vol_meta[kv.ATTACHED_VM_NAME] = None
+
+    if not kv.update(vmdk_path, reset_meta, missing_ok=True):
        msg = "Failed to save volume metadata for {0}.".format(vmdk_path)
        logging.warning("reset_vol_meta: " + msg)
        return err(msg)
 
 def setStatusAttached(vmdk_path, vm, vm_dev_info=None):
     '''Sets metadata for vmdk_path to (attached, attachedToVM=uuid'''
+    # Fetch VM properties before the metadata update, not while holding the volume lock
+    vm_config = vm.config
     logging.debug("Set status=attached disk=%s VM name=%s uuid=%s", vmdk_path,
-                  vm.config.name, vm.config.uuid)
-    vol_meta = kv.getAll(vmdk_path)
-    if not vol_meta:
-        vol_meta = {}
-    vol_meta[kv.STATUS] = kv.ATTACHED
-    vol_meta[kv.ATTACHED_VM_UUID] = vm.config.instanceUuid
-    vol_meta[kv.ATTACHED_VM_NAME] = vm.config.name
-    if vm_dev_info:
-        vol_meta[kv.ATTACHED_VM_DEV] = vm_dev_info
-    if not kv.setAll(vmdk_path, vol_meta):
+                  vm_config.name, vm_config.uuid)
+
+    def set_attached(vol_meta):
+        vol_meta[kv.STATUS] = kv.ATTACHED
+        vol_meta[kv.ATTACHED_VM_UUID] = vm_config.instanceUuid
+        vol_meta[kv.ATTACHED_VM_NAME] = vm_config.name
+        if vm_dev_info:
+            vol_meta[kv.ATTACHED_VM_DEV] = vm_dev_info
+
+    if not kv.update(vmdk_path, set_attached, missing_ok=True):
         logging.warning("Attach: Failed to save Disk metadata for %s", vmdk_path)
 
 
 def setStatusDetached(vmdk_path, key=None, value=None):
-    '''Sets metadata for vmdk_path to "detached"'''
+    '''
+    Sets metadata for vmdk_path to "detached".
+    If key is passed, only if metadata has no key or key has the given value.
+    '''
     logging.debug("Set status=detached disk=%s", vmdk_path)
-    vol_meta = kv.getAll(vmdk_path)
-    if not vol_meta:
-        vol_meta = {}
-    vol_meta[kv.STATUS] = kv.DETACHED
-    # If attachedVMName is present, so is attachedVMUuid
-    try:
-        del vol_meta[kv.ATTACHED_VM_UUID]
-        del vol_meta[kv.ATTACHED_VM_NAME]
-        del vol_meta[kv.ATTACHED_VM_DEV]
-    except:
-        pass
-    if not kv.setAll(vmdk_path, vol_meta, key, value):
+
+    def set_detached(vol_meta):
+        vol_meta[kv.STATUS] = kv.DETACHED
+        # If attachedVMName is present, so is attachedVMUuid
+        try:
+            del vol_meta[kv.ATTACHED_VM_UUID]
+            del vol_meta[kv.ATTACHED_VM_NAME]
+            del vol_meta[kv.ATTACHED_VM_DEV]
+        except:
+            pass
+
+    expect = {key: value} if key else None
+    if not kv.update(vmdk_path, set_detached, expect=expect, missing_ok=True):
         logging.warning("Detach: Failed to save Disk metadata for %s", vmdk_path)
 
 
@@ -1437,32 +1933,28 @@ def add_pvscsi_controller(vm, controllers, max_scsi_controllers, offset_from_bus
     logging.debug("Added a PVSCSI controller, controller_id=%d", controller_key)
     return controller_key, None
 
-def find_disk_slot_in_controller(vm, devices, pvsci, idx, offset_from_bus_number):
+def find_disk_slot_in_controller(topology, pvsci, idx, offset_from_bus_number, reserved=frozenset()):
     '''
     Find an empty disk slot in the given controller, return disk_slot if an empty slot
-    can be found, otherwise, return None
+    can be found, otherwise, return None.
+    reserved is a set of (controller_key, unit_number) already taken by pending changes.
     '''
     disk_slot = None
     controller_key = pvsci[idx].key
-    taken = set([dev.unitNumber
-             for dev in devices
-             if type(dev) == vim.VirtualDisk and dev.controllerKey ==
-             controller_key])
+    taken = topology.used_units(controller_key)
+    taken |= set([unit for key, unit in reserved if key == controller_key])
     # search in 15 slots, with unit_number 7 reserved for scsi controller
     avail_slots = (set(range(0, 7)) | set(range(8, PVSCSI_MAX_TARGETS))) - taken
     logging.debug("idx=%d controller_key=%d avail_slots=%d", idx, controller_key, len(avail_slots))
 
     if len(avail_slots) != 0:
         disk_slot = avail_slots.pop()
-        pci_slot_number = get_controller_pci_slot(vm, pvsci[idx],
-                                                  offset_from_bus_number)
-
         logging.debug("Find an available slot: controller_key = %d slot = %d", controller_key, disk_slot)
     else:
         logging.warning("No available slot in this controller: controller_key = %d", controller_key)
     return disk_slot
 
-def find_available_disk_slot(vm, devices, pvsci, offset_from_bus_number):
+def find_available_disk_slot(topology, pvsci, offset_from_bus_number, reserved=frozenset()):
     '''
     Iterate through all the existing PVSCSI controllers attached to a VM to find an empty
     disk slot. Return disk_slot is an empty slot can be found, otherwise, return None
@@ -1470,20 +1962,115 @@ def find_available_disk_slot(vm, devices, pvsci, offset_from_bus_number):
     idx = 0
     disk_slot = None
     while ((disk_slot is None) and (idx < len(pvsci))):
-            disk_slot = find_disk_slot_in_controller(vm, devices, pvsci, idx, offset_from_bus_number)
+            disk_slot = find_disk_slot_in_controller(topology, pvsci, idx,
+                                                     offset_from_bus_number, reserved)
             if (disk_slot is None):
                 idx = idx + 1;
     return idx, disk_slot
 
-def disk_attach(vmdk_path, vm):
+class DiskChange(object):
     '''
-    Attaches *existing* disk to a vm on a PVSCI controller
-    (we need PVSCSI to avoid SCSI rescans in the guest)
-    return error or unit:bus numbers of newly attached disk.
+    Disk attach or detach requested for a VM, and its result.
+    Changes for the same VM are collected by VmReconfigBatcher and applied
+    with a single ReconfigVM_Task.
+    '''
+
+    def __init__(self, attach, vmdk_path):
+        self.attach = attach
+        self.vmdk_path = vmdk_path
+        # VirtualDeviceConfigSpec to apply, None if there is nothing to reconfigure
+        self.spec = None
+        # Unit/Bus info for the disk being attached
+        self.dev_info = None
+        # Volume metadata status captured before attach, used for error messages
+        self.kv_status_attached = False
+        self.kv_uuid = None
+        self.attached_vm_name = None
+        # Reply for the requester: dev_info for attach, None for detach or err()
+        self.result = None
+        self.completed = False
+
+    def finish(self, result):
+        self.spec = None
+        self.result = result
+        self.completed = True
+
+
+class DiskChangeBatch(object):
+    ''' Disk changes collected for one VM while it is being reconfigured '''
+
+    def __init__(self):
+        self.changes = []
+        self.done = threading.Event()
+
+
+class VmReconfigBatcher(object):
     '''
+    Coalesces concurrent attach/detach requests for the same VM.
+    A request for a VM without a reconfigure in progress is applied right away.
+    Requests coming in while a reconfigure of the VM is in progress are
+    collected, and the first of them applies them all with one reconfigure
+    once the VM is free, then wakes up the other requesters.
+    Reconfigures of a VM are serialized by its "reconfig.<moId>" lock (see vm_reconfig_lock()).
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # VM moId -> DiskChangeBatch being collected
+        self._batches = {}
+
+    def apply(self, vm, change):
+        ''' Queue change for vm, wait for it to be applied and return its result '''
+        key = vm._moId
+        with self._lock:
+            batch = self._batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._batches[key] = DiskChangeBatch()
+            batch.changes.append(change)
+
+        if not leader:
+            batch.done.wait()
+            return change.result
 
+        try:
+            # Changes queued while waiting for a reconfigure in progress join the batch
+            with perf_stats.timed_lock(vm_reconfig_lock(vm), perf_stats.PHASE_VM_LOCK_WAIT):
+                with self._lock:
+                    del self._batches[key]
+                logging.debug("Applying %d disk change(s) to VM %s", len(batch.changes), key)
+                apply_disk_changes(vm, batch.changes)
+        except Exception as ex:
+            logging.exception("Failed to apply disk changes to VM %s:", key)
+            for c in batch.changes:
+                if not c.completed:
+                    c.finish(err("Failed to reconfigure VM: {0}".format(repr(ex))))
+        finally:
+            with self._lock:
+                if self._batches.get(key) is batch:
+                    del self._batches[key]
+            batch.done.set()
+        return change.result
+
+def vm_reconfig_lock(vm):
+    ''' Return the lock serializing device reconfigures of vm '''
+    return lockManager.get_lock("reconfig.{0}".format(vm._moId))
+
+reconfigBatcher = VmReconfigBatcher()
+
+def prepare_disk_attach(vm, topology, change, reserved):
+    '''
+    Place the disk for an attach change on a PVSCSI controller (adding a controller
+    if needed) and set change.spec, or finish the change if no reconfigure is needed.
+    Slots used by the change are added to reserved.
+    Returns the VM topology, refreshed if a controller was added.
+    '''
+    vmdk_path = change.vmdk_path
     kv_status_attached, kv_uuid, attach_mode, attached_vm_name = getStatusAttached(vmdk_path)
     logging.info("Attaching {0} as {1}".format(vmdk_path, attach_mode))
+    change.kv_status_attached = kv_status_attached
+    change.kv_uuid = kv_uuid
+    change.attached_vm_name = attached_vm_name
 
     if kv_status_attached:
        log_attached_volume(vmdk_path, kv_uuid, attached_vm_name)
@@ -1497,40 +2084,36 @@ def disk_attach(vmdk_path, vm):
     offset_from_bus_number = 1000
     max_scsi_controllers = 4
 
-
-    devices = vm.config.hardware.device
     # get all scsi controllers (pvsci, lsi logic, whatever)
-    controllers = [d for d in devices
-                   if isinstance(d, vim.VirtualSCSIController)]
+    controllers = topology.controllers
 
     # Check if this disk is already attached, and if it is - skip the disk
     # attach and the checks on attaching a controller if needed.
-    device = findDeviceByPath(vmdk_path, vm)
+    device = topology.find_disk(vmdk_path)
     if device:
         # Disk is already attached.
         logging.warning("Disk %s already attached. VM=%s",
-                        vmdk_path, vm.config.uuid)
+                        vmdk_path, topology.uuid)
         setStatusAttached(vmdk_path, vm)
         # Get that controller to which the device is configured for
         pvsci = [d for d in controllers
                    if type(d) == vim.ParaVirtualSCSIController and
                       d.key == device.controllerKey]
 
-        return dev_info(device.unitNumber,
-                        get_controller_pci_slot(vm, pvsci[0],
-                                                offset_from_bus_number))
-
+        change.finish(dev_info(device.unitNumber,
+                               get_controller_pci_slot(topology, pvsci[0],
+                                                       offset_from_bus_number)))
+        return topology
 
     # Disk isn't attached, make sure we have a PVSCI and add it if we don't
     # check if we already have a pvsci one
-    pvsci = [d for d in controllers
-             if type(d) == vim.ParaVirtualSCSIController]
+    pvsci = topology.pvscsi
     disk_slot = None
     if len(pvsci) > 0:
-        idx, disk_slot = find_available_disk_slot(vm, devices, pvsci, offset_from_bus_number);
+        idx, disk_slot = find_available_disk_slot(topology, pvsci, offset_from_bus_number, reserved)
         if (disk_slot is not None):
             controller_key = pvsci[idx].key
-            pci_slot_number = get_controller_pci_slot(vm, pvsci[idx],
+            pci_slot_number = get_controller_pci_slot(topology, pvsci[idx],
                                                       offset_from_bus_number)
             logging.debug("Find an available disk slot, controller_key=%d, slot_id=%d",
                           controller_key, disk_slot)
@@ -1539,8 +2122,9 @@ def disk_attach(vmdk_path, vm):
         disk_slot = 0  # starting on a fresh controller
         if len(controllers) >= max_scsi_controllers:
             msg = "Failed to place new disk - The maximum number of supported volumes has been reached."
-            logging.error(msg + " VM=%s", vm.config.uuid)
-            return err(msg)
+            logging.error(msg + " VM=%s", topology.uuid)
+            change.finish(err(msg))
+            return topology
 
         logging.info("Adding a PVSCSI controller")
 
@@ -1548,20 +2132,19 @@ def disk_attach(vmdk_path, vm):
                                                         offset_from_bus_number)
 
         if (ret_err):
-            return ret_err
-
-        # Find the controller just added
-        devices = vm.config.hardware.device
-        pvsci = [d for d in devices
-                 if type(d) == vim.ParaVirtualSCSIController and
-                 d.key == controller_key]
-        pci_slot_number = get_controller_pci_slot(vm, pvsci[0],
+            change.finish(ret_err)
+            return topology
+
+        # Find the controller just added, with the PCI slot assigned by hostd
+        topology = vmTopologies.refresh(vm)
+        pvsci = [d for d in topology.pvscsi if d.key == controller_key]
+        pci_slot_number = get_controller_pci_slot(topology, pvsci[0],
                                                   offset_from_bus_number)
         logging.info("Added a PVSCSI controller, controller_key=%d pci_slot_number=%s",
                       controller_key, pci_slot_number[0])
 
     # add disk as independent, so it won't be snapshotted with the Docker VM
-    disk_spec = vim.VirtualDeviceConfigSpec(
+    change.spec = vim.VirtualDeviceConfigSpec(
         operation='add',
         device=
         vim.VirtualDisk(backing=vim.VirtualDiskFlatVer2BackingInfo(
@@ -1573,38 +2156,117 @@ def disk_attach(vmdk_path, vm):
                             summary="dockerDataVolume", ),
                         unitNumber=disk_slot,
                         controllerKey=controller_key, ), )
-    disk_changes = []
-    disk_changes.append(disk_spec)
+    change.dev_info = dev_info(disk_slot, pci_slot_number)
+    reserved.add((controller_key, disk_slot))
+    return topology
 
-    spec = vim.vm.ConfigSpec()
-    spec.deviceChange = disk_changes
+def prepare_disk_detach(vm, change):
+    '''
+    Set change.spec to remove the disk, or finish the change if the disk is not attached
+    Returns the VM topology.
+    '''
+    topology = vmTopologies.get(vm)
+    device = topology.find_disk(change.vmdk_path)
 
-    try:
-        si = get_si()
-        wait_for_tasks(si, [vm.ReconfigVM_Task(spec=spec)])
-    except vim.fault.VimFault as ex:
-        msg = ex.msg
+    if not device:
+       # Could happen if the disk attached to a different VM - attach fails
+       # and docker will insist to sending "unmount/detach" which also fails.
+       # Or Plugin retrying operation due to socket errors #1076
+       # Return success since disk is anyway not attached
+       logging.warning("*** Detach disk={0} not found. VM={1}".format(
+                       change.vmdk_path, topology.uuid))
+       change.finish(None)
+       return topology
+
+    change.spec = vim.vm.device.VirtualDeviceSpec()
+    change.spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.remove
+    change.spec.device = device
+    return topology
+
+def complete_disk_change(vm, change):
+    ''' Update volume metadata after the change was applied to the VM '''
+    if change.attach:
+        setStatusAttached(change.vmdk_path, vm, change.dev_info)
+        logging.info("Disk %s successfully attached. controller pci_slot_number=%s, disk_slot=%s",
+                     change.vmdk_path, change.dev_info['ControllerPciSlotNumber'],
+                     change.dev_info['Unit'])
+        change.finish(change.dev_info)
+    else:
+        setStatusDetached(change.vmdk_path)
+        logging.info("Disk detached %s", change.vmdk_path)
+        change.finish(None)
+
+def fail_disk_change(vm, change, msg):
+    ''' Finish the change with an error after the reconfigure failed '''
+    if change.attach:
         # Use metadata (KV) for extra logging
-        if kv_status_attached:
+        if change.kv_status_attached:
             # KV  claims we are attached to a different VM'.
-            cur_vm = vm_uuid2name(kv_uuid)
+            cur_vm = vm_uuid2name(change.kv_uuid)
 
             if not cur_vm:
-                cur_vm = attached_vm_name
-            msg += " disk {0} already attached to VM={1}".format(vmdk_path,
+                cur_vm = change.attached_vm_name
+            msg += " disk {0} already attached to VM={1}".format(change.vmdk_path,
                                                                  cur_vm)
-            if kv_uuid == vm.config.uuid:
+            if change.kv_uuid == vm.config.uuid:
                 msg += "(Current VM)"
-        return err(msg)
+    else:
+        msg = "Failed to detach %s: %s" % (change.vmdk_path, msg)
+        logging.warning(msg)
+    change.finish(err(msg))
 
-    vm_dev_info = dev_info(disk_slot, pci_slot_number)
+def reconfigure_vm_devices(vm, device_changes):
+    ''' Apply device_changes to vm with one ReconfigVM_Task. Returns None or error message '''
+    spec = vim.vm.ConfigSpec()
+    spec.deviceChange = device_changes
+    try:
+        # vm is bound to the pooled session of the request (see apply_action_VMDK())
+        wait_for_tasks(get_si(), [vm.ReconfigVM_Task(spec=spec)])
+    except vim.fault.VimFault as ex:
+        return ex.msg
+    return None
 
-    setStatusAttached(vmdk_path, vm, vm_dev_info)
+def apply_disk_changes(vm, changes):
+    '''
+    Apply attach/detach changes to vm with a single ReconfigVM_Task and fill
+    in the result of each change.
+    If the combined reconfigure fails, the changes are applied one at a time,
+    so every requester gets the result of its own change.
+    '''
+    topology = vmTopologies.get(vm)
+    reserved = set()
+    for change in changes:
+        if change.attach:
+            topology = prepare_disk_attach(vm, topology, change, reserved)
+        else:
+            topology = prepare_disk_detach(vm, change)
 
-    logging.info("Disk %s successfully attached. controller pci_slot_number=%s, disk_slot=%d",
-                 vmdk_path, pci_slot_number[0], disk_slot)
+    pending = [c for c in changes if c.spec]
+    if not pending:
+        return
 
-    return vm_dev_info
+    msg = reconfigure_vm_devices(vm, [c.spec for c in pending])
+    # The reconfigure changed the VM config change version
+    vmTopologies.forget(vm)
+    if not msg:
+        for change in pending:
+            complete_disk_change(vm, change)
+    elif len(pending) == 1:
+        fail_disk_change(vm, pending[0], msg)
+    else:
+        logging.warning("Reconfigure of %d disks failed (%s), applying changes one at a time",
+                        len(pending), msg)
+        for change in pending:
+            change.spec = None
+            apply_disk_changes(vm, [change])
+
+def disk_attach(vmdk_path, vm):
+    '''
+    Attaches *existing* disk to a vm on a PVSCI controller
+    (we need PVSCSI to avoid SCSI rescans in the guest)
+    return error or unit:bus numbers of newly attached disk.
+    '''
+    return reconfigBatcher.apply(vm, DiskChange(attach=True, vmdk_path=vmdk_path))
 
 
 def err(string):
@@ -1613,24 +2275,13 @@ def err(string):
 
 def disk_detach(vmdk_path, vm):
     """detach disk (by full path) from a vm and return None or err(msg)"""
-
-    device = findDeviceByPath(vmdk_path, vm)
-
-    if not device:
-       # Could happen if the disk attached to a different VM - attach fails
-       # and docker will insist to sending "unmount/detach" which also fails.
-       # Or Plugin retrying operation due to socket errors #1076
-       # Return success since disk is anyway not attached
-       logging.warning("*** Detach disk={0} not found. VM={1}".format(
-                       vmdk_path, vm.config.uuid))
-       return None
-
-    return disk_detach_int(vmdk_path, vm, device)
+    return reconfigBatcher.apply(vm, DiskChange(attach=False, vmdk_path=vmdk_path))
 
 def disk_detach_int(vmdk_path, vm, device, key=None, value=None):
     """
     Disk Detach imlementation. We get here after all validations are done,
-    and here we simply connect to ESX and execute  Reconfig("remove disk") task
+    and here we simply connect to ESX and execute  Reconfig("remove disk") task.
+    Serialized with the attach/detach requests for the VM (see VmReconfigBatcher).
     """
     si = get_si()
     spec = vim.vm.ConfigSpec()
@@ -1643,7 +2294,11 @@ def disk_detach_int(vmdk_path, vm, device, key=None, value=None):
     spec.deviceChange = dev_changes
 
     try:
-        wait_for_tasks(si, [vm.ReconfigVM_Task(spec=spec)])
+        with perf_stats.timed_lock(vm_reconfig_lock(vm), perf_stats.PHASE_VM_LOCK_WAIT):
+            try:
+                wait_for_tasks(si, [vm.ReconfigVM_Task(spec=spec)])
+            finally:
+                vmTopologies.forget(vm)
     except vim.Fault.VimFault as ex:
         ex_type, ex_value, ex_traceback = sys.exc_info()
         msg = "Failed to detach %s: %s" % (vmdk_path, ex.msg)
@@ -1730,15 +2385,13 @@ def set_vol_opts(name, tenant_name, options):
     if has_invalid_opt_value:
         return False
 
-    vol_meta = kv.getAll(vmdk_path)
-    if vol_meta:
-       if not vol_meta[kv.VOL_OPTS]:
+    def set_opts(vol_meta):
+       if not vol_meta.get(kv.VOL_OPTS):
            vol_meta[kv.VOL_OPTS] = {}
        for key in opts.keys():
            vol_meta[kv.VOL_OPTS][key] = opts[key]
-       return kv.setAll(vmdk_path, vol_meta)
 
-    return False
+    return kv.update(vmdk_path, set_opts)
 
 def wait_ops_in_flight():
     # Wait for the event indicating all in-flight ops are drained
@@ -1765,6 +2418,28 @@ def signal_handler_stop(signalnum, frame):
     # Fire a thread to wait for ops in flight to drain
     threadutils.start_new_thread(target=wait_ops_in_flight)
 
+def signal_handler_dump_stats(signalnum, frame):
+    """
+    Request a save of performance and lock stats for admin CLI ('status --perf/--locks').
+    Saving takes locks and logs, which the interrupted thread may hold, so it
+    is done by dump_stats_loop() and not in the handler.
+    """
+    dumpStatsRequest.set()
+
+def dump_stats_loop():
+    """ Stats dump thread: save stats on every dumpStatsRequest """
+    threadutils.set_thread_name("StatsDump")
+    while True:
+        dumpStatsRequest.wait()
+        dumpStatsRequest.clear()
+        try:
+            lock_stats = lockManager.get_lock_stats(LOCK_STATS_TOP)
+            for s in lock_stats:
+                logging.info("Lock stats: %s", s)
+            perf_stats.dump(lock_stats=lock_stats)
+        except Exception as ex:
+            logging.warning("Failed to save performance stats: %s", ex)
+
 def load_vmci():
     global lib
 
@@ -1786,7 +2461,7 @@ def send_vmci_reply(client_socket, reply_string):
 
 def execRequestThread(client_socket, cartel, request):
     '''
-    Execute requests in a thread context with a per volume locking.
+    Execute requests in a worker thread context with a per volume locking.
     '''
     # Before we start, block to allow main thread or other running threads to advance.
     # https://docs.python.org/2/faq/library.html#none-of-my-threads-seem-to-run-why
@@ -1836,14 +2511,18 @@ def execRequestThread(client_socket, cartel, request):
                 reply_string = {u'version': "%s" % vmdk_utils.get_version()}
             else:
                 opts = req["details"]["Opts"] if "Opts" in req["details"] else {}
-                reply_string = executeRequest(
-                                vm_uuid=vm_uuid,
-                                vc_uuid=vc_uuid,
-                                vm_name=vm_name,
-                                config_path=cfg_path,
-                                cmd=req["cmd"],
-                                full_vol_name=req["details"]["Name"],
-                                opts=opts)
+                perf_stats.start_request(req["cmd"])
+                try:
+                    reply_string = executeRequest(
+                                    vm_uuid=vm_uuid,
+                                    vc_uuid=vc_uuid,
+                                    vm_name=vm_name,
+                                    config_path=cfg_path,
+                                    cmd=req["cmd"],
+                                    full_vol_name=req["details"]["Name"],
+                                    opts=opts)
+                finally:
+                    perf_stats.end_request()
 
             logging.info("executeRequest '%s' completed with ret=%s", req["cmd"], reply_string)
             send_vmci_reply(client_socket, reply_string)
@@ -1883,6 +2562,7 @@ def handleVmciRequests(port):
     txt = create_string_buffer(bsize)
     cartel = c_int32()
     vmci_grab_listening_socket(port)
+    requestPool.start()
 
     while True:
         # Listening on VMCI socket
@@ -1894,6 +2574,9 @@ def handleVmciRequests(port):
         if errno == ECONNABORTED:
             logging.warn("Client with non privileged port attempted a request")
             continue
+        if c == VMCI_ERROR and errno == EINTR:
+            # Interrupted by a signal (e.g. stats dump request), not a VMCI failure
+            continue
         if c == VMCI_ERROR:
             # We can self-correct by reoping sockets internally. Give it a chance.
             logging.warning("vmci_get_one_op failed ret=%d: %s (errno=%d) Retrying...",
@@ -1923,10 +2606,12 @@ def handleVmciRequests(port):
 
         opsCounter.incr()
 
-        # Fire a thread to execute the request
-        threadutils.start_new_thread(
-            target=execRequestThread,
-            args=(client_socket, cartel.value, txt.value))
+        # Queue the request for a worker thread, fail it right away if we are overloaded
+        if not requestPool.submit(cartel.value, execRequestThread,
+                                  (client_socket, cartel.value, txt.value)):
+            logging.warning("Request from cartel %d declined: %s", cartel.value, SERVICE_BUSY_ERR)
+            send_vmci_reply(client_socket, err(SERVICE_BUSY_ERR))
+            opsCounter.decr()
 
     # Close listening socket when the loop is over
     logging.info("Closing VMCI listening socket...")
@@ -1941,6 +2626,8 @@ def main():
     logging.info("Version: %s , Pid: %d", vmdk_utils.get_version(), os.getpid() )
     signal.signal(signal.SIGINT, signal_handler_stop)
     signal.signal(signal.SIGTERM, signal_handler_stop)
+    threadutils.start_new_thread(target=dump_stats_loop, daemon=True)
+    signal.signal(signal.SIGUSR1, signal_handler_dump_stats)
     try:
         port = 1019
         opts, args = getopt.getopt(sys.argv[1:], 'hp:')
@@ -1962,6 +2649,8 @@ def main():
 
         kv.init()
         connectLocalSi()
+        threadutils.start_new_thread(target=si_keepalive, daemon=True)
+        threadutils.start_new_thread(target=volumeChanges.rescan_loop, daemon=True)
 
         # start the daemon. Do all the task to start the listener through the daemon
         threadutils.start_new_thread(target=vm_listener.start_vm_changelistener,
@@ -1971,25 +2660,13 @@ def main():
     except Exception as e:
         logging.exception(e)
 
-def getTaskList(prop_collector, tasks):
-    # Create filter
-    obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=task)
-                 for task in tasks]
-    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task,
-                                                               pathSet=[],
-                                                               all=True)
-    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
-    filter_spec.objectSet = obj_specs
-    filter_spec.propSet = [property_spec]
-    return prop_collector.CreateFilter(filter_spec, True)
-
 #-----------------------------------------------------------
 #
 # Support for 'wait for task completion'
 # Keep it here to keep a single file for now
 #
 """
-Written by Michael Rice <michael@michaelrice.org>
+Originally based on a helper written by Michael Rice <michael@michaelrice.org>
 
 Github: https://github.com/michaelrice
 Website: https://michaelrice.github.io/
@@ -1997,46 +2674,184 @@ Blog: http://www.errr-online.com/
 This code has been released under the terms of the Apache 2 licenses
 http://www.apache.org/licenses/LICENSE-2.0.html
 
-Helper module for task operations.
+Helper for task operations. All request threads share one TaskMonitor,
+which tracks outstanding tasks through a single property collector filter.
 """
 
+# Max time (seconds) the task monitor blocks in a single WaitForUpdatesEx call.
+# On timeout the monitor checks if it is still needed and waits again.
+TASK_MONITOR_WAIT_SECONDS = 60
+
+class TaskWaiter(object):
+    """ Completion state of a single vim.Task tracked by TaskMonitor """
+
+    def __init__(self, task):
+        self.task = task
+        self.error = None
+        self._done = threading.Event()
+
+    def set_result(self, error=None):
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        """ Block until the task completes. Raises the task error on failure """
+        self._done.wait()
+        if self.error:
+            raise self.error
+
+
+class TaskMonitorSession(object):
+    """
+    Property collector state for one service instance: a private property collector
+    with a single filter on a ListView which holds all outstanding tasks.
+    """
+
+    def __init__(self, si):
+        self.si = si
+        self.waiters = {}  # str(task) -> TaskWaiter
+        self.closed = False
+        self.pc = si.content.propertyCollector.CreatePropertyCollector()
+        self.view = si.content.viewManager.CreateListView([])
+
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(name='traverseTasks',
+                                                                     type=vim.view.ListView,
+                                                                     path='view',
+                                                                     skip=False)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=self.view,
+                                                            skip=True,
+                                                            selectSet=[traversal_spec])
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task,
+                                                                   pathSet=['info.state', 'info.error'])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec],
+                                                               propSet=[property_spec])
+        self.pcfilter = self.pc.CreateFilter(filter_spec, True)
+
+    def destroy(self):
+        """ Best effort cleanup of server side objects """
+        for destroy in (self.pcfilter.Destroy, self.view.DestroyView,
+                        self.pc.DestroyPropertyCollector):
+            try:
+                destroy()
+            except Exception:
+                pass
+
+
+class TaskMonitor(object):
+    """
+    Waits for completion of vim.Task objects.
+    A single long-lived thread per service instance waits for updates on all
+    outstanding tasks, callers block on a per-task TaskWaiter.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+
+    def _get_session(self, si):
+        """ Return the monitor session for si, (re)creating it if needed. Called under self._lock """
+        if self._session and not self._session.closed and self._session.si is si:
+            return self._session
+
+        # Previous session (if any) exits when its waiters are done
+        self._session = TaskMonitorSession(si)
+        threadutils.start_new_thread(target=self._monitor, args=(self._session,), daemon=True)
+        return self._session
+
+    def wait_for_tasks(self, si, tasks):
+        """ Add tasks to the monitored set and block until all of them complete """
+        waiters = [TaskWaiter(task) for task in tasks]
+        with self._lock:
+            session = self._get_session(si)
+            for waiter in waiters:
+                session.waiters[str(waiter.task)] = waiter
+        try:
+            session.view.ModifyListView(add=tasks)
+            for waiter in waiters:
+                waiter.wait()
+        finally:
+            with self._lock:
+                for waiter in waiters:
+                    session.waiters.pop(str(waiter.task), None)
+            if not session.closed:
+                try:
+                    session.view.ModifyListView(remove=tasks)
+                except Exception as ex:
+                    logging.debug("TaskMonitor: failed to remove tasks from view: %s", ex)
+
+    def _monitor(self, session):
+        """ Monitor thread: dispatch task state changes to the waiters of session """
+        threadutils.set_thread_name("TaskMonitor")
+        logging.info("TaskMonitor thread started")
+        wait_options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=TASK_MONITOR_WAIT_SECONDS)
+        version = ''
+        try:
+            while True:
+                with self._lock:
+                    if self._session is not session and not session.waiters:
+                        # superseded by a new session and nobody waits on us
+                        break
+                update = session.pc.WaitForUpdatesEx(version, wait_options)
+                if not update:
+                    continue
+                version = update.version
+                for filter_set in update.filterSet:
+                    for obj_set in filter_set.objectSet:
+                        self._process_task_update(session, obj_set)
+        except Exception as ex:
+            logging.warning("TaskMonitor: failed to wait for task updates: %s", ex)
+            if is_connection_error(ex):
+                mark_si_stale(session.si)
+            self._fail_all(session, ex)
+        finally:
+            with self._lock:
+                session.closed = True
+            session.destroy()
+            logging.info("TaskMonitor thread exiting")
+
+    def _process_task_update(self, session, obj_set):
+        """ Complete the waiter for the task in obj_set, if the task is done """
+        task = obj_set.obj
+        state, error = None, None
+        for change in obj_set.changeSet:
+            if change.name == 'info.state':
+                state = change.val
+            elif change.name == 'info.error':
+                error = change.val
+
+        if state == vim.TaskInfo.State.error and not error:
+            error = task.info.error
+
+        if state not in (vim.TaskInfo.State.success, vim.TaskInfo.State.error):
+            return
+
+        with self._lock:
+            waiter = session.waiters.pop(str(task), None)
+        if waiter:
+            waiter.set_result(error if state == vim.TaskInfo.State.error else None)
+
+    def _fail_all(self, session, ex):
+        """ Wake up all waiters of session with error ex """
+        with self._lock:
+            session.closed = True
+            waiters = list(session.waiters.values())
+            session.waiters.clear()
+        for waiter in waiters:
+            waiter.set_result(ex)
+
+
+# Shared by all request threads
+taskMonitor = TaskMonitor()
+
 def wait_for_tasks(si, tasks):
     """Given the service instance si and tasks, it returns after all the
    tasks are complete
+   si is the session the tasks were started on. Tasks are host wide objects,
+   so all of them are monitored by one TaskMonitor over the main session
+   rather than by one per pooled session.
    """
-    task_list = [str(task) for task in tasks]
-    property_collector = si.content.propertyCollector
-    pcfilter = getTaskList(property_collector, tasks)
-
-    try:
-        version, state = None, None
-        # Loop looking for updates till the state moves to a completed state.
-        while len(task_list):
-            update = property_collector.WaitForUpdates(version)
-            for filter_set in update.filterSet:
-                for obj_set in filter_set.objectSet:
-                    task = obj_set.obj
-                    for change in obj_set.changeSet:
-                        if change.name == 'info':
-                            state = change.val.state
-                        elif change.name == 'info.state':
-                            state = change.val
-                        else:
-                            continue
-
-                        if not str(task) in task_list:
-                            continue
-
-                        if state == vim.TaskInfo.State.success:
-                            # Remove task from taskList
-                            task_list.remove(str(task))
-                        elif state == vim.TaskInfo.State.error:
-                            raise task.info.error
-            # Move to next version
-            version = update.version
-    finally:
-        if pcfilter:
-            pcfilter.Destroy()
+    with perf_stats.phase(perf_stats.PHASE_HOSTD_TASK):
+        taskMonitor.wait_for_tasks(get_si(), tasks)
 
 #------------------------
 
@@ -23,6 +23,9 @@ import logging
 import glob
 import os
 import os.path
+import shutil
+import tempfile
+import threading
 import time
 
 import vmdk_ops
@@ -49,6 +52,7 @@ from vmdkops_admin_sanity_test import ADMIN_CLI
 import glob
 import vmdkops_admin
 import test_utils
+import volume_changes
 # Max volumes count we can attach to a singe VM.
 MAX_VOL_COUNT_FOR_ATTACH = 60
 
@@ -104,6 +108,246 @@ class VolumeNamingTestCase(unittest.TestCase):
                 self.assertFalse(expected_result, "Expected vol name parsing to succeed for '{0}'"
                                  .format(full_name))
 
+class ListPagingTestCase(unittest.TestCase):
+    """Unit test for paged "list" replies"""
+
+    names = ["vol{0:02d}@ds1".format(i) for i in range(25)]
+
+    def setUp(self):
+        self.lists = 0
+        self.iter_volume_names = vmdk_ops.iter_volume_names
+        vmdk_ops.iter_volume_names = self.list_volumes
+        self.volume_changes = vmdk_ops.volumeChanges
+        vmdk_ops.volumeChanges = volume_changes.VolumeChanges(self.list_volumes,
+                                                              lambda: frozenset(self.names))
+
+    def tearDown(self):
+        vmdk_ops.iter_volume_names = self.iter_volume_names
+        vmdk_ops.volumeChanges = self.volume_changes
+
+    def list_volumes(self, tenant):
+        self.lists += 1
+        # unordered, as volumes come in directory order
+        return iter(reversed(self.names))
+
+    def list_page(self, page_size, cursor=None, sequence=None):
+        opts = {vmdk_ops.LIST_PAGE_SIZE: page_size}
+        if cursor:
+            opts[vmdk_ops.LIST_CURSOR] = cursor
+        if sequence:
+            opts[vmdk_ops.LIST_SEQUENCE] = sequence
+        return vmdk_ops.listVMDK(None, opts)
+
+    def test_full_list(self):
+        self.assertEqual(sorted(vol[u'Name'] for vol in vmdk_ops.listVMDK(None)), self.names)
+
+    def test_pages(self):
+        names = []
+        cursor = None
+        sequence = None
+        pages = 0
+        while True:
+            page = self.list_page(10, cursor, sequence)
+            sequence = page[u'Sequence']
+            self.assertLessEqual(len(page[u'Volumes']), 10)
+            names.extend(vol[u'Name'] for vol in page[u'Volumes'])
+            pages += 1
+            cursor = page[u'Cursor']
+            if not cursor:
+                break
+            self.assertEqual(cursor, names[-1])
+        self.assertEqual(names, self.names)
+        self.assertEqual(pages, 3)
+        # the datastores are listed once for all pages
+        self.assertEqual(self.lists, 1)
+
+    def test_pages_of_sequence(self):
+        page = self.list_page(20)
+        self.names = self.names[1:] + ["vol99@ds1"]
+        vmdk_ops.volumeChanges.bump()
+        # next page from the list of the first one
+        next_page = self.list_page(20, page[u'Cursor'], page[u'Sequence'])
+        self.assertEqual(next_page[u'Sequence'], page[u'Sequence'])
+        self.assertEqual(len(next_page[u'Volumes']), 5)
+        # unknown sequence, from the current list
+        next_page = self.list_page(20, page[u'Cursor'], page[u'Sequence'] - 1)
+        self.assertGreater(next_page[u'Sequence'], page[u'Sequence'])
+        self.assertEqual(next_page[u'Volumes'][-1][u'Name'], "vol99@ds1")
+
+    def test_exact_page(self):
+        page = self.list_page(len(self.names))
+        self.assertEqual(len(page[u'Volumes']), len(self.names))
+        self.assertIsNone(page[u'Cursor'])
+
+    def test_cursor(self):
+        page = self.list_page("5", cursor="vol19@ds1")
+        self.assertEqual([vol[u'Name'] for vol in page[u'Volumes']], self.names[20:25])
+        self.assertIsNone(page[u'Cursor'])
+        # past the last volume
+        page = self.list_page(5, cursor="vol99@ds1")
+        self.assertEqual((page[u'Volumes'], page[u'Cursor']), ([], None))
+
+    def test_invalid_page_size(self):
+        for page_size in [0, -1, vmdk_ops.MAX_LIST_PAGE_SIZE + 1, "ten", None]:
+            self.assertIn(u'Error', self.list_page(page_size), page_size)
+        self.assertIn(u'Error', vmdk_ops.listVMDK(None, {vmdk_ops.LIST_PAGE_SIZE: 10,
+                                                         vmdk_ops.LIST_SINCE: None}))
+        self.assertIn(u'Error', self.list_page(10, sequence="first"))
+
+
+class ListSinceTestCase(unittest.TestCase):
+    """Unit test for "list" replies with changes since a previous list"""
+
+    def setUp(self):
+        self.names = {"vol1@ds1", "vol2@ds1"}
+        self.volume_changes = vmdk_ops.volumeChanges
+        vmdk_ops.volumeChanges = volume_changes.VolumeChanges(lambda tenant: iter(self.names),
+                                                              lambda: frozenset(self.names))
+
+    def tearDown(self):
+        vmdk_ops.volumeChanges = self.volume_changes
+
+    def list_since(self, since):
+        return vmdk_ops.listVMDK(None, {vmdk_ops.LIST_SINCE: since})
+
+    def test_full_list(self):
+        result = self.list_since(None)
+        self.assertEqual([vol[u'Name'] for vol in result[u'Volumes']], sorted(self.names))
+        # unknown sequence
+        result = self.list_since(result[u'Sequence'] - 1)
+        self.assertEqual([vol[u'Name'] for vol in result[u'Volumes']], sorted(self.names))
+
+    def test_unchanged(self):
+        sequence = self.list_since(None)[u'Sequence']
+        self.assertEqual(self.list_since(str(sequence)), {u'Sequence': sequence, u'Unchanged': True})
+
+    def test_changes(self):
+        sequence = self.list_since(None)[u'Sequence']
+        self.names = {"vol2@ds1", "vol3@ds1"}
+        vmdk_ops.volumeChanges.bump()
+        result = self.list_since(sequence)
+        self.assertGreater(result[u'Sequence'], sequence)
+        self.assertEqual(result[u'Added'], [{u'Name': "vol3@ds1", u'Attributes': {}}])
+        self.assertEqual(result[u'Removed'], [{u'Name': "vol1@ds1"}])
+
+    def test_invalid_since(self):
+        self.assertIn(u'Error', self.list_since("yesterday"))
+
+
+class VolPathCacheTestCase(unittest.TestCase):
+    """Unit test for VolPathCache validation"""
+
+    key = ("ds1", "tenant1", "vol1")
+    datastores = [("ds1", "url1", "/vmfs/volumes/ds1/dockvols")]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.vmdk_path = os.path.join(self.tmp_dir, "vol1.vmdk")
+        # old enough to be trusted
+        os.utime(self.tmp_dir, (time.time() - 60, time.time() - 60))
+        self.datastore_cache = vmdk_utils.datastoreCache
+        vmdk_utils.datastoreCache = vmdk_utils.DatastoreCache()
+        vmdk_utils.datastoreCache.load(list(self.datastores))
+        self.cache = vmdk_ops.VolPathCache()
+
+    def tearDown(self):
+        vmdk_utils.datastoreCache = self.datastore_cache
+        shutil.rmtree(self.tmp_dir)
+
+    def put(self):
+        self.cache.put(self.key, vmdk_utils.datastoreCache.generation, self.tmp_dir,
+                       os.stat(self.tmp_dir).st_mtime_ns, self.vmdk_path)
+
+    def test_hit(self):
+        self.put()
+        self.assertEqual(self.cache.get(self.key), self.vmdk_path)
+        # datastores scanned again without changes
+        vmdk_utils.datastoreCache.load(list(self.datastores))
+        self.assertEqual(self.cache.get(self.key), self.vmdk_path)
+
+    def test_recent_mtime(self):
+        # the directory may change again within the mtime granularity
+        os.utime(self.tmp_dir)
+        self.put()
+        self.assertIsNone(self.cache.get(self.key))
+
+    def test_dir_changed(self):
+        self.put()
+        open(self.vmdk_path, "w").close()
+        self.assertIsNone(self.cache.get(self.key))
+
+    def test_dir_removed(self):
+        self.put()
+        shutil.rmtree(self.tmp_dir)
+        self.assertIsNone(self.cache.get(self.key))
+        os.mkdir(self.tmp_dir)
+
+    def test_datastores_changed(self):
+        self.put()
+        vmdk_utils.datastoreCache.load(self.datastores + [("ds2", "url2", "/vmfs/volumes/ds2/dockvols")])
+        self.assertIsNone(self.cache.get(self.key))
+
+    def test_forget(self):
+        self.put()
+        self.cache.forget(self.key)
+        self.assertIsNone(self.cache.get(self.key))
+
+
+class VmReconfigBatcherTestCase(unittest.TestCase):
+    """Unit test for batching of attach/detach changes per VM"""
+
+    class FakeVM(object):
+        _moId = "vm-1"
+
+    def setUp(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.apply_disk_changes = vmdk_ops.apply_disk_changes
+        vmdk_ops.apply_disk_changes = self.fake_apply
+        self.batcher = vmdk_ops.VmReconfigBatcher()
+
+    def tearDown(self):
+        vmdk_ops.apply_disk_changes = self.apply_disk_changes
+
+    def fake_apply(self, vm, changes):
+        self.batches.append([c.vmdk_path for c in changes])
+        if len(self.batches) == 1:
+            self.release.wait(5)
+        for change in changes:
+            change.finish(change.vmdk_path)
+
+    def change(self, vmdk_path):
+        return vmdk_ops.DiskChange(attach=True, vmdk_path=vmdk_path)
+
+    def test_single_change(self):
+        self.release.set()
+        self.assertEqual(self.batcher.apply(self.FakeVM(), self.change("d1")), "d1")
+        self.assertEqual(self.batches, [["d1"]])
+
+    def test_batch_while_running(self):
+        results = {}
+
+        def apply(vmdk_path):
+            results[vmdk_path] = self.batcher.apply(self.FakeVM(), self.change(vmdk_path))
+
+        first = threading.Thread(target=apply, args=("d1",))
+        first.start()
+        while not self.batches:
+            time.sleep(0.01)
+        # reconfigure of d1 in progress, these are collected
+        others = [threading.Thread(target=apply, args=(path,)) for path in ("d2", "d3")]
+        for thread in others:
+            thread.start()
+        while len(self.batcher._batches.get("vm-1", vmdk_ops.DiskChangeBatch()).changes) < 2:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in [first] + others:
+            thread.join(5)
+        self.assertEqual(results, {"d1": "d1", "d2": "d2", "d3": "d3"})
+        self.assertEqual(len(self.batches), 2)
+        self.assertEqual(sorted(self.batches[1]), ["d2", "d3"])
+
+
 class VmdkCreateRemoveTestCase(unittest.TestCase):
     """Unit test for VMDK Create and Remove ops"""
 
@@ -775,6 +1019,53 @@ class VmdkTenantTestCase(unittest.TestCase):
         if self.vm3:
             test_utils.remove_vm(si, self.vm3)
 
+    def test_list_since_on_create_remove(self):
+        """ Test "list" with "since" after volumes are created and removed by executeRequest """
+        vm1_uuid = vmdk_utils.get_vm_uuid_by_name(self.vm1_name)
+        vol_name = self.default_tenant_vol1_name
+        since = {vmdk_ops.LIST_SINCE: None}
+        sequence = vmdk_ops.executeRequest(vm1_uuid, self.vm1_name, self.vm1_config_path,
+                                           'list', None, since)[u'Sequence']
+
+        opts = {u'size': u'100MB', u'fstype': u'ext4'}
+        error_info = vmdk_ops.executeRequest(vm1_uuid, self.vm1_name, self.vm1_config_path,
+                                             auth.CMD_CREATE, vol_name, opts)
+        self.assertEqual(None, error_info)
+        self.assertGreater(vmdk_ops.volumeChanges.sequence, sequence)
+        since = {vmdk_ops.LIST_SINCE: sequence}
+        result = vmdk_ops.executeRequest(vm1_uuid, self.vm1_name, self.vm1_config_path,
+                                         'list', None, since)
+        self.assertIn(vol_name, [vol[u'Name'].split("@")[0] for vol in result[u'Added']])
+        sequence = result[u'Sequence']
+
+        error_info = vmdk_ops.executeRequest(vm1_uuid, self.vm1_name, self.vm1_config_path,
+                                             auth.CMD_REMOVE, vol_name, {})
+        self.assertEqual(None, error_info)
+        since = {vmdk_ops.LIST_SINCE: sequence}
+        result = vmdk_ops.executeRequest(vm1_uuid, self.vm1_name, self.vm1_config_path,
+                                         'list', None, since)
+        self.assertIn(vol_name, [vol[u'Name'].split("@")[0] for vol in result[u'Removed']])
+
+    def test_vol_path_forget_on_create_remove(self):
+        """ Test that executeRequest drops cached paths of volumes it creates or removes """
+        vm1_uuid = vmdk_utils.get_vm_uuid_by_name(self.vm1_name)
+        vol_name = self.default_tenant_vol2_name
+        key = (self.datastore_name, auth_data_const.DEFAULT_TENANT, vol_name)
+        stale_entry = (vmdk_utils.datastoreCache.generation, self.datastore_path, 0, "stale.vmdk")
+
+        vmdk_ops.volPathCache._entries[key] = stale_entry
+        opts = {u'size': u'100MB', u'fstype': u'ext4'}
+        error_info = vmdk_ops.executeRequest(vm1_uuid, self.vm1_name, self.vm1_config_path,
+                                             auth.CMD_CREATE, vol_name, opts)
+        self.assertEqual(None, error_info)
+        self.assertNotIn(key, vmdk_ops.volPathCache._entries)
+
+        vmdk_ops.volPathCache._entries[key] = stale_entry
+        error_info = vmdk_ops.executeRequest(vm1_uuid, self.vm1_name, self.vm1_config_path,
+                                             auth.CMD_REMOVE, vol_name, {})
+        self.assertEqual(None, error_info)
+        self.assertNotIn(key, vmdk_ops.volPathCache._entries)
+
     def test_vmdkops_on_default_tenant_vm(self):
         """ Test vmdk life cycle on a VM which belongs to DEFAULT tenant """
         # This test tests the following cases:
@@ -18,8 +18,16 @@
 ## module exposes a set of functions that allow creat/delete/get/set
 ## on the kv store. Currently uses side cars to keep KV pairs for
 ## a given volume.
+## Metadata read or written by this process is cached (see MetaCache), and
+## kept in the host-local volume index (see volume_index.py).
+
+import copy
+import os
+import threading
+import time
 
 import kvESX
+from volume_index import volumeIndex
 
 # All possible metadata keys for the volume. New keys should be added here as
 # constants pointing to strings.
@@ -92,6 +100,162 @@ DEFAULT_FILESYSTEM_TYPE = 'ext4'
 CLONE_FROM = 'clone-from' # clone volume parent
 DEFAULT_CLONE_FROM = 'None'
 
+class MetaCache(object):
+    """
+    Process wide write-through cache of volume metadata, keyed by vmdk path.
+    Entries are validated against the side car file signature (see _file_sig)
+    on every use, so changes made by other processes or hosts are picked up.
+    Callers get their own copy of the metadata and may change it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # vol_path -> (side car file signature, metadata)
+        self._entries = {}
+
+    def get(self, vol_path, file_sig, meta_file=None):
+        """
+        Return cached metadata if the side car still has file_sig, else None.
+        An entry cached shortly after a write has the side car generation in
+        its signature (see _file_sig). Once the side car aged, it is checked
+        by generation once more (meta_file is read for that) and kept with
+        the aged signature.
+        """
+        with self._lock:
+            entry = self._entries.get(vol_path)
+        if not entry:
+            return None
+        if entry[0] != file_sig:
+            if not meta_file or not _sig_aged(entry[0], file_sig, meta_file):
+                return None
+            with self._lock:
+                if self._entries.get(vol_path) is entry:
+                    self._entries[vol_path] = (file_sig, entry[1])
+        return copy.deepcopy(entry[1])
+
+    def put(self, vol_path, file_sig, vol_meta):
+        with self._lock:
+            self._entries[vol_path] = (file_sig, copy.deepcopy(vol_meta))
+
+    def forget(self, vol_path):
+        with self._lock:
+            self._entries.pop(vol_path, None)
+
+
+metaCache = MetaCache()
+
+
+# Seconds disk size info (see get_vol_info) is cached for. The allocated size
+# changes with guest writes, which we are not told about.
+VOL_INFO_TTL = 10
+
+
+class VolInfoCache(object):
+    """
+    Process wide cache of disk size info, keyed by vmdk path.
+    Entries expire after VOL_INFO_TTL, are validated against the vmdk
+    descriptor (inode, mtime), and are dropped on any metadata change of the
+    volume, i.e. on attach and detach.
+    """
+
+    def __init__(self, ttl=VOL_INFO_TTL):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        # vol_path -> (time fetched, descriptor signature, info)
+        self._entries = {}
+
+    def get(self, vol_path, desc_sig):
+        """ Return cached info if not expired and the descriptor still has desc_sig, else None """
+        with self._lock:
+            entry = self._entries.get(vol_path)
+        if entry and entry[1] == desc_sig and time.time() - entry[0] < self._ttl:
+            return dict(entry[2])
+        return None
+
+    def put(self, vol_path, desc_sig, info, fetched):
+        now = time.time()
+        with self._lock:
+            self._entries = dict((path, entry) for path, entry in self._entries.items()
+                                 if now - entry[0] < self._ttl)
+            self._entries[vol_path] = (fetched, desc_sig, dict(info))
+
+    def forget(self, vol_path):
+        with self._lock:
+            self._entries.pop(vol_path, None)
+
+
+volInfoCache = VolInfoCache()
+
+
+# Side car mtimes may have a coarse granularity. Within this many seconds
+# of the last write, the side car generation is part of its signature.
+META_MTIME_GRANULARITY = 2
+
+
+def _file_sig(meta_file):
+    """
+    Return (inode, size, mtime) of the side car file, or None if it can't be checked.
+    A side car changed recently also has its generation in the signature, as
+    a write in the same mtime tick does not change the rest of it.
+    """
+    try:
+        st = os.stat(meta_file)
+    except OSError:
+        return None
+    file_sig = (st.st_ino, st.st_size, st.st_mtime_ns)
+    if time.time() - st.st_mtime < META_MTIME_GRANULARITY:
+        file_sig += (kvESX.get_generation(meta_file),)
+    return file_sig
+
+
+def _sig_aged(cached_sig, file_sig, meta_file):
+    """
+    Return True if cached_sig, taken within META_MTIME_GRANULARITY of a write,
+    and file_sig, taken after that, are signatures of the same side car content.
+    """
+    return (len(cached_sig) == len(file_sig) + 1 and
+            cached_sig[:-1] == file_sig and
+            cached_sig[-1] is not None and
+            kvESX.get_generation(meta_file) == cached_sig[-1])
+
+
+def _written_sig(write_sig):
+    """
+    Return the signature (see _file_sig()) of a side car from the signature
+    kvESX.save() took from its descriptor after the write.
+    """
+    if time.time() - write_sig[2] / 1e9 < META_MTIME_GRANULARITY:
+        return tuple(write_sig)
+    return tuple(write_sig[:3])
+
+
+def _cache_saved(vol_path, vol_meta, write_sig):
+    """
+    Cache metadata just written to the side car of vol_path.
+    The signature is the one of our write, so a write by someone else
+    right after it makes the entry miss.
+    """
+    file_sig = _written_sig(write_sig)
+    metaCache.put(vol_path, file_sig, vol_meta)
+    volumeIndex.put_metadata(vol_path, file_sig, vol_meta)
+
+
+def _forget(vol_path):
+    metaCache.forget(vol_path)
+    volInfoCache.forget(vol_path)
+    volumeIndex.forget(vol_path)
+
+
+def _save(vol_path, vol_meta, key=None, value=None):
+    """ Write vol_meta to the side car through the cache """
+    write_sig = kvESX.save(vol_path, vol_meta, key, value)
+    if write_sig:
+        volInfoCache.forget(vol_path)
+        _cache_saved(vol_path, vol_meta, write_sig)
+        return True
+    return False
+
+
 # Create a kv store object for this volume identified by vol_path
 # Create the side car or open if it exists.
 def init():
@@ -102,7 +266,12 @@ def create(vol_path, vol_meta):
     Create a side car KV store for given vol_path.
     Return true if successful, false otherwise
     """
-    return kvESX.create(vol_path, vol_meta)
+    _forget(vol_path)
+    write_sig = kvESX.create(vol_path, vol_meta)
+    if write_sig:
+        _cache_saved(vol_path, vol_meta, write_sig)
+        return True
+    return False
 
 
 def delete(vol_path):
@@ -110,6 +279,7 @@ def delete(vol_path):
     Delete a kv store object for this volume identified by vol_path.
     Return true if successful, false otherwise
     """
+    _forget(vol_path)
     return kvESX.delete(vol_path)
 
 
@@ -118,7 +288,26 @@ def getAll(vol_path):
     Return the entire meta-data for the given vol_path.
     Return true if successful, false otherwise
     """
-    return kvESX.load(vol_path)
+    meta_file = kvESX.get_meta_file(vol_path)
+    if not meta_file:
+        return None
+    file_sig = _file_sig(meta_file)
+    if file_sig:
+        vol_meta = metaCache.get(vol_path, file_sig, meta_file)
+        if vol_meta is not None:
+            return vol_meta
+        vol_meta = volumeIndex.get_metadata(vol_path, file_sig)
+        if vol_meta is not None:
+            metaCache.put(vol_path, file_sig, vol_meta)
+            return vol_meta
+
+    vol_meta = kvESX.load(vol_path)
+    # file_sig is taken before the read, so a concurrent change of
+    # the side car makes the entry miss on next use
+    if vol_meta is not None and file_sig:
+        metaCache.put(vol_path, file_sig, vol_meta)
+        volumeIndex.put_metadata(vol_path, file_sig, vol_meta)
+    return vol_meta
 
 
 def setAll(vol_path, vol_meta, key=None, value=None):
@@ -127,28 +316,55 @@ def setAll(vol_path, vol_meta, key=None, value=None):
     Return true if successful, false otherwise
     """
     if vol_meta:
-        return kvESX.save(vol_path, vol_meta, key, value)
+        return _save(vol_path, vol_meta, key, value)
     # No data to save
     return True
 
 
-# Set a string value for a given key(index)
-def set_kv(vol_path, key, val):
-    vol_meta = kvESX.load(vol_path)
+def update(vol_path, mutator, expect=None, missing_ok=False):
+    """
+    Atomically read, change and write the meta-data for vol_path.
+    mutator(vol_meta) changes the meta-data dict in place. If missing_ok is
+    set, mutator gets an empty dict when there is no meta-data, otherwise
+    the update fails.
+    expect is an optional dict of key: value; the update is only done if
+    each key is either not present or has the given value.
+    The side car is not written if the meta-data is unchanged.
+    Return true if successful, false otherwise
+    """
+    with kvESX.get_volume_lock(vol_path):
+        vol_meta = getAll(vol_path)
+        if not vol_meta:
+            if not missing_ok:
+                return False
+            vol_meta = {}
+
+        if expect:
+            for key, value in expect.items():
+                if key in vol_meta and vol_meta[key] != value:
+                    return False
+
+        orig_meta = copy.deepcopy(vol_meta)
+        mutator(vol_meta)
+        if vol_meta == orig_meta or not vol_meta:
+            # Nothing to save
+            return True
+        return _save(vol_path, vol_meta)
 
-    if not vol_meta:
-        return False
 
-    vol_meta[key] = val
+# Set a string value for a given key(index)
+def set_kv(vol_path, key, val):
+    def set_key(vol_meta):
+        vol_meta[key] = val
 
-    return kvESX.save(vol_path, vol_meta)
+    return update(vol_path, set_key)
 
 
 def get_kv(vol_path, key):
     """
     Return a string value for the given key, or None if the key is not present.
     """
-    vol_meta = kvESX.load(vol_path)
+    vol_meta = getAll(vol_path)
 
     if not vol_meta:
         return None
@@ -164,18 +380,40 @@ def remove(vol_path, key):
     Remove a key/value pair from the store. Return true on success, false on
     error.
     """
-    vol_meta = kvESX.load(vol_path)
+    def remove_key(vol_meta):
+        vol_meta.pop(key, None)
 
-    if not vol_meta:
-        return False
+    return update(vol_path, remove_key)
 
-    if key in vol_meta:
-        del vol_meta[key]
+def get_vol_info(vol_path):
+    """ Return disk size info for vol_path, or None on error. Cached, see VolInfoCache """
+    return get_vol_infos([vol_path])[vol_path]
 
-    return kvESX.save(vol_path, vol_meta)
 
-def get_vol_info(vol_path):
-   return kvESX.get_info(vol_path)
+def get_vol_infos(vol_paths):
+    """
+    Return a dict of vol_path -> disk size info (or None on error) for a list
+    of volumes. Volumes not cached are queried in one batch.
+    """
+    infos = {}
+    missing = {}
+    for vol_path in vol_paths:
+        desc_sig = kvESX.get_descriptor_sig(vol_path)
+        info = volInfoCache.get(vol_path, desc_sig) if desc_sig else None
+        if info is not None:
+            infos[vol_path] = info
+        else:
+            missing[vol_path] = desc_sig
+
+    if missing:
+        # taken before the query, so a change meanwhile expires the entry early
+        fetched = time.time()
+        for vol_path, info in kvESX.get_infos(list(missing)).items():
+            infos[vol_path] = info
+            if info is not None and missing[vol_path]:
+                volInfoCache.put(vol_path, missing[vol_path], info, fetched)
+    return infos
 
 def fixup_kv(src_volpath, dst_volpath):
+    _forget(dst_volpath)
     return kvESX.fixup_kv(src_volpath, dst_volpath)
@@ -0,0 +1,181 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests for volume metadata caching in volume_kv.py
+
+import time
+import unittest
+import uuid
+
+import auth_data_const
+import kvESX
+import log_config
+import test_utils
+import vmdk_ops
+import vmdk_utils
+import volume_kv
+
+
+class MetaCacheTestCase(unittest.TestCase):
+    """ Unit test of MetaCache signature checks """
+
+    vol_path = "/vmfs/volumes/ds1/dockvols/vol1.vmdk"
+    meta_file = "/vmfs/volumes/ds1/dockvols/vol1-1234.vmfd"
+
+    def setUp(self):
+        self.cache = volume_kv.MetaCache()
+        self.generation = 7
+        self.generation_reads = 0
+        self.get_generation = kvESX.get_generation
+        kvESX.get_generation = self.read_generation
+
+    def tearDown(self):
+        kvESX.get_generation = self.get_generation
+
+    def read_generation(self, meta_file):
+        self.generation_reads += 1
+        return self.generation
+
+    def test_hit(self):
+        meta = {volume_kv.STATUS: volume_kv.DETACHED}
+        self.cache.put(self.vol_path, (1, 2, 3), meta)
+        self.assertEqual(self.cache.get(self.vol_path, (1, 2, 3), self.meta_file), meta)
+        # callers get their own copy
+        self.cache.get(self.vol_path, (1, 2, 3))[volume_kv.STATUS] = volume_kv.ATTACHED
+        self.assertEqual(self.cache.get(self.vol_path, (1, 2, 3)), meta)
+        self.assertEqual(self.generation_reads, 0)
+
+    def test_miss_on_change(self):
+        self.cache.put(self.vol_path, (1, 2, 3), {volume_kv.STATUS: volume_kv.DETACHED})
+        self.assertIsNone(self.cache.get(self.vol_path, (1, 2, 4), self.meta_file))
+        self.assertIsNone(self.cache.get(self.vol_path, (1, 3, 3), self.meta_file))
+
+    def test_aged_signature(self):
+        meta = {volume_kv.STATUS: volume_kv.DETACHED}
+        # cached within META_MTIME_GRANULARITY of the write
+        self.cache.put(self.vol_path, (1, 2, 3, 7), meta)
+        self.assertEqual(self.cache.get(self.vol_path, (1, 2, 3), self.meta_file), meta)
+        self.assertEqual(self.generation_reads, 1)
+        # kept with the aged signature
+        self.assertEqual(self.cache.get(self.vol_path, (1, 2, 3), self.meta_file), meta)
+        self.assertEqual(self.generation_reads, 1)
+
+    def test_aged_signature_changed(self):
+        self.cache.put(self.vol_path, (1, 2, 3, 6), {volume_kv.STATUS: volume_kv.DETACHED})
+        self.assertIsNone(self.cache.get(self.vol_path, (1, 2, 3), self.meta_file))
+        # v1 side cars have no generation
+        self.cache.put(self.vol_path, (1, 2, 3, None), {volume_kv.STATUS: volume_kv.DETACHED})
+        self.generation = None
+        self.assertIsNone(self.cache.get(self.vol_path, (1, 2, 3), self.meta_file))
+
+    def test_written_sig(self):
+        now_ns = int(time.time() * 1e9)
+        # just written, the generation tells writes in the same mtime tick apart
+        self.assertEqual(volume_kv._written_sig((1, 2, now_ns, 7)), (1, 2, now_ns, 7))
+        self.assertEqual(volume_kv._written_sig((1, 2, 3, 7)), (1, 2, 3))
+
+    def test_forget(self):
+        self.cache.put(self.vol_path, (1, 2, 3), {volume_kv.STATUS: volume_kv.DETACHED})
+        self.cache.forget(self.vol_path)
+        self.assertIsNone(self.cache.get(self.vol_path, (1, 2, 3)))
+
+
+class VolumeKVCacheTestCase(unittest.TestCase):
+    """ Test metadata caching of volumes on the first datastore """
+
+    vm_name = test_utils.generate_test_vm_name()
+    volName = "vol_UnitTest_KVCache"
+    cloneName = "vol_UnitTest_KVCache_Clone"
+
+    def setUp(self):
+        datastore = vmdk_utils.get_datastores()[0]
+        self.datastore_url = datastore[1]
+        path, err = vmdk_ops.get_vol_path(datastore[0], auth_data_const.DEFAULT_TENANT)
+        self.assertEqual(err, None, err)
+        self.name = vmdk_utils.get_vmdk_path(path, self.volName)
+        self.clone_name = vmdk_utils.get_vmdk_path(path, self.cloneName)
+
+        self.loads = 0
+        self.load = kvESX.load
+        kvESX.load = self.counting_load
+
+    def tearDown(self):
+        kvESX.load = self.load
+        vmdk_ops.removeVMDK(self.clone_name)
+        vmdk_ops.removeVMDK(self.name)
+
+    def counting_load(self, volpath):
+        self.loads += 1
+        return self.load(volpath)
+
+    def create(self):
+        err = vmdk_ops.createVMDK(vmdk_path=self.name,
+                                  vm_name=self.vm_name,
+                                  vol_name=self.volName)
+        self.assertEqual(err, None, err)
+
+    def testHit(self):
+        self.create()
+        vol_meta = volume_kv.getAll(self.name)
+        self.assertEqual(vol_meta[volume_kv.STATUS], volume_kv.DETACHED)
+        self.assertEqual(volume_kv.getAll(self.name), vol_meta)
+        self.assertEqual(self.loads, 0)
+
+    def testMissOnChange(self):
+        self.create()
+        self.assertTrue(volume_kv.set_kv(self.name, volume_kv.STATUS, volume_kv.ATTACHED))
+        self.assertEqual(volume_kv.get_kv(self.name, volume_kv.STATUS), volume_kv.ATTACHED)
+
+        # Side car changed by someone else
+        volume_kv.metaCache.forget(self.name)
+        vol_meta = kvESX.load(self.name)
+        vol_meta[volume_kv.STATUS] = volume_kv.DETACHED
+        self.assertTrue(kvESX.save(self.name, vol_meta))
+        self.assertEqual(volume_kv.get_kv(self.name, volume_kv.STATUS), volume_kv.DETACHED)
+
+    def testRemove(self):
+        self.create()
+        self.assertNotEqual(volume_kv.getAll(self.name), None)
+        err = vmdk_ops.removeVMDK(self.name)
+        self.assertEqual(err, None, err)
+        self.assertEqual(volume_kv.getAll(self.name), None)
+        # recreated volume gets its own metadata
+        err = vmdk_ops.createVMDK(vmdk_path=self.name,
+                                  vm_name=self.vm_name,
+                                  vol_name=self.volName,
+                                  opts={volume_kv.SIZE: "200mb"})
+        self.assertEqual(err, None, err)
+        self.assertEqual(volume_kv.getAll(self.name)[volume_kv.VOL_OPTS][volume_kv.SIZE], "200mb")
+
+    def testClone(self):
+        self.create()
+        self.assertTrue(volume_kv.set_kv(self.name, volume_kv.STATUS, volume_kv.DETACHED))
+        err = vmdk_ops.createVMDK(vmdk_path=self.clone_name,
+                                  vm_name=self.vm_name,
+                                  vol_name=self.cloneName,
+                                  opts={volume_kv.CLONE_FROM: self.volName},
+                                  vm_uuid=str(uuid.uuid4()),
+                                  datastore_url=self.datastore_url)
+        self.assertEqual(err, None, err)
+        clone_meta = volume_kv.getAll(self.clone_name)
+        self.assertEqual(clone_meta[volume_kv.STATUS], volume_kv.DETACHED)
+        self.assertEqual(clone_meta[volume_kv.VOL_OPTS][volume_kv.CLONE_FROM], self.volName)
+        # source is unchanged
+        self.assertNotIn(volume_kv.CLONE_FROM, volume_kv.getAll(self.name)[volume_kv.VOL_OPTS])
+
+
+if __name__ == '__main__':
+    log_config.configure()
+    volume_kv.init()
+    unittest.main()